@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmark for parsing of TextStat heavy replies.
+
+Parses a get-text-stat reply (as received from lyskomd for a text
+with several recipients, comments and aux-items) many times, with both
+the blocking ReceiveBuffer and the AioReceiveBuffer, and reports the
+best of --repeat runs and the number of function calls per text-stat.
+
+Run from the top directory with:
+
+    python benchmarks/bench_parse.py
+
+To compare with another revision, give it with --rev. Its pylyskom
+package is extracted with git archive and benchmarked in a separate
+process, before the working tree:
+
+    python benchmarks/bench_parse.py --rev a64738d~
+
+Results from before and after the token level reading in the receive
+buffers (cbbefa0 and a64738d, --count 2000, best of 25, on a noisy
+single-core VM, so the call counts are the more reliable comparison):
+
+    function calls per text-stat:  917 -> 566
+    AioReceiveBuffer:              192 us -> 101 us
+    ReceiveBuffer:                 188 us -> 96 us
+"""
+
+import argparse
+import cProfile
+import importlib
+import os
+import pstats
+import subprocess
+import sys
+import tempfile
+import time
+
+
+TOP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+TEXT_STAT_REPLY = (
+    b"51 36 14 3 9 123 2 275 0 14506 3 117 0 "
+    b"13 { 0 6 6 19932 2 4711 0 14506 6 2387 7 51 36 14 3 9 123 2 275 0 "
+    b"8 14506 1 1 6 56712 3 4730 3 4751 3 4752 3 4799 } "
+    b"4 { 1 1 14506 51 36 14 3 9 123 2 275 0 00000000 0 24Htext/plain;charset=utf-8 "
+    b"2 15 14506 51 36 14 3 9 123 2 275 0 00000000 0 16Hjskom 0.14 pylys "
+    b"3 33 14506 51 36 14 3 9 123 2 275 0 00000000 0 9H127.0.0.1 "
+    b"4 35 14506 51 36 14 3 9 123 2 275 0 00000000 0 8Hexample }\n")
+
+COUNT = 20000
+REPEAT = 25
+
+
+class MemorySocket(object):
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._pos = 0
+
+    def recv_into(self, buffer, nbytes=0):
+        n = min(len(buffer), 64 * 1024, len(self._data) - self._pos)
+        buffer[:n] = self._data[self._pos:self._pos+n]
+        self._pos += n
+        return n
+
+    def recv(self, bufsize):
+        # For the ReceiveBuffer of older revisions
+        data = self._data[self._pos:self._pos+bufsize].tobytes()
+        self._pos += len(data)
+        return data
+
+
+def create_receive_buffer(modules, data):
+    return modules["connection"].ReceiveBuffer(MemorySocket(data))
+
+
+def create_aio_receive_buffer(modules, data):
+    buf = modules["aio"].AioReceiveBuffer()
+    buf.append(data)
+    return buf
+
+
+def parse(modules, buf, count):
+    parse_text_stat = modules["datatypes"].TextStat.parse
+    for i in range(count):
+        parse_text_stat(buf)
+
+
+def bench(modules, create_buffer, count):
+    buf = create_buffer(modules, TEXT_STAT_REPLY * count)
+    start = time.perf_counter()
+    parse(modules, buf, count)
+    return time.perf_counter() - start
+
+
+def count_calls(modules, create_buffer, count):
+    buf = create_buffer(modules, TEXT_STAT_REPLY * count)
+    profile = cProfile.Profile()
+    profile.runcall(parse, modules, buf, count)
+    return pstats.Stats(profile).total_calls
+
+
+def run(path, label, count, repeat):
+    sys.path.insert(0, path)
+    modules = dict((name, importlib.import_module("pylyskom." + name))
+                   for name in ("aio", "connection", "datatypes"))
+    calls = count_calls(modules, create_aio_receive_buffer, count)
+    print("%s: %.0f function calls per text-stat" % (label, calls / count))
+    for name, create_buffer in [("ReceiveBuffer", create_receive_buffer),
+                                ("AioReceiveBuffer", create_aio_receive_buffer)]:
+        best = min(bench(modules, create_buffer, count) for i in range(repeat))
+        print("%s: %-18s %d text-stats, best of %d: %.3f s (%.1f us/text-stat)" % (
+            label, name, count, repeat, best, best / count * 1e6))
+
+
+def run_revision(rev, count, repeat):
+    with tempfile.TemporaryDirectory() as path:
+        archive = subprocess.run(["git", "archive", rev, "pylyskom"], cwd=TOP_DIR,
+                                 stdout=subprocess.PIPE, check=True).stdout
+        subprocess.run(["tar", "-x", "-C", path], input=archive, check=True)
+        subprocess.run([sys.executable, __file__, "--path", path, "--label", rev,
+                        "--count", str(count), "--repeat", str(repeat)], check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing of text-stat replies.")
+    parser.add_argument("--count", type=int, default=COUNT,
+                        help="number of text-stats to parse per run")
+    parser.add_argument("--repeat", type=int, default=REPEAT,
+                        help="number of runs to take the best of")
+    parser.add_argument("--rev", help="git revision to benchmark before the working tree")
+    parser.add_argument("--path", default=TOP_DIR, help=argparse.SUPPRESS)
+    parser.add_argument("--label", default="working tree", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.rev is not None:
+        run_revision(args.rev, args.count, args.repeat)
+    run(args.path, args.label, args.count, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
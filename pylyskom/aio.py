@@ -4,27 +4,35 @@
 
 import asyncio
 import base64
+import copy
+from collections import OrderedDict, deque
 import errno
 import functools
+import inspect
 import json
 import logging
 import socket
+import time
 
 import six
 
 from .errors import (
     error_dict,
-    BadRequestId,
     ConferenceZero,
     ReceiveError,
+    RequestTimeout,
     BadInitialResponse,
     NotEnoughDataInBufferError,
     NotMember,
     NoSuchLocalText,
     ProtocolError,
+    ServerError,
     UndefinedConference,
     UnimplementedAsync)
 from .protocol import (
+    WHITESPACE,
+    BaseReceiveBuffer,
+    MessageScanner,
     to_hstring,
     read_first_non_ws,
     read_int)
@@ -72,63 +80,235 @@ log = logging.getLogger("pylyskom.aio")
 UNDEFINED_CONFERENCE_NAME = "Conference {conf_no} (does not exist)."
 UNDEFINED_PERSON_NAME = "Person {pers_no} (does not exist)."
 
+# Minimum number of bytes to ask for when reading from the stream.
+READ_SIZE = 64 * 1024
 
-class AioReceiveBuffer:
+# Number of received but unread bytes above which AioProtocolConnection
+# stops reading from the transport, until they are below
+# READ_LOW_WATER. (AioConnection gets the same from its StreamReader.)
+READ_HIGH_WATER = 4 * READ_SIZE
+READ_LOW_WATER = READ_SIZE
+
+# Number of queued outgoing bytes that makes AioConnection write them
+# at once, instead of at the end of the event loop iteration.
+WRITE_FLUSH_SIZE = 64 * 1024
+
+# Number of bytes in the transport's write buffer above which
+# AioConnection.send_request() waits for it to drain.
+WRITE_HIGH_WATER = 64 * 1024
+
+# Default maximum number of requests that AioClient has sent but not
+# received the reply to. Further requests wait until a reply arrives.
+MAX_IN_FLIGHT = 100
+
+# Priority classes for AioClient requests. Interactive requests are
+# sent before any waiting background requests.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Default share of AioClient's max_in_flight that background requests
+# may use.
+BACKGROUND_SHARE = 0.5
+
+# Default number of bytes to get per request when streaming a text.
+TEXT_CHUNK_SIZE = 64 * 1024
+
+# Default number of bytes to get for a text preview.
+TEXT_PREVIEW_SIZE = 1024
+
+# Maximum number of texts per local-to-global request.
+MAX_LOCAL_TO_GLOBAL = 255
+
+# Default maximum number of concurrent local-to-global requests when
+# getting the unread texts in a conference.
+LOCAL_TO_GLOBAL_WINDOW = 8
+
+# Default maximum number of concurrent requests when AioKomSession
+# fetches many objects at once.
+CONCURRENCY_LIMIT = 10
+
+# Default maximum number of texts in a conference to collect before
+# sending a mark-as-read request, when marks as read are batched.
+MARK_AS_READ_BATCH_SIZE = 100
+
+# Default number of seconds that AioCachingPersonClient caches the
+# read ranges of a membership. Texts marked as read by other sessions
+# (or clients) for the same person are not seen before that.
+READ_MEMBERSHIP_TTL = 60
+
+# Default maximum number of conferences that AioCachingClient keeps a
+# local to global index for. The least recently used is evicted.
+MAX_TEXT_INDEXES = 100
+
+
+async def gather_bounded(aws, limit=None):
+    """Like asyncio.gather(), but run at most {limit} of the
+    awaitables {aws} at a time. The results are in the order of aws.
+    If one of them raises, the others are cancelled (and waited for, so
+    that no exception is left unretrieved).
+    """
+    semaphore = asyncio.Semaphore(limit) if limit is not None else None
+
+    async def run(aw):
+        try:
+            if semaphore is None:
+                return await aw
+            async with semaphore:
+                return await aw
+        finally:
+            if asyncio.iscoroutine(aw):
+                # Avoid "never awaited" warnings when cancelled
+                # before it got its turn.
+                aw.close()
+
+    tasks = [ asyncio.ensure_future(run(aw)) for aw in aws ]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class AioReceiveBuffer(BaseReceiveBuffer):
     def __init__(self):
-        self._rb = b""    # Buffer for data received from connection
+        self._rb = bytearray() # Buffer for data received from connection
         self._rb_len = 0 # Length of the buffer
         self._rb_pos = 0 # Position of first unread byte in buffer
+        self._scanner = MessageScanner()
 
-    def copy(self):
-        c = AioReceiveBuffer()
-        c._rb = self._rb
-        c._rb_len = self._rb_len
-        c._rb_pos = self._rb_pos
-        return c
-
-    def current(self):
-        return self._rb[self._rb_pos:]
-
-    def length(self):
-        return self._rb_len
+    def _compact(self):
+        # Only compact when the consumed part dominates the buffer,
+        # so that appending stays linear in the amount of data.
+        if self._rb_pos > 0 and self._rb_pos >= self._rb_len - self._rb_pos:
+            del self._rb[:self._rb_pos]
+            self._rb_len -= self._rb_pos
+            self._rb_pos = 0
 
     def append(self, data):
-        self._rb = self._rb[self._rb_pos:] + data
-        self._rb_pos = 0
+        self._compact()
+        del self._rb[self._rb_len:]
+        self._rb += data
         self._rb_len = len(self._rb)
 
+    def get_buffer(self, size):
+        """Return a writable memoryview of at least size bytes of free
+        space at the end of the buffer, for receiving data directly
+        into it. Call buffer_updated() with the number of bytes
+        received, after the view has been released.
+        """
+        self._compact()
+        missing = self._rb_len + size - len(self._rb)
+        if missing > 0:
+            self._rb += bytes(missing)
+        return memoryview(self._rb)[self._rb_len:]
+
+    def buffer_updated(self, nbytes):
+        """Add nbytes received into the view from get_buffer() to the
+        data in the buffer."""
+        assert self._rb_len + nbytes <= len(self._rb)
+        self._rb_len += nbytes
+
+    def find_message_end(self):
+        """Return the position just after the end of the first complete
+        message in the buffer, or None if we have not received all of
+        it yet. Leading whitespace before the message is consumed.
+        """
+        if self._scanner.at_start():
+            while self._rb_pos < self._rb_len and self._rb[self._rb_pos] in WHITESPACE:
+                self._rb_pos += 1
+            if self._rb_pos == self._rb_len:
+                return None
+        offset = self._scanner.scan(self._rb, self._rb_pos, self._rb_len)
+        if offset is None:
+            return None
+        return self._rb_pos + offset
+
+    def buffered(self):
+        """Number of received bytes that have not been consumed."""
+        return self._rb_len - self._rb_pos
+
+    def hollerith_left(self):
+        """Number of bytes still missing of the Hollerith string that is
+        currently being received."""
+        return self._scanner.hollerith_left()
+
+    def skip_to(self, pos):
+        """Consume everything in the buffer before pos."""
+        assert self._rb_pos <= pos <= self._rb_len
+        self._rb_pos = pos
+
+    def take(self, start, stop):
+        """Return the bytes between start and stop as a read-only
+        memoryview and consume everything up to the current position.
+
+        When the data is at least half of the storage (including the
+        free space for receiving into), the storage is handed over to
+        the view without copying, and the buffer keeps a copy of just
+        the data after it. Otherwise the (smaller) data is copied, so
+        that a small reply does not keep a large buffer alive.
+        """
+        assert start <= stop <= self._rb_pos
+        rb = self._rb
+        if stop - start >= len(rb) - (stop - start):
+            self._rb = rb[self._rb_pos:self._rb_len]
+            self._rb_len = len(self._rb)
+            self._rb_pos = 0
+            return memoryview(rb)[start:stop].toreadonly()
+        return memoryview(bytes(rb[start:stop]))
+
     def receive_string(self, length):
-        """Get a string from the receive buffer (receiving more if
-        necessary).
+        """Get a string from the receive buffer. Raises
+        NotEnoughDataInBufferError if it isn't all in the buffer.
         """
         present = self._rb_len - self._rb_pos
         if present < length:
             raise NotEnoughDataInBufferError()
-        res = self._rb[self._rb_pos:self._rb_pos+length]
+        with memoryview(self._rb) as mv:
+            res = mv[self._rb_pos:self._rb_pos+length].tobytes()
         self._rb_pos = self._rb_pos + length
         return res
 
-    def receive_char(self):
-        """Get a character from the receive buffer (receiving more if
-        necessary).
+    def receive_byte(self):
+        """Get a character as an int from the receive buffer. Raises
+        NotEnoughDataInBufferError if the buffer is empty.
         """
-        return self.receive_string(1)
+        if self._rb_pos >= self._rb_len:
+            raise NotEnoughDataInBufferError()
+        res = self._rb[self._rb_pos]
+        self._rb_pos = self._rb_pos + 1
+        return res
+
+    def _receive_more(self):
+        raise NotEnoughDataInBufferError()
 
 
 class AioConnection:
     """
     Not safe to use concurrently from different tasks.
+
+    Requests are queued and written together once per event loop
+    iteration (or when WRITE_FLUSH_SIZE bytes are queued), so a burst
+    of requests becomes a single write.
     """
 
     def __init__(self):
         self._tcp_stream_writer = None
         self._tcp_stream_reader = None
+        self._flush_handle = None
         self._reset_vars()
 
     def _reset_vars(self):
         self._ref_no = 0 # Last used ID (i.e. increment before use)
         self._outstanding_requests = {} # Ref-No to Request mapping
+        self._raw_requests = set() # Ref-Nos of requests sent as bytes
         self._buffer = AioReceiveBuffer()
+        self._write_queue = [] # Requests (bytes) not written yet
+        self._write_queue_size = 0
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
 
     async def connect(self, host, port, user=None):
         """
@@ -139,25 +319,31 @@ class AioConnection:
             user = ""
         assert isinstance(user, str) # Do we want user to be str or bytes?
         log.debug("AioConnection: Connecting to %s:%s", host, port)
-        self._tcp_stream_reader, self._tcp_stream_writer = await asyncio.open_connection(host, port)
-        self._reset_vars()
+        await self._open_connection(host, port)
 
         # Send initial string
         await self._send_initial_string(user)
         await self._receive_initial_reply()
         log.debug("AioConnection: Connected to %s:%s", host, port)
 
+    async def _open_connection(self, host, port):
+        self._tcp_stream_reader, self._tcp_stream_writer = await asyncio.open_connection(host, port)
+        self._reset_vars()
+
     async def _send_initial_string(self, user):
-        self._tcp_stream_writer.write(b"A%s\n" % (to_hstring(user.encode('latin1')),))
-        await self._tcp_stream_writer.drain()
+        self._write(b"A%s\n" % (to_hstring(user.encode('latin1')),))
+        await self._drain()
         log.debug("AioConnection: Sent initial string")
 
     async def _receive_initial_reply(self):
         # Wait for answer "LysKOM\n"
         size = 7
-        data = await self._tcp_stream_reader.readexactly(size)
-        self._buffer.append(data)
-        resp = self._buffer.receive_string(size)
+        while True:
+            try:
+                resp = self._buffer.receive_string(size)
+                break
+            except NotEnoughDataInBufferError:
+                await self._receive_data()
         if resp != b"LysKOM\n":
             raise BadInitialResponse()
         log.debug("AioConnection: Received initial reply")
@@ -168,6 +354,7 @@ class AioConnection:
     async def close(self):
         try:
             if self._tcp_stream_writer is not None:
+                self._flush_writes()
                 self._tcp_stream_writer.close()
                 await self._tcp_stream_writer.wait_closed()
         finally:
@@ -175,9 +362,23 @@ class AioConnection:
             self._tcp_stream_writer = None
             self._buffer = None
             self._outstanding_requests = None
-            self._buffer = None
+            self._raw_requests = None
 
     async def send_request(self, request):
+        """Queue a request for sending, and wait for the write buffer
+        to drain if needed. Returns the ref-no of the request."""
+        ref_no = self.queue_request(request)
+        await self.drain_if_needed()
+        return ref_no
+
+    def queue_request(self, request):
+        """Queue a request for sending, without waiting. Returns the
+        ref-no of the request.
+
+        The request can be written (and answered) before
+        drain_if_needed() returns, so anything needed to handle the
+        reply must be set up before that is awaited.
+        """
         #log.debug("AioConnection: Sending request: %s", request)
         self._ref_no += 1
         ref_no = self._ref_no
@@ -186,122 +387,566 @@ class AioConnection:
             log.debug("AioConnection: send_request - bytes: %r", request)
             request_string = b"%d %b\n" % (ref_no, request)
             call_no = int(request.split(b' ')[0])
+            self._raw_requests.add(ref_no)
         else:
             request_string = b"%d %s" % (ref_no, request.to_string())
             call_no = request.CALL_NO
         self._outstanding_requests[ref_no] = call_no
-        self._tcp_stream_writer.write(request_string)
-        await self._tcp_stream_writer.drain()
+        self._queue_write(request_string)
         return ref_no
 
+    async def drain_if_needed(self):
+        """Wait for the write buffer to drain, if it is above
+        WRITE_HIGH_WATER."""
+        if self._get_write_buffer_size() > WRITE_HIGH_WATER:
+            await self._drain()
+            stats.set('connections.drains.last', 1, agg='sum')
+
+    def _queue_write(self, data):
+        self._write_queue.append(data)
+        self._write_queue_size += len(data)
+        if self._write_queue_size >= WRITE_FLUSH_SIZE:
+            self._flush_writes()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_soon(self._flush_writes)
+
+    def _flush_writes(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._write_queue or not self.is_connected():
+            return
+        data = b"".join(self._write_queue)
+        self._write_queue = []
+        self._write_queue_size = 0
+        self._write(data)
+        stats.set('connections.writes.last', 1, agg='sum')
+
+    def _write(self, data):
+        self._tcp_stream_writer.write(data)
+
+    def _get_write_buffer_size(self):
+        return self._tcp_stream_writer.transport.get_write_buffer_size()
+
+    async def _drain(self):
+        await self._tcp_stream_writer.drain()
+
+    async def _receive_data(self):
+        """Wait for more data and add it to the receive buffer. Raises
+        ReceiveError at the end of the stream."""
+        read_size = max(READ_SIZE, self._buffer.hollerith_left())
+        data = await self._tcp_stream_reader.read(read_size)
+        stats.set('connections.reads.last', 1, agg='sum')
+        #log.debug("AioConnection: Received data: %r", data)
+        if len(data) == 0:
+            raise ReceiveError("End of stream")
+        self._buffer.append(data)
+
     async def read_response(self):
         #log.debug("AioConnection: Reading response")
         response = await self._read_response()
         # A response is a 5-tuple: (ref_no, ok_reply, error_reply, async_msg, reply_bytes)
+        # Replies to requests sent as bytes are not parsed. They only
+        # have reply_bytes, as a memoryview that shares the memory of
+        # the receive buffer. For all other responses reply_bytes is
+        # None, so that the received data is never copied for them.
         #log.debug("AioConnection: read_response - response: %s", response)
-        log.debug("AioConnection: read_response - bytes: %r", response[4])
         return response
 
     async def _read_response(self):
-        response = None
-        # Loop until we have a response
-        while response is None:
-            # Try to parse a response first, in case there already is
-            # unparsed data in the buffer
-            response = self._try_parse_response()
-            if response is None:
-                data = await self._tcp_stream_reader.read(1024)
-                #log.debug("AioConnection: Received data: %r", data)
-                if len(data) == 0:
-                    raise ReceiveError("End of stream")
-                self._buffer.append(data)
-        return response
-
-    def _try_parse_response(self):
-        # Trying to parse a response will consume from the buffer, and
-        # to be able to try again we need to keep all of the buffer
-        # until we can parse a response. Therefor we keep a copy and
-        # restore the copy if we fail to parse something from the
-        # buffer.
-        buffer_copy = self._buffer.copy()
-        try:
-            return self._parse_response()
-        except NotEnoughDataInBufferError:
-            pass
-        # Continue reading data from stream
-        # Restore buffer
-        self._buffer = buffer_copy
-        return None
-
-    def _parse_response(self):
+        # Read until there is a complete message in the buffer, and
+        # only then parse it. The framing scan keeps its state between
+        # reads, so a large message is not re-parsed from the start
+        # every time more data arrives.
+        end = self._buffer.find_message_end()
+        while end is None:
+            await self._receive_data()
+            end = self._buffer.find_message_end()
+        return self._parse_response(end)
+
+    def _parse_response(self, end):
         ref_no = None
         ok_reply = None
         error_reply = None
         async_msg = None
         ch = read_first_non_ws(self._buffer)
+        if ch in b"=%":
+            ref_no = read_int(self._buffer)
+            if ref_no not in self._outstanding_requests:
+                # We don't know how to parse the reply, so skip all
+                # of it. The reply (without a result) is passed on
+                # for the client to ignore.
+                stats.set('connections.responses.received.unknown.last', 1, agg='sum')
+                self._buffer.skip_to(end)
+                return ref_no, None, None, None, None
+            if ref_no in self._raw_requests:
+                return self._take_raw_reply(ch, ref_no, end)
         if ch == b"=":
-            ref_no, ok_reply, reply_bytes = self._parse_ok_reply()
+            ok_reply = self._parse_ok_reply(ref_no)
             stats.set('connections.responses.received.ok.last', 1, agg='sum')
         elif ch == b"%":
-            ref_no, error_reply, reply_bytes = self._parse_error_reply()
+            error_reply = self._parse_error_reply(ref_no)
             stats.set('connections.responses.received.error.last', 1, agg='sum')
         elif ch == b":":
-            async_msg, reply_bytes = self._parse_asynchronous_message()
+            async_msg = self._parse_asynchronous_message()
             stats.set('connections.responses.received.async.last', 1, agg='sum')
         else:
             stats.set('connections.responses.received.protocolerror.last', 1, agg='sum')
             raise ProtocolError("Got unexpected: %s" % (ch,))
 
-        reply_bytes = reply_bytes[:-1] # skip trailing newline
-        return ref_no, ok_reply, error_reply, async_msg, reply_bytes
+        self._buffer.skip_to(end)
+        return ref_no, ok_reply, error_reply, async_msg, None
+
+    def _take_raw_reply(self, ch, ref_no, end):
+        # Replies to raw requests are passed through as they are, so
+        # only the ref-no is read. The framing scan has already found
+        # where the reply ends.
+        if ch == b"=":
+            stats.set('connections.responses.received.ok.last', 1, agg='sum')
+        else:
+            stats.set('connections.responses.received.error.last', 1, agg='sum')
+        reply_start = min(self._buffer._rb_pos, end-1)
+        self._buffer.skip_to(end)
+        reply_bytes = self._buffer.take(reply_start, end-1) # skip trailing newline
+        self._raw_requests.remove(ref_no)
+        del self._outstanding_requests[ref_no]
+        return ref_no, None, None, None, reply_bytes
 
-    def _parse_ok_reply(self):
-        ref_no = read_int(self._buffer)
-        if ref_no not in self._outstanding_requests:
-            raise BadRequestId(ref_no)
-        buf_start = self._buffer._rb_pos
+    def _parse_ok_reply(self, ref_no):
         call_no = self._outstanding_requests[ref_no]
         ok_reply = requests.response_dict[call_no].parse(self._buffer)
-        reply_bytes = self._buffer._rb[buf_start:self._buffer._rb_pos]
         del self._outstanding_requests[ref_no]
-        return ref_no, ok_reply, reply_bytes
+        return ok_reply
 
-    def _parse_error_reply(self):
-        ref_no = read_int(self._buffer)
-        if ref_no not in self._outstanding_requests:
-            raise BadRequestId(ref_no)
-        buf_start = self._buffer._rb_pos
+    def _parse_error_reply(self, ref_no):
         error_no = read_int(self._buffer)
         error_status = read_int(self._buffer)
         error_reply = error_dict[error_no](error_status)
-        reply_bytes = self._buffer._rb[buf_start:self._buffer._rb_pos]
         del self._outstanding_requests[ref_no]
-        return ref_no, error_reply, reply_bytes
+        return error_reply
 
     def _parse_asynchronous_message(self):
-        buf_start = self._buffer._rb_pos
         read_int(self._buffer) # read number of arguments (but we don't need it)
         msg_no = read_int(self._buffer)
         if msg_no not in async_dict:
             raise UnimplementedAsync(msg_no)
         msg = async_dict[msg_no].parse(self._buffer)
-        reply_bytes = self._buffer._rb[buf_start:self._buffer._rb_pos]
-        return msg, reply_bytes
+        return msg
+
+
+class _AioReceiveProtocol(asyncio.BufferedProtocol):
+    """Protocol for AioProtocolConnection, that lets the transport
+    receive data directly into an AioReceiveBuffer.
+
+    Reading is paused when more than READ_HIGH_WATER bytes are
+    waiting in the buffer, and resumed (by resume_reading_if_drained())
+    when they are down to READ_LOW_WATER, or when more data is needed
+    to complete a message.
+    """
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._transport = None
+        self._eof = False
+        self._exception = None
+        self._data_waiter = None
+        self._reading_paused = False
+        self._writing_paused = False
+        self._drain_waiters = []
+        self._closed = asyncio.get_event_loop().create_future()
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def get_buffer(self, sizehint):
+        # Make room for the rest of a large Hollerith string at once,
+        # instead of growing the buffer READ_SIZE bytes at a time.
+        stats.set('connections.reads.last', 1, agg='sum')
+        return self._buffer.get_buffer(max(READ_SIZE, self._buffer.hollerith_left()))
+
+    def buffer_updated(self, nbytes):
+        self._buffer.buffer_updated(nbytes)
+        if self._data_waiter is not None:
+            self._wake_data_waiter()
+        elif not self._reading_paused and self._buffer.buffered() > READ_HIGH_WATER:
+            # Nobody is reading the replies as fast as they arrive
+            self._transport.pause_reading()
+            self._reading_paused = True
+            stats.set('connections.reads.paused.last', 1, agg='sum')
+
+    def resume_reading_if_drained(self):
+        if self._reading_paused and self._buffer.buffered() <= READ_LOW_WATER:
+            self._resume_reading()
+
+    def _resume_reading(self):
+        self._reading_paused = False
+        if not self._eof:
+            self._transport.resume_reading()
+
+    def eof_received(self):
+        self._eof = True
+        self._wake_data_waiter()
+
+    def connection_lost(self, exc):
+        self._eof = True
+        self._exception = exc
+        self._wake_data_waiter()
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(ConnectionResetError("Connection lost"))
+        self._drain_waiters = []
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._drain_waiters = []
+
+    def _wake_data_waiter(self):
+        if self._data_waiter is not None and not self._data_waiter.done():
+            self._data_waiter.set_result(None)
+
+    async def wait_for_data(self):
+        """Wait until more data has been received into the buffer.
+        Raises ReceiveError at the end of the stream."""
+        if self._eof:
+            raise ReceiveError("End of stream") from self._exception
+        assert self._data_waiter is None, "Already waiting for data"
+        if self._reading_paused:
+            # The buffered data is not enough for the next message
+            self._resume_reading()
+        self._data_waiter = asyncio.get_event_loop().create_future()
+        try:
+            await self._data_waiter
+        finally:
+            self._data_waiter = None
+
+    async def drain(self):
+        if self._eof and self._exception is not None:
+            raise ConnectionResetError("Connection lost")
+        if not self._writing_paused:
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+    async def wait_closed(self):
+        await self._closed
+
+
+class AioProtocolConnection(AioConnection):
+    """AioConnection on an asyncio.BufferedProtocol instead of streams.
+
+    The transport receives data directly into the receive buffer, and
+    the buffer is grown to fit the rest of the Hollerith string being
+    received, so a large reply is neither copied from a stream buffer
+    nor received READ_SIZE bytes at a time.
+    """
+
+    def __init__(self):
+        self._transport = None
+        self._protocol = None
+        super().__init__()
+
+    async def _open_connection(self, host, port):
+        self._reset_vars()
+        loop = asyncio.get_event_loop()
+        buffer = self._buffer
+        self._transport, self._protocol = await loop.create_connection(
+            lambda: _AioReceiveProtocol(buffer), host, port)
+
+    def is_connected(self):
+        return self._transport is not None
+
+    async def close(self):
+        try:
+            if self._transport is not None:
+                self._flush_writes()
+                self._transport.close()
+                await self._protocol.wait_closed()
+        finally:
+            self._transport = None
+            self._protocol = None
+            self._buffer = None
+            self._outstanding_requests = None
+            self._raw_requests = None
+
+    def _write(self, data):
+        self._transport.write(data)
+
+    def _get_write_buffer_size(self):
+        return self._transport.get_write_buffer_size()
+
+    async def _drain(self):
+        await self._protocol.drain()
+
+    async def read_response(self):
+        response = await AioConnection.read_response(self)
+        self._protocol.resume_reading_if_drained()
+        return response
+
+    async def _receive_data(self):
+        await self._protocol.wait_for_data()
+
+
+class RequestWindow:
+    """Limits the number of requests in flight, with priority classes.
+
+    Waiting interactive requests always get a free slot before waiting
+    background requests, and background requests never use more than
+    max_background of the slots, so that there are always slots left
+    for interactive requests (unless max_in_flight is 1).
+    """
+
+    def __init__(self, max_in_flight, max_background):
+        assert 1 <= max_background <= max_in_flight
+        self._max_in_flight = max_in_flight
+        self._max_background = max_background
+        self._in_flight = 0
+        self._background_in_flight = 0
+        self._waiters = { PRIORITY_INTERACTIVE: deque(),
+                          PRIORITY_BACKGROUND: deque() }
+
+    def _can_start(self, priority):
+        if self._in_flight >= self._max_in_flight:
+            return False
+        if priority == PRIORITY_INTERACTIVE:
+            return True
+        return (not self._waiters[PRIORITY_INTERACTIVE] and
+                self._background_in_flight < self._max_background)
+
+    def _start(self, priority):
+        self._in_flight += 1
+        if priority == PRIORITY_BACKGROUND:
+            self._background_in_flight += 1
+
+    def _wake_waiters(self):
+        for priority in (PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND):
+            waiters = self._waiters[priority]
+            while waiters and self._can_start(priority):
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    self._start(priority)
+                    waiter.set_result(None)
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE):
+        """Wait for a slot for a request of the given priority."""
+        if priority not in self._waiters:
+            raise ValueError("Unknown priority: %r" % (priority,))
+        waiters = self._waiters[priority]
+        if not waiters and self._can_start(priority):
+            self._start(priority)
+            return
+        if priority == PRIORITY_BACKGROUND:
+            stats.set('clients.requests.window.background.waits.last', 1, agg='sum')
+        else:
+            stats.set('clients.requests.window.waits.last', 1, agg='sum')
+        waiter = asyncio.get_event_loop().create_future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Got the slot just before being cancelled
+                self.release(priority)
+            raise
+        finally:
+            if waiter in waiters:
+                waiters.remove(waiter)
+
+    def release(self, priority=PRIORITY_INTERACTIVE):
+        """Give back the slot of a request that got its reply."""
+        self._in_flight -= 1
+        if priority == PRIORITY_BACKGROUND:
+            self._background_in_flight -= 1
+        self._wake_waiters()
+
+
+class RateLimiter:
+    """Token bucket that limits the rate of requests.
+
+    The bucket holds at most burst tokens and is refilled with rate
+    tokens per second. Each request takes tokens from it according to
+    its cost, which is configured per request class with costs (a dict
+    from request class to number of tokens, 1 for other requests). A
+    request that would take more tokens than there are waits until
+    there are enough. Like RequestWindow, waiting interactive requests
+    are let through before waiting background requests.
+    """
+
+    def __init__(self, rate, burst=None, costs=None):
+        """
+        @param rate: Number of tokens added per second.
+        @param burst: Maximum number of tokens in the bucket (default
+        rate), i.e. how many cheap requests can be sent at once.
+        @param costs: Dict from request class to number of tokens for
+        a request of that class, for example
+        { requests.ReqLocalToGlobal: 5, requests.ReqGetMembership11: 10 }.
+        """
+        assert rate > 0
+        self._rate = rate
+        self._burst = max(1, burst if burst is not None else rate)
+        self._costs = {} # Call no to cost
+        if costs is not None:
+            self._costs = { request_class.CALL_NO: cost for request_class, cost in costs.items() }
+        self._tokens = self._burst
+        self._updated = None
+        self._waiters = { PRIORITY_INTERACTIVE: deque(),
+                          PRIORITY_BACKGROUND: deque() }
+        self._wake_handle = None
+
+    def get_cost(self, request):
+        """Number of tokens for request (a Request, or bytes for a raw
+        request). Never more than the bucket holds."""
+        if isinstance(request, bytes):
+            call_no = int(request.split(b' ')[0])
+        else:
+            call_no = request.CALL_NO
+        return min(self._costs.get(call_no, 1), self._burst)
+
+    def _refill(self):
+        now = asyncio.get_event_loop().time()
+        if self._updated is not None:
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def _take(self, cost):
+        if self._tokens < cost:
+            return False
+        self._tokens -= cost
+        return True
+
+    def _wake_waiters(self):
+        self._wake_handle = None
+        self._refill()
+        for priority in (PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND):
+            waiters = self._waiters[priority]
+            while waiters:
+                cost, waiter = waiters[0]
+                if waiter.done():
+                    waiters.popleft()
+                elif self._take(cost):
+                    waiters.popleft()
+                    waiter.set_result(None)
+                else:
+                    # Wake up again when there are enough tokens for the
+                    # first waiter, and don't let anyone pass it.
+                    delay = (cost - self._tokens) / self._rate
+                    self._wake_handle = asyncio.get_event_loop().call_later(
+                        delay, self._wake_waiters)
+                    return
+
+    async def acquire(self, cost, priority=PRIORITY_INTERACTIVE):
+        """Wait until cost tokens can be taken from the bucket."""
+        if priority not in self._waiters:
+            raise ValueError("Unknown priority: %r" % (priority,))
+        self._refill()
+        ahead = self._waiters[PRIORITY_INTERACTIVE]
+        if priority == PRIORITY_BACKGROUND and not ahead:
+            ahead = self._waiters[PRIORITY_BACKGROUND]
+        if not ahead and self._take(cost):
+            return
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        self._waiters[priority].append((cost, waiter))
+        if self._wake_handle is not None:
+            self._wake_handle.cancel()
+        self._wake_waiters()
+        start = loop.time()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Got the tokens just before being cancelled
+                self._tokens = min(self._burst, self._tokens + cost)
+            # Let the ones after it pass if they can
+            if self._wake_handle is not None:
+                self._wake_handle.cancel()
+            self._wake_waiters()
+            raise
+        finally:
+            stats.set('clients.ratelimit.waits.last', 1, agg='sum')
+            stats.set('clients.ratelimit.wait_time.last', loop.time() - start, agg='sum')
+
+
+# Rate limiters shared by all AioClients in the process, by (host, port)
+_shared_rate_limiters = {} # (host, port) to (RateLimiter, kwargs)
+
+
+def get_shared_rate_limiter(host, port, **kwargs):
+    """Return the process-wide RateLimiter for host and port. It is
+    created with kwargs the first time. Later calls must give the same
+    kwargs (or none), otherwise ValueError is raised."""
+    shared = _shared_rate_limiters.get((host, port))
+    if shared is None:
+        rate_limiter = RateLimiter(**kwargs)
+        _shared_rate_limiters[(host, port)] = (rate_limiter, kwargs)
+        return rate_limiter
+    rate_limiter, shared_kwargs = shared
+    if kwargs and kwargs != shared_kwargs:
+        raise ValueError("Rate limit for %s:%s is already %r, not %r" % (
+            host, port, shared_kwargs, kwargs))
+    return rate_limiter
 
 
 class AioClient:
     """Safe to use concurrently from different tasks.
     """
-    def __init__(self, conn):
+    def __init__(self, conn, max_in_flight=MAX_IN_FLIGHT, timeout=None,
+                 background_share=BACKGROUND_SHARE, rate_limit=None, shared_rate_limit=False):
+        """
+        @param max_in_flight: Maximum number of requests waiting for
+        their replies, or None for no limit. A request that would
+        exceed it waits until another request has got its reply.
+        Waiting interactive requests are sent before waiting
+        background requests.
+        @param timeout: Default number of seconds to wait for a reply
+        before raising RequestTimeout, or None to wait forever.
+        @param background_share: Share of max_in_flight that
+        background requests (priority PRIORITY_BACKGROUND) may use,
+        so that interactive requests do not queue behind them.
+        @param rate_limit: Dict of keyword arguments (rate, burst and
+        costs) for a RateLimiter that limits the rate of requests, or
+        None for no limit.
+        @param shared_rate_limit: If True, the rate limiter is shared
+        with all clients in the process that are connected to the same
+        host and port (see get_shared_rate_limiter()).
+        """
         self._conn = conn
         self._async_handler_func = None
         self._send_lock = asyncio.Lock()
+        self._max_in_flight = max_in_flight
+        self._background_share = background_share
+        self._timeout = timeout
+        self._rate_limit = rate_limit
+        self._shared_rate_limit = shared_rate_limit
+        self._rate_limiter = None
+        if rate_limit is not None and not shared_rate_limit:
+            self._rate_limiter = RateLimiter(**rate_limit)
         self._reset_vars()
 
     def _reset_vars(self):
-        # Dict with ref-no to tuple(ok, error), where error is None if it's a ok reply (ok reply can be None)
-        self._reply_queue = {}
-        self._outstanding_requests_events = {} # Ref-No to asyncio.Event mapping
+        # Ref-No to the future for the reply, a tuple (ok_reply,
+        # error_reply, reply_bytes) where error_reply is None for an
+        # ok reply (and ok_reply can be None).
+        self._reply_futures = {}
+        # Ref-Nos of requests that nobody waits for anymore (timed out
+        # or cancelled). Their replies are thrown away.
+        self._abandoned_ref_nos = set()
+        # The exception that stopped the response receiver, if any
+        self._receiver_error = None
+        self._in_flight = None
+        if self._max_in_flight is not None:
+            # Leave at least one slot for interactive requests
+            max_background = max(1, min(int(self._max_in_flight * self._background_share),
+                                        self._max_in_flight - 1))
+            self._in_flight = RequestWindow(self._max_in_flight, max_background)
         self._asyncmsg_queue = asyncio.Queue()
         self._send_request_queue = asyncio.Queue()
         self._response_receiver_task = None
@@ -309,6 +954,10 @@ class AioClient:
 
     async def connect(self, host, port, user=None):
         assert not self.is_connected()
+        if self._rate_limit is not None and self._shared_rate_limit:
+            # Before connecting, so that conflicting settings do not
+            # leave a connection behind.
+            self._rate_limiter = get_shared_rate_limiter(host, port, **self._rate_limit)
         log.debug("AioClient: Connecting to %s:%s", host, port)
         await self._conn.connect(host, port, user=user)
         log.debug("AioClient: Connected to %s:%s", host, port)
@@ -329,6 +978,7 @@ class AioClient:
                 self._response_receiver_task.cancel()
             if self._asyncmsg_receiver_task is not None:
                 self._asyncmsg_receiver_task.cancel()
+            self._fail_outstanding_requests(ReceiveError("Connection closed"))
             await asyncio.sleep(0)
             if self._conn is not None:
                 await self._conn.close()
@@ -350,28 +1000,80 @@ class AioClient:
         """
         self._async_handler_func = handler_func
 
-    async def request(self, request):
-        return await self._request(request, return_bytes=False)
+    async def request(self, request, timeout=None, priority=PRIORITY_INTERACTIVE):
+        """Send a request and return the reply.
 
-    async def raw_request(self, request_bytes):
-        return await self._request(request_bytes, return_bytes=True)
+        @param timeout: Number of seconds to wait for the reply before
+        raising RequestTimeout. If None, the client's default timeout
+        is used.
+        @param priority: PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND
+        (for prefetching and bulk work).
+        """
+        return await self._request(request, return_bytes=False, timeout=timeout,
+                                   priority=priority)
+
+    async def raw_request(self, request_bytes, timeout=None, priority=PRIORITY_INTERACTIVE):
+        return await self._request(request_bytes, return_bytes=True, timeout=timeout,
+                                   priority=priority)
+
+    async def _request(self, request, *, return_bytes=False, timeout=None,
+                       priority=PRIORITY_INTERACTIVE):
+        if timeout is None:
+            timeout = self._timeout
+        if self._rate_limiter is not None:
+            await self._rate_limiter.acquire(self._rate_limiter.get_cost(request), priority)
+        if self._in_flight is None:
+            return await self._send_and_wait(request, return_bytes, timeout)
+        await self._in_flight.acquire(priority)
+        try:
+            return await self._send_and_wait(request, return_bytes, timeout)
+        finally:
+            self._in_flight.release(priority)
 
-    async def _request(self, request, *, return_bytes=False):
+    async def _send_and_wait(self, request, return_bytes, timeout):
         async with self._send_lock:
-            ref_no = await self._conn.send_request(request)
+            if self._receiver_error is not None:
+                raise ReceiveError(
+                    "Response receiver has failed: %s" % (self._receiver_error,))
+            # The future must be registered before anything is
+            # awaited, because the reply can arrive while waiting for
+            # the write buffer to drain.
+            ref_no = self._conn.queue_request(request)
             #log.debug("AioClient: Sent request (ref_no=%s): %s", ref_no, request)
-            assert ref_no not in self._outstanding_requests_events
-            self._outstanding_requests_events[ref_no] = asyncio.Event()
+            assert ref_no not in self._reply_futures
+            future = asyncio.get_event_loop().create_future()
+            self._reply_futures[ref_no] = future
+            try:
+                await self._conn.drain_if_needed()
+            except BaseException:
+                self._abandon(ref_no)
+                raise
 
         #log.debug("AioClient: Waiting for reply to ref_no=%s", ref_no)
-        await self._outstanding_requests_events[ref_no].wait()
-        del self._outstanding_requests_events[ref_no]
-        return self._handle_reply(ref_no, return_bytes=return_bytes)
-
-    def _handle_reply(self, ref_no, *, return_bytes=False):
-        assert ref_no in self._reply_queue
-        (ok_reply, error_reply, reply_bytes) = self._reply_queue.pop(ref_no)
-        #log.debug("AioClient: Handling reply (ref_no=%s): %s", ref_no, (ok_reply, error_reply))
+        try:
+            if timeout is None:
+                reply = await future
+            else:
+                reply = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._abandon(ref_no)
+            stats.set('clients.requests.timeouts.last', 1, agg='sum')
+            raise RequestTimeout(ref_no)
+        except asyncio.CancelledError:
+            self._abandon(ref_no)
+            stats.set('clients.requests.cancellations.last', 1, agg='sum')
+            raise
+        return self._handle_reply(reply, return_bytes=return_bytes)
+
+    def _abandon(self, ref_no):
+        # The reply will still arrive, and must be recognized and
+        # thrown away by the response receiver.
+        if self._reply_futures.pop(ref_no, None) is not None:
+            self._abandoned_ref_nos.add(ref_no)
+
+    def _handle_reply(self, reply, *, return_bytes=False):
+        (ok_reply, error_reply, reply_bytes) = reply
+        #log.debug("AioClient: Handling reply: %s", (ok_reply, error_reply))
         if return_bytes:
             return reply_bytes
         if error_reply is not None:
@@ -390,19 +1092,41 @@ class AioClient:
                 await self._receive_response(response)
         except Exception as e:
             log.error(f"AioClient: Response receiver task exception: {e}")
+            self._fail_outstanding_requests(e)
         finally:
             log.debug("AioClient: Exiting response receiver task")
 
+    def _fail_outstanding_requests(self, error):
+        # No more replies will be received, so fail all the waiting
+        # requests (and the ones sent later) instead of letting them
+        # wait forever.
+        self._receiver_error = error
+        reply_futures = self._reply_futures
+        self._reply_futures = {}
+        for future in reply_futures.values():
+            if not future.done():
+                receive_error = ReceiveError("Response receiver has failed: %s" % (error,))
+                receive_error.__cause__ = error
+                future.set_exception(receive_error)
+
     async def _receive_response(self, response):
         ref_no, ok_reply, error_reply, async_msg, reply_bytes = response
         if ref_no is None:
             # async message
             await self._asyncmsg_queue.put(async_msg)
+        elif ref_no in self._abandoned_ref_nos:
+            # Nobody waits for this reply anymore
+            self._abandoned_ref_nos.remove(ref_no)
+            stats.set('clients.replies.discarded.last', 1, agg='sum')
         else:
-            # ok or error reply go on reply queue
-            self._reply_queue[ref_no] = (ok_reply, error_reply, reply_bytes)
-            assert ref_no in self._outstanding_requests_events
-            self._outstanding_requests_events[ref_no].set()
+            # ok or error reply, to the task waiting for it
+            future = self._reply_futures.pop(ref_no, None)
+            if future is None:
+                # Not something to take down the whole client for
+                log.warning("AioClient: Reply to unknown ref_no=%s", ref_no)
+                stats.set('clients.replies.unknown.last', 1, agg='sum')
+            elif not future.done():
+                future.set_result((ok_reply, error_reply, reply_bytes))
 
     async def _run_asyncmsg_receiver(self):
         log.debug("AioClient: Starting asyncmsg receiver task")
@@ -437,7 +1161,8 @@ class AioClient:
 #   - Person
 #   - TextStat
 #   - Subjects
-#   No negative caching. No time-outs.
+#   Optional size limit (least recently used entries are evicted),
+#   time-outs and negative caching, per cache (see cache_options).
 #   Some automatic invalidation (if accept-async called appropriately).
 #
 # * Lookup function (conference/person name -> numbers)
@@ -445,8 +1170,20 @@ class AioClient:
 #   numbers of all unread text in a conference for a person
 
 class AioCachingClient:
-    def __init__(self, client):
+    def __init__(self, client, cache_options=None):
+        """
+        @param cache_options: Dict from cache name ("UConference",
+        "Conference", "Person", "TextStat", "Membership" or
+        "ReadMembership") to a dict of keyword arguments for that
+        AioCache, such as max_size and ttl. "ReadMembership" is the
+        current person's memberships with read ranges (in
+        AioCachingPersonClient), with ttl READ_MEMBERSHIP_TTL by
+        default. "TextIndex" only takes max_size, the maximum number of
+        conferences to keep local to global indexes for (default
+        MAX_TEXT_INDEXES).
+        """
         self._client = client
+        self._cache_options = cache_options if cache_options is not None else {}
 
         # Caches
         #
@@ -460,10 +1197,17 @@ class AioCachingClient:
         # could be dangerous. Sometime it is okay with cached
         # responses, and sometimes it is not. How can we make it
         # possible to force no cached?
-        self.uconferences = AioCache(self._fetch_uconference, "UConference")
-        self.conferences = AioCache(self._fetch_conference, "Conference")
-        self.persons = AioCache(self._fetch_person, "Person")
-        self.textstats = AioCache(self._fetch_textstat, "TextStat")
+        self.uconferences = self._create_cache(self._fetch_uconference, "UConference")
+        self.conferences = self._create_cache(self._fetch_conference, "Conference")
+        self.persons = self._create_cache(self._fetch_person, "Person")
+        self.textstats = self._create_cache(self._fetch_textstat, "TextStat")
+
+        # Conference number to utils.LocalToGlobalIndex, least
+        # recently used first. Updated from local-to-global replies and
+        # async messages.
+        self._text_indexes = OrderedDict()
+        self._max_text_indexes = self._cache_options.get("TextIndex", {}).get(
+            "max_size", MAX_TEXT_INDEXES)
 
         self._async_handlers = {}
         self._client.set_async_handler(self._handle_async_message)
@@ -490,11 +1234,22 @@ class AioCachingClient:
     async def close(self):
         await self._client.close()
 
-    async def request(self, request):
-        return await self._client.request(request)
+    async def request(self, request, **kwargs):
+        """Send a request through the client. Keyword arguments (such as
+        timeout and priority) are passed on to AioClient.request().
+        """
+        result = await self._client.request(request, **kwargs)
+        if isinstance(request, (requests.ReqCreateConf, requests.ReqCreatePerson)):
+            # The new conference or person might be cached as undefined
+            self.uconferences.invalidate_error(result)
+            self.conferences.invalidate_error(result)
+            self.persons.invalidate_error(result)
+        elif isinstance(request, (requests.ReqCreateText, requests.ReqCreateAnonymousText)):
+            self.textstats.invalidate_error(result)
+        return result
 
-    async def raw_request(self, request_bytes):
-        return await self._client.raw_request(request_bytes)
+    async def raw_request(self, request_bytes, **kwargs):
+        return await self._client.raw_request(request_bytes, **kwargs)
 
 
     # Protocol A async message handling
@@ -545,6 +1300,8 @@ class AioCachingClient:
         self.uconferences.invalidate(msg.conf_no)
         # A new name makes conferences[].name invalid
         self.conferences.invalidate(msg.conf_no)
+        # A new name could be for a new person
+        self.persons.invalidate_error(msg.conf_no)
 
     async def _cah_leave_conf(self, msg):
         # Leaving a conference makes conferences[].no_of_members invalid
@@ -555,6 +1312,8 @@ class AioCachingClient:
         ts = msg.text_stat
         for rcpt in ts.misc_info.recipient_list:
             self.conferences.invalidate(rcpt.recpt)
+            if rcpt.recpt in self._text_indexes:
+                self._text_indexes[rcpt.recpt].remove_text(msg.text_no, rcpt.loc_no)
 
     async def _cah_new_text(self, msg):
         # A new text. conferences[].no_of_texts and
@@ -563,8 +1322,12 @@ class AioCachingClient:
         for rcpt in msg.text_stat.misc_info.recipient_list:
             self.conferences.invalidate(rcpt.recpt)
             self.uconferences.invalidate(rcpt.recpt)
+            if rcpt.recpt in self._text_indexes:
+                self._text_indexes[rcpt.recpt].add_text(rcpt.loc_no, msg.text_no)
         for ct in msg.text_stat.misc_info.comment_to_list:
             self.textstats.invalidate(ct.text_no)
+        # The new text might be cached as not existing
+        self.textstats.invalidate_error(msg.text_no)
         # FIXME: A new text makes persons[author].no_of_created_texts invalid
 
     async def _cah_new_recipient(self, msg):
@@ -574,12 +1337,18 @@ class AioCachingClient:
         self.uconferences.invalidate(msg.conf_no)
         # textstats.misc_info_recipient_list gets invalid as well.
         self.textstats.invalidate(msg.text_no)
+        # The message doesn't tell the local number of the text in
+        # the conference, so it has to be mapped.
+        if msg.conf_no in self._text_indexes:
+            self._text_indexes[msg.conf_no].set_incomplete()
 
     async def _cah_sub_recipient(self, msg):
         # Invalid conferences[].no_of_texts
         self.conferences.invalidate(msg.conf_no)
         # textstats.misc_info_recipient_list gets invalid as well.
         self.textstats.invalidate(msg.text_no)
+        if msg.conf_no in self._text_indexes:
+            self._text_indexes[msg.conf_no].remove_text(msg.text_no)
 
     async def _cah_new_membership(self, msg):
         # Joining a conference makes conferences[].no_of_members invalid
@@ -594,17 +1363,22 @@ class AioCachingClient:
 
 
     # Fetching functions (internal use)
-    async def _fetch_uconference(self, no):
-        return await self.request(requests.ReqGetUconfStat(no))
+    def _create_cache(self, fetcher, name, **defaults):
+        options = dict(defaults)
+        options.update(self._cache_options.get(name, {}))
+        return AioCache(fetcher, name, **options)
 
-    async def _fetch_conference(self, no):
-        return await self.request(requests.ReqGetConfStat(no))
+    async def _fetch_uconference(self, no, priority=PRIORITY_INTERACTIVE):
+        return await self.request(requests.ReqGetUconfStat(no), priority=priority)
 
-    async def _fetch_person(self, no):
-        return await self.request(requests.ReqGetPersonStat(no))
+    async def _fetch_conference(self, no, priority=PRIORITY_INTERACTIVE):
+        return await self.request(requests.ReqGetConfStat(no), priority=priority)
 
-    async def _fetch_textstat(self, no):
-        return await self.request(requests.ReqGetTextStat(no))
+    async def _fetch_person(self, no, priority=PRIORITY_INTERACTIVE):
+        return await self.request(requests.ReqGetPersonStat(no), priority=priority)
+
+    async def _fetch_textstat(self, no, priority=PRIORITY_INTERACTIVE):
+        return await self.request(requests.ReqGetTextStat(no), priority=priority)
 
 
     # Report cache usage
@@ -656,45 +1430,131 @@ class AioCachingClient:
                 want_confs=want_confs))
         return [(x.conf_no, x.name.decode('latin1')) for x in matches]
 
-    async def get_unread_texts_from_membership(self, membership):
-        unread = []
-
-        more_to_fetch = 1
+    async def get_unread_texts_from_membership(self, membership, window=LOCAL_TO_GLOBAL_WINDOW):
+        """Get the global numbers of the unread texts in a membership
+        (with read ranges), in local number order.
+
+        The local numbers that can be unread are split in chunks. The
+        chunks that the conference's local to global index does not
+        cover are mapped with up to {window} concurrent local-to-global
+        requests. The chunks after the last read range are planned
+        from the (cached) highest local number of the conference. If
+        there are more texts after that, they are mapped one chunk at
+        a time.
+        """
+        conf_no = membership.conference
+        index = self._find_text_index(conf_no)
         gaps, last = utils.read_ranges_to_gaps_and_last(membership.read_ranges)
+        highest_local_no = (await self.uconferences.get(conf_no)).highest_local_no
+        if index is not None:
+            if highest_local_no >= index.end:
+                # Texts we have not been told about
+                index.set_incomplete()
+            highest_local_no = max(highest_local_no, index.end - 1)
+        # Always map at least one chunk after the last read range, to
+        # find texts that are newer than the cached conference.
+        gaps.append((last, max(highest_local_no + 1 - last, 1)))
+
+        chunks = []
         for first, gap_len in gaps:
-            first_local = first
-            while gap_len > 0:
-                if gap_len > 255:
-                    n = 255
-                else:
-                    n = gap_len
-                gap_len -= n
-                try:
-                    mapping = await self.request(
-                        requests.ReqLocalToGlobal(membership.conference, first_local, n))
-                    unread.extend([e[1] for e in mapping.list if e[1] != 0])
-                    first_local = mapping.range_end
-                    more_to_fetch = mapping.later_texts_exists
-                except NoSuchLocalText:
-                    more_to_fetch = 0
-
-        # If there are more than 255 after the last read range, we
-        # need to continue mapping (the last, if any, previous call
-        # will have set later_texts_exists to 1 if so).
-        first_local = last
+            for first_local in range(first, first + gap_len, MAX_LOCAL_TO_GLOBAL):
+                chunks.append((first_local, min(MAX_LOCAL_TO_GLOBAL, first + gap_len - first_local)))
+        # (local, global) pairs for each chunk, from the index if possible
+        chunk_pairs = [ index.lookup(first_local, first_local + n) if index is not None else None
+                        for first_local, n in chunks ]
+        remote = [ i for i, pairs in enumerate(chunk_pairs) if pairs is None ]
+        mappings = await gather_bounded(
+            [ self._local_to_global(conf_no, *chunks[i]) for i in remote ], window)
+        for i, mapping in zip(remote, mappings):
+            chunk_pairs[i] = mapping.list if mapping is not None else []
+        stats.set('clients.localtoglobal.chunks.local.last', len(chunks) - len(remote), agg='sum')
+        stats.set('clients.localtoglobal.chunks.remote.last', len(remote), agg='sum')
+
+        unread = []
+        for (first_local, n), pairs in zip(chunks, chunk_pairs):
+            # A mapping covers n existing texts, which can go past the
+            # chunk if texts have been deleted.
+            end_local = first_local + n
+            unread.extend([ e[1] for e in pairs
+                            if first_local <= e[0] < end_local and e[1] != 0 ])
+
+        # Continue mapping if there are texts after the planned chunks.
+        first_local = chunks[-1][0] + chunks[-1][1]
+        if remote and remote[-1] == len(chunks) - 1:
+            mapping = mappings[-1]
+            more_to_fetch = mapping is not None and (
+                mapping.later_texts_exists or mapping.range_end > first_local)
+        else:
+            # The index covers the last chunk, and it is complete or
+            # it would not have been used.
+            more_to_fetch = False
         while more_to_fetch:
-            try:
-                mapping = await self.request(
-                    requests.ReqLocalToGlobal(membership.conference, first_local, 255))
-                unread.extend([e[1] for e in mapping.list if e[1] != 0])
-                first_local = mapping.range_end
-                more_to_fetch = mapping.later_texts_exists
-            except NoSuchLocalText:
-                # No unread texts
-                more_to_fetch = 0
-
-        # Remove text that don't exist anymore (text_no == 0)
-        return [ text_no for text_no in unread if text_no != 0]
+            mapping = await self._local_to_global(conf_no, first_local, MAX_LOCAL_TO_GLOBAL)
+            if mapping is None:
+                break
+            unread.extend([ e[1] for e in mapping.list if e[0] >= first_local and e[1] != 0 ])
+            first_local = mapping.range_end
+            more_to_fetch = mapping.later_texts_exists
+
+        return unread
+
+    async def get_last_text_mappings(self, conf_no, no_of_texts):
+        """Get (local, global) pairs of the last {no_of_texts} texts in
+        conference {conf_no}, in local number order."""
+        index = self._find_text_index(conf_no)
+        if index is not None:
+            if (await self.uconferences.get(conf_no)).highest_local_no >= index.end:
+                # Texts we have not been told about
+                index.set_incomplete()
+            pairs = index.last_texts(no_of_texts)
+            if pairs is not None:
+                stats.set('clients.localtoglobal.last.local.last', 1, agg='sum')
+                return pairs
+        stats.set('clients.localtoglobal.last.remote.last', 1, agg='sum')
+        mapping = await self.request(requests.ReqLocalToGlobalReverse(conf_no, 0, no_of_texts),
+                                     priority=PRIORITY_BACKGROUND)
+        # Without a ceiling, the mapping goes to the end of the conference.
+        self._get_text_index(conf_no).add_mapping(
+            mapping.range_begin, mapping.range_end, mapping.list, False)
+        return [ e for e in mapping.list if e[1] != 0 ]
+
+    async def count_unread_texts_from_membership(self, membership):
+        """Count the unread texts in a membership (with read ranges),
+        from the read ranges and the (cached) highest local number of
+        the conference. Texts that have been deleted are counted as
+        well, so this is an upper bound, but no local-to-global
+        requests are needed.
+        """
+        uconf = await self.uconferences.get(membership.conference)
+        return utils.count_unread_texts(membership.read_ranges, uconf.highest_local_no)
+
+    async def _local_to_global(self, conf_no, first_local, n):
+        """Returns None if there are no texts from first_local and on."""
+        try:
+            mapping = await self.request(requests.ReqLocalToGlobal(conf_no, first_local, n),
+                                         priority=PRIORITY_BACKGROUND)
+        except NoSuchLocalText:
+            self._get_text_index(conf_no).add_mapping(first_local, first_local, [], False)
+            return None
+        self._get_text_index(conf_no).add_mapping(
+            mapping.range_begin, mapping.range_end, mapping.list, mapping.later_texts_exists)
+        return mapping
+
+    def _find_text_index(self, conf_no):
+        """Return the local to global index for conf_no, or None."""
+        index = self._text_indexes.get(conf_no)
+        if index is not None:
+            self._text_indexes.move_to_end(conf_no)
+        return index
+
+    def _get_text_index(self, conf_no):
+        index = self._find_text_index(conf_no)
+        if index is None:
+            index = self._text_indexes[conf_no] = utils.LocalToGlobalIndex()
+            while len(self._text_indexes) > self._max_text_indexes:
+                self._text_indexes.popitem(last=False)
+                stats.set('clients.cache.TextIndex.evictions.last', 1, agg='sum')
+        return index
 
     async def mark_text(self, text_no, mark_type):
         await self.request(requests.ReqMarkText(text_no, mark_type))
@@ -708,8 +1568,24 @@ class AioCachingClient:
 
 
 class AioCachingPersonClient(AioCachingClient):
-    def __init__(self, connection):
-        AioCachingClient.__init__(self, connection)
+    def __init__(self, connection, cache_options=None, mark_as_read_delay=None,
+                 mark_as_read_batch_size=MARK_AS_READ_BATCH_SIZE):
+        """
+        @param mark_as_read_delay: If not None, mark_as_read_local()
+        collects the texts marked as read in each conference for this
+        number of seconds (or until there are mark_as_read_batch_size
+        of them), and marks them as read with one request per
+        conference.
+        """
+        AioCachingClient.__init__(self, connection, cache_options)
+
+        # Batching of marks as read. Conference number to list of
+        # (local text number, future) for the texts to mark as read.
+        self._mark_as_read_delay = mark_as_read_delay
+        self._mark_as_read_batch_size = mark_as_read_batch_size
+        self._pending_marks = {}
+        self._mark_flush_handle = None
+        self._mark_flush_tasks = set()
 
         # Current person number
         self._pers_no = 0
@@ -718,7 +1594,14 @@ class AioCachingPersonClient(AioCachingClient):
         self._current_conference_no = 0
 
         # Caches
-        self._memberships = AioCache(self._fetch_membership, "Membership")
+        self._memberships = self._create_cache(self._fetch_membership, "Membership")
+        # Memberships with read ranges (as utils.ReadRangeSet), which
+        # are updated when texts are marked as read or unread through
+        # this client, and invalidated by other requests that change
+        # read ranges. Texts marked as read by other sessions for the
+        # same person are not seen (no async messages), so they expire.
+        self._read_memberships = self._create_cache(
+            self._fetch_read_membership, "ReadMembership", ttl=READ_MEMBERSHIP_TTL)
 
         # Specific membership cache where the keys are the positions
         # in the membership list for the membership, and the values
@@ -731,6 +1614,25 @@ class AioCachingPersonClient(AioCachingClient):
         # sending accept-async until the last call.
         self._add_async_handler(AsyncMessages.LEAVE_CONF, self._cpah_leave_conf)
         self._add_async_handler(AsyncMessages.NEW_MEMBERSHIP, self._cpah_new_membership)
+        self._add_async_handler(AsyncMessages.NEW_TEXT, self._cpah_new_text)
+
+    async def request(self, request, **kwargs):
+        result = await AioCachingClient.request(self, request, **kwargs)
+        self._invalidate_changed_read_ranges(request)
+        return result
+
+    async def raw_request(self, request_bytes, **kwargs):
+        result = await AioCachingClient.raw_request(self, request_bytes, **kwargs)
+        self._invalidate_changed_read_ranges(request_bytes)
+        return result
+
+    def _invalidate_changed_read_ranges(self, request):
+        # Requests that change read ranges, other than the ones sent
+        # by mark_as_read_local() and mark_as_unread_local() (which
+        # update the cached read ranges instead).
+        conf_no = utils.read_ranges_changed_by(request)
+        if conf_no is not None:
+            self._read_memberships.invalidate(conf_no)
 
     async def login(self, pers_no, passwd):
         await self.request(requests.ReqLogin(pers_no, passwd, invisible=0))
@@ -738,12 +1640,21 @@ class AioCachingPersonClient(AioCachingClient):
         # invalidate caches.
         self._pers_no = pers_no
 
+    async def close(self):
+        try:
+            await self.flush_marks_as_read()
+        finally:
+            await AioCachingClient.close(self)
+
     async def logout(self):
+        await self.flush_marks_as_read()
         await self.request(requests.ReqLogout())
         # Invalidate caches that are/were for the current person
         self._pers_no = 0
         self._memberships_by_position = dict()
         self._memberships.invalidate_all()
+        self._read_memberships.invalidate_all()
+        self._text_indexes.clear()
 
     def get_current_person_no(self):
         return self._pers_no
@@ -758,22 +1669,129 @@ class AioCachingPersonClient(AioCachingClient):
         # current conference to be able to invalidate the membership
         # correctly.
         prev_conf_no = self._current_conference_no
+        await self.flush_marks_as_read()
         await self.request(requests.ReqChangeConference(conf_no))
         self._current_conference_no = conf_no
         if prev_conf_no != 0:
             self._invalidate_membership(prev_conf_no)
 
     async def mark_as_read_local(self, conf_no, local_text_no):
+        """Mark a text as read. If marks as read are batched, this
+        returns (or raises) when the batch with the text has been
+        sent. The batches are sent as background requests."""
+        if self._mark_as_read_delay is None:
+            await self._send_mark_as_read(conf_no, [local_text_no], PRIORITY_INTERACTIVE)
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        marks = self._pending_marks.setdefault(conf_no, [])
+        marks.append((local_text_no, future))
+        if len(marks) >= self._mark_as_read_batch_size:
+            self._start_flush(conf_no)
+        elif self._mark_flush_handle is None:
+            self._mark_flush_handle = asyncio.get_event_loop().call_later(
+                self._mark_as_read_delay, self._start_flush)
+        await future
+
+    async def flush_marks_as_read(self, conf_no=None):
+        """Send the batched marks as read now, for conference
+        {conf_no} or for all conferences."""
+        if conf_no is None:
+            self._cancel_flush_timer()
+            conf_nos = list(self._pending_marks.keys())
+        else:
+            conf_nos = [ conf_no ]
+        await asyncio.gather(*[ self._send_marks_as_read(c, self._pop_marks(c)) for c in conf_nos ],
+                             *list(self._mark_flush_tasks))
+
+    def _cancel_flush_timer(self):
+        if self._mark_flush_handle is not None:
+            self._mark_flush_handle.cancel()
+            self._mark_flush_handle = None
+
+    def _start_flush(self, conf_no=None):
+        # Flush in a task of its own, so that a cancelled caller does
+        # not leave the rest of the batch unsent.
+        if conf_no is None:
+            self._mark_flush_handle = None
+            conf_nos = list(self._pending_marks.keys())
+        else:
+            conf_nos = [ conf_no ]
+        for c in conf_nos:
+            task = asyncio.ensure_future(self._send_marks_as_read(c, self._pop_marks(c)))
+            self._mark_flush_tasks.add(task)
+            task.add_done_callback(self._mark_flush_tasks.discard)
+
+    def _pop_marks(self, conf_no):
+        marks = self._pending_marks.pop(conf_no, [])
+        if not self._pending_marks:
+            self._cancel_flush_timer()
+        return marks
+
+    async def _send_marks_as_read(self, conf_no, marks):
+        if not marks:
+            return
+        stats.set('clients.markasread.batches.last', 1, agg='sum')
+        stats.set('clients.markasread.texts.last', len(marks), agg='sum')
+        try:
+            try:
+                await self._send_mark_as_read(conf_no, [ local_no for local_no, _ in marks ],
+                                              PRIORITY_BACKGROUND)
+                results = [ None ] * len(marks)
+            except ServerError:
+                # Find out which of the texts that failed, by marking
+                # them one at a time.
+                results = []
+                for local_no, _ in marks:
+                    try:
+                        await self._send_mark_as_read(conf_no, [ local_no ], PRIORITY_BACKGROUND)
+                        results.append(None)
+                    except ServerError as e:
+                        results.append(e)
+        except asyncio.CancelledError:
+            for _, future in marks:
+                future.cancel()
+            raise
+        except Exception as e:
+            results = [ e ] * len(marks)
+        for (_, future), result in zip(marks, results):
+            if future.done():
+                continue
+            if result is None:
+                future.set_result(None)
+            else:
+                future.set_exception(result)
+
+    async def _send_mark_as_read(self, conf_no, local_text_nos, priority):
         try:
-            await self.request(requests.ReqMarkAsRead(conf_no, [local_text_no]))
+            await AioCachingClient.request(self, requests.ReqMarkAsRead(conf_no, local_text_nos),
+                                           priority=priority)
         except NotMember:
-            pass
+            return
+        def update(read_ranges):
+            for local_text_no in local_text_nos:
+                read_ranges.add(local_text_no)
+        self._update_read_ranges(conf_no, update)
 
     async def mark_as_unread_local(self, conf_no, local_text_no):
+        # A pending mark as read of the text must be sent first
+        await self.flush_marks_as_read(conf_no)
         try:
-            await self.request(requests.ReqMarkAsUnread(conf_no, local_text_no))
+            await AioCachingClient.request(self, requests.ReqMarkAsUnread(conf_no, local_text_no))
         except NotMember:
-            pass
+            return
+        self._update_read_ranges(conf_no, lambda read_ranges: read_ranges.remove(local_text_no))
+
+    def _update_read_ranges(self, conf_no, update):
+        # Update the cached read ranges in place instead of fetching
+        # them again.
+        membership = self._read_memberships.get_cached(conf_no)
+        if membership is not None:
+            update(membership.read_ranges)
+        else:
+            # A fetch in flight might have been answered before the
+            # change, so it must not be cached.
+            self._read_memberships.invalidate(conf_no)
 
     def _get_cached_memberships_by_position(self, first, no_of_confs):
         # Return a list of the cached memberships if we have all of
@@ -792,6 +1810,7 @@ class AioCachingPersonClient(AioCachingClient):
 
     def _invalidate_membership(self, conf_no):
         self._memberships.invalidate(conf_no)
+        self._read_memberships.invalidate(conf_no)
         # Since we only return anything from memberships_by_position
         # if all memberships are found, it means that we can make
         # partial invalidations.
@@ -829,6 +1848,13 @@ class AioCachingPersonClient(AioCachingClient):
         """Get a membership for a person
         """
         if want_read_ranges:
+            if pers_no == self._pers_no:
+                await self.flush_marks_as_read(conf_no)
+                # The cached membership is updated in place, so return
+                # a copy of it.
+                membership = copy.copy(await self._read_memberships.get(conf_no))
+                membership.read_ranges = membership.read_ranges.copy()
+                return membership
             return await self.request(requests.ReqQueryReadTexts(pers_no, conf_no, 1, 0))
         else:
             if pers_no == self._pers_no:
@@ -848,10 +1874,19 @@ class AioCachingPersonClient(AioCachingClient):
         # read ranges, because it is easier to invalidate correctly.
         return await self.request(requests.ReqQueryReadTexts11(self._pers_no, conf_no, 0, 0))
 
+    async def _fetch_read_membership(self, conf_no):
+        """Fetch the membership, with read ranges, for a conf for the
+        current person.
+        """
+        membership = await self.request(requests.ReqQueryReadTexts11(self._pers_no, conf_no, 1, 0))
+        membership.read_ranges = utils.ReadRangeSet(membership.read_ranges)
+        return membership
+
     # Handlers for asynchronous messages (internal use)
     async def _cpah_leave_conf(self, msg):
         # Invalidates cached membership
         self._memberships.invalidate(msg.conf_no)
+        self._read_memberships.invalidate(msg.conf_no)
         # We invalidate the entire memberships_by_position because you
         # can change position of memberships.
         self._memberships_by_position = dict()
@@ -863,44 +1898,175 @@ class AioCachingPersonClient(AioCachingClient):
         # memberships, and because we get this async messages, we know
         # the current person was not a member before.
 
+    async def _cpah_new_text(self, msg):
+        # The server marks a new text as read for its author in the
+        # recipients the author is a member of
+        if msg.text_stat.author == self._pers_no:
+            for rcpt in msg.text_stat.misc_info.recipient_list:
+                self._read_memberships.invalidate(rcpt.recpt)
+
     # Report cache usage
     def report_cache_usage(self):
         AioCachingClient.report_cache_usage(self)
         self._memberships.report()
+        self._read_memberships.report()
 
 
 # Cache class for use internally by AioCachingClient
 class AioCache(object):
-    def __init__(self, fetcher, name = "Unknown"):
-        self.dict = {}
+    """Cache of objects fetched with the async fetcher function.
+
+    Concurrent gets of the same uncached object share a single
+    fetch. If the object is invalidated while it is being fetched, the
+    result of that fetch is not stored (but it is still returned to
+    the tasks that were already waiting for it).
+
+    Errors from the fetcher are only cached (negative caching) for
+    the exception classes in error_ttls.
+
+    A get with a priority passes it on to the fetcher, as the
+    priority keyword argument. A get that is not a background get
+    (priority PRIORITY_BACKGROUND) does not share a background fetch,
+    but starts a fetch of its own that replaces it, so that it does
+    not have to wait behind other background requests.
+    """
+
+    def __init__(self, fetcher, name = "Unknown", max_size=None, ttl=None, error_ttls=None):
+        """
+        @param max_size: Maximum number of cached objects, or None for
+        no limit. When full, the least recently used object is evicted.
+        @param ttl: Number of seconds an object is cached, or None for
+        no time-out.
+        @param error_ttls: Dict from exception class to the number of
+        seconds that such an error from the fetcher is cached. A get
+        of a cached error raises a new exception of the same class.
+        """
+        self.dict = OrderedDict()
         self.fetcher = fetcher
         self.cached = 0
         self.uncached = 0
         self.name = name
-
-    async def get(self, no):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.error_ttls = error_ttls if error_ttls is not None else {}
+        self._expires = {} # Key to expiry time (for entries with a ttl)
+        self._clock = time.monotonic
+        self._fetches = {} # Key to task for fetches in flight
+        self._background_fetches = set() # Keys of background fetches in flight
+
+    async def get(self, no, priority=None):
         #print('%s[%d]' % (self.name, no))
         stats.set('clients.cache.{}.gets.last'.format(self.name), 1, agg='sum')
-        if no in self.dict:
+        if no in self.dict and not self._expire(no):
             #print('%s[%d] - cached' % (self.name, no))
             self.cached = self.cached + 1
             stats.set('clients.cache.{}.gets.hits.last'.format(self.name), 1, agg='sum')
-            return self.dict[no]
-        else:
+            self.dict.move_to_end(no)
+            val = self.dict[no]
+            if isinstance(val, _CachedError):
+                stats.set('clients.cache.{}.gets.hits.errors.last'.format(self.name), 1, agg='sum')
+                raise val.create()
+            return val
+
+        task = self._fetches.get(no)
+        if task is not None and no in self._background_fetches and priority != PRIORITY_BACKGROUND:
+            # Left to the tasks already waiting for it, like an
+            # invalidated fetch.
+            stats.set('clients.cache.{}.gets.overtakes.last'.format(self.name), 1, agg='sum')
+            task = None
+        if task is None:
             #print('%s[%d] - not cached' % (self.name, no))
             self.uncached = self.uncached + 1
             stats.set('clients.cache.{}.gets.misses.last'.format(self.name), 1, agg='sum')
-            self.dict[no] = await self.fetcher(no)
-            stats.set('clients.cache.{}.sets.last'.format(self.name), 1, agg='sum')
-            return self.dict[no]
+            if priority is None:
+                task = asyncio.ensure_future(self.fetcher(no))
+            else:
+                task = asyncio.ensure_future(self.fetcher(no, priority=priority))
+            self._fetches[no] = task
+            if priority == PRIORITY_BACKGROUND:
+                self._background_fetches.add(no)
+            else:
+                self._background_fetches.discard(no)
+            task.add_done_callback(functools.partial(self._fetch_done, no))
+        else:
+            stats.set('clients.cache.{}.gets.joins.last'.format(self.name), 1, agg='sum')
+        # Shielded, so that a cancelled get does not cancel the fetch
+        # for the other tasks waiting for it.
+        return await asyncio.shield(task)
+
+    def _fetch_done(self, no, task):
+        # Done callbacks are called in the order they were added, so
+        # this is called before any of the waiting tasks are resumed.
+        error = None
+        if not task.cancelled():
+            error = task.exception()
+        if self._fetches.get(no) is not task:
+            # Invalidated while being fetched
+            return
+        del self._fetches[no]
+        self._background_fetches.discard(no)
+        if task.cancelled():
+            return
+        if error is None:
+            self._set(no, task.result(), self.ttl)
+            return
+        for error_class, error_ttl in self.error_ttls.items():
+            if isinstance(error, error_class):
+                self._set(no, _CachedError(error), error_ttl)
+                stats.set('clients.cache.{}.sets.errors.last'.format(self.name), 1, agg='sum')
+                return
+
+    def _set(self, no, val, ttl):
+        self.dict[no] = val
+        self.dict.move_to_end(no)
+        if ttl is not None:
+            self._expires[no] = self._clock() + ttl
+        else:
+            self._expires.pop(no, None)
+        stats.set('clients.cache.{}.sets.last'.format(self.name), 1, agg='sum')
+        if self.max_size is not None:
+            while len(self.dict) > self.max_size:
+                evicted, _ = self.dict.popitem(last=False)
+                self._expires.pop(evicted, None)
+                stats.set('clients.cache.{}.evictions.last'.format(self.name), 1, agg='sum')
+
+    def _expire(self, no):
+        # Remove the object if it has timed out. Returns True if it was removed.
+        expires = self._expires.get(no)
+        if expires is None or expires > self._clock():
+            return False
+        del self.dict[no]
+        del self._expires[no]
+        stats.set('clients.cache.{}.expirations.last'.format(self.name), 1, agg='sum')
+        return True
+
+    def invalidate_error(self, no):
+        """Invalidate the entry for no only if it is a cached error."""
+        if isinstance(self.dict.get(no), _CachedError):
+            self.invalidate(no)
+
+    def get_cached(self, no):
+        """Return the cached object for no, or None if it is not
+        cached (without fetching it)."""
+        if no in self.dict and not self._expire(no):
+            val = self.dict[no]
+            if not isinstance(val, _CachedError):
+                return val
+        return None
 
     def invalidate(self, no):
-        if no in self.dict:
-            del self.dict[no]
+        if no in self.dict or no in self._fetches:
+            self.dict.pop(no, None)
+            self._expires.pop(no, None)
+            self._fetches.pop(no, None)
+            self._background_fetches.discard(no)
             stats.set('clients.cache.{}.invalidations.last'.format(self.name), 1, agg='sum')
 
     def invalidate_all(self):
-        self.dict = dict()
+        self.dict = OrderedDict()
+        self._expires = {}
+        self._fetches = dict()
+        self._background_fetches = set()
         stats.set('clients.cache.{}.invalidate-alls.last'.format(self.name), 1, agg='sum')
 
     def report(self):
@@ -909,14 +2075,57 @@ class AioCache(object):
                                                      self.uncached)))
 
 
-def create_client():
-    conn = AioConnection()
-    client = AioClient(conn)
-    caching_client = AioCachingPersonClient(client)
+class _CachedError(object):
+    """An error from a fetcher, stored in an AioCache."""
+    def __init__(self, error):
+        self.error_class = type(error)
+        self.args = error.args
+
+    def create(self):
+        return self.error_class(*self.args)
+
+
+def create_client(cache_options=None, mark_as_read_delay=None, max_in_flight=MAX_IN_FLIGHT,
+                  timeout=None, connection_class=AioConnection, background_share=BACKGROUND_SHARE,
+                  rate_limit=None, shared_rate_limit=False):
+    conn = connection_class()
+    client = AioClient(conn, max_in_flight=max_in_flight, timeout=timeout,
+                       background_share=background_share, rate_limit=rate_limit,
+                       shared_rate_limit=shared_rate_limit)
+    caching_client = AioCachingPersonClient(client, cache_options,
+                                            mark_as_read_delay=mark_as_read_delay)
     return caching_client
 
 
+async def _async_socket_error(komsession, serr):
+    """Return the exception to raise for the socket error serr."""
+    if serr.errno in (errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN, errno.ETIMEDOUT):
+        # If we got an error that indicates that the
+        # connection has failed, then close and raise.
+        log.debug("AioKomSession raised socket error, closing")
+        await komsession.close()
+        return KomSessionNotConnected(serr)
+    else:
+        return KomSessionException(serr)
+
+
 def async_check_connection(f):
+    if inspect.isasyncgenfunction(f):
+        @functools.wraps(f)
+        async def decorated_generator(komsession, *args, **kwargs):
+            if not komsession.is_connected():
+                raise KomSessionNotConnected()
+            generator = f(komsession, *args, **kwargs)
+            try:
+                async for item in generator:
+                    yield item
+            except socket.error as serr:
+                raise await _async_socket_error(komsession, serr)
+            finally:
+                await generator.aclose()
+
+        return decorated_generator
+
     @functools.wraps(f)
     async def decorated(komsession, *args, **kwargs):
         if not komsession.is_connected():
@@ -924,14 +2133,7 @@ def async_check_connection(f):
         try:
             return await f(komsession, *args, **kwargs)
         except socket.error as serr:
-            if serr.errno in (errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN, errno.ETIMEDOUT):
-                # If we got an error that indicates that the
-                # connection has failed, then close and raise.
-                log.debug("AioKomSession raised socket error, closing")
-                await komsession.close()
-                raise KomSessionNotConnected(serr)
-            else:
-                raise KomSessionException(serr)
+            raise await _async_socket_error(komsession, serr)
 
     return decorated
 
@@ -947,12 +2149,18 @@ class AioKomSession(object):
     bytes? Seems inconvient at this level.)
 
     """
-    def __init__(self, *, client_factory=create_client):
+    def __init__(self, *, client_factory=create_client, concurrency_limit=CONCURRENCY_LIMIT):
+        """
+        @param concurrency_limit: Maximum number of concurrent
+        requests when many objects are fetched at once (such as the
+        texts in get_last_texts()), or None for no limit.
+        """
         # TODO: We actually require the API of a
         # CachingPersonClient. We should enhance the Connection
         # class and make CachingPersonClient have the same API as
         # Connection.
         self._client_factory = client_factory
+        self._concurrency_limit = concurrency_limit
         self._client = None
         self._session_no = None
         self._client_name = None
@@ -1144,8 +2352,8 @@ class AioKomSession(object):
             raise AmbiguousName("ambiguous recipient: %s" % lookup)
         return matches[0][0]
 
-    async def _get_text_stat(self, text_no):
-        return await self._client.textstats.get(text_no)
+    async def _get_text_stat(self, text_no, priority=None):
+        return await self._client.textstats.get(text_no, priority=priority)
 
     @async_check_connection
     async def get_text_stat(self, text_no) -> 'KomTextStat':
@@ -1161,23 +2369,40 @@ class AioKomSession(object):
     async def delete_membership(self, pers_no, conf_no):
         await self._client.request(requests.ReqSubMember(conf_no, pers_no))
 
-    async def _create_kom_membership(self, pers_no, membership: Membership) -> KomMembership:
+    async def _create_kom_membership(self, pers_no, membership: Membership, person_names=None) -> KomMembership:
         if membership.added_by == 0:
             # If the membership was created before protocol 10.
             added_by = None
+        elif person_names is not None:
+            added_by = person_names[membership.added_by]
         else:
             added_by = await self._get_person_name(membership.added_by)
         conference = await self._get_uconference(membership.conference)
         return KomMembership(pers_no, added_by=added_by, conference=conference, membership=membership)
 
+    async def _create_kom_memberships(self, pers_no, memberships):
+        # The same person has often added many of the memberships, so
+        # get each person's name once, before the conferences.
+        person_names = await self._get_person_names(
+            m.added_by for m in memberships if m.added_by != 0)
+        return await self._gather(
+            self._create_kom_membership(pers_no, m, person_names) for m in memberships)
+
     @async_check_connection
     async def get_membership(self, pers_no, conf_no) -> KomMembership:
         membership = await self._client.get_membership(pers_no, conf_no, want_read_ranges=False)
         return await self._create_kom_membership(pers_no, membership)
 
     @async_check_connection
-    async def get_membership_unread(self, pers_no, conf_no) -> KomMembershipUnread:
+    async def get_membership_unread(self, pers_no, conf_no, count_only=False) -> KomMembershipUnread:
+        """If {count_only} is true, no_of_unread is an upper bound
+        (exact unless texts have been deleted) and unread_texts is None.
+        That is much cheaper than getting the unread text numbers.
+        """
         membership = await self._client.get_membership(pers_no, conf_no, want_read_ranges=True)
+        if count_only:
+            no_of_unread = await self._client.count_unread_texts_from_membership(membership)
+            return KomMembershipUnread(pers_no, conf_no, no_of_unread, None)
         unread_texts = await self._client.get_unread_texts_from_membership(membership)
         return KomMembershipUnread(pers_no, conf_no, len(unread_texts), unread_texts)
 
@@ -1193,7 +2418,10 @@ class AioKomSession(object):
             # don't want to get the unread texts in this case. It's
             # possible that we need to change this, which means that
             # unread=True may be a slower call.
-            memberships = [ await self.get_membership(pers_no, conf_no) for conf_no in conf_nos ]
+            ms_list = await self._gather(
+                self._client.get_membership(pers_no, conf_no, want_read_ranges=False)
+                for conf_no in conf_nos)
+            memberships = await self._create_kom_memberships(pers_no, ms_list)
             has_more = False
         else:
             ms_list = await self._client.get_memberships(pers_no, first, no_of_confs,
@@ -1206,19 +2434,18 @@ class AioKomSession(object):
             else:
                 has_more = True
 
-            memberships = []
-            for membership in ms_list:
-                if (not passive) and membership.type.passive:
-                    continue
-                memberships.append(await self._create_kom_membership(pers_no, membership))
+            if not passive:
+                ms_list = [ m for m in ms_list if not m.type.passive ]
+            memberships = await self._create_kom_memberships(pers_no, ms_list)
 
         return memberships, has_more
 
     @async_check_connection
-    async def get_membership_unreads(self, pers_no):
+    async def get_membership_unreads(self, pers_no, count_only=False):
+        """See get_membership_unread() for {count_only}."""
         conf_nos = await self._client.request(requests.ReqGetUnreadConfs(pers_no))
-        memberships = [ await self.get_membership_unread(pers_no, conf_no)
-                        for conf_no in conf_nos ]
+        memberships = await self._gather(
+            self.get_membership_unread(pers_no, conf_no, count_only) for conf_no in conf_nos)
         return [ m for m in memberships if m.no_of_unread > 0 ]
 
     @async_check_connection
@@ -1231,18 +2458,37 @@ class AioKomSession(object):
             name = UNDEFINED_CONFERENCE_NAME.format(conf_no=conf_no)
         return KomConferenceName(conf_no, name)
 
+    async def _gather(self, aws):
+        return await gather_bounded(list(aws), self._concurrency_limit)
+
+    async def _get_person_names(self, pers_nos):
+        """Get the names of persons concurrently, each distinct person
+        only once. Returns a dict from person number to KomPersonName.
+        """
+        pers_nos = list(dict.fromkeys(pers_nos))
+        names = await self._gather(self._get_person_name(pers_no) for pers_no in pers_nos)
+        return dict(zip(pers_nos, names))
+
+    @staticmethod
+    def _text_stat_pers_nos(text_stat: TextStat):
+        return [ text_stat.author ] + [ ai.creator for ai in text_stat.aux_items ]
+
     async def _get_komauxitem(self, aux_item: AuxItem) -> KomAuxItem:
         creator = await self._get_person_name(aux_item.creator)
         return KomAuxItem(aux_item, creator)
 
-    async def _get_komtextstat(self, text_no, text_stat: TextStat) -> 'KomTextStat':
-        author = await self._get_person_name(text_stat.author)
-        aux_items = [await self._get_komauxitem(ai) for ai in text_stat.aux_items]
+    async def _get_komtextstat(self, text_no, text_stat: TextStat, person_names=None) -> 'KomTextStat':
+        if person_names is None:
+            person_names = await self._get_person_names(self._text_stat_pers_nos(text_stat))
+        author = person_names[text_stat.author]
+        aux_items = [ KomAuxItem(ai, person_names[ai.creator]) for ai in text_stat.aux_items ]
         return KomTextStat(text_no, text_stat, aux_items=aux_items, author=author)
 
-    async def _get_komtext(self, text_no, text, text_stat: TextStat) -> KomText:
-        ks = await self._get_komtextstat(text_no, text_stat)
-        return KomText(text_no=text_no, text=text, text_stat=text_stat, aux_items=ks.aux_items, author=ks.author)
+    async def _get_komtext(self, text_no, text, text_stat: TextStat, truncated=False,
+                           person_names=None) -> KomText:
+        ks = await self._get_komtextstat(text_no, text_stat, person_names)
+        return KomText(text_no=text_no, text=text, text_stat=text_stat, aux_items=ks.aux_items, author=ks.author,
+                       truncated=truncated)
 
     async def _get_uconference(self, conf_no) -> KomUConference:
         return KomUConference(conf_no, uconf=await self._client.uconferences.get(conf_no))
@@ -1285,22 +2531,115 @@ class AioKomSession(object):
 
     @async_check_connection
     async def get_text(self, text_no) -> KomText:
-        text_stat = await self._get_text_stat(text_no)
-        text = await self._client.request(requests.ReqGetText(text_no))
+        text_stat, text = await self._gather([
+            self._get_text_stat(text_no),
+            self._client.request(requests.ReqGetText(text_no)) ])
         return await self._get_komtext(text_no=text_no, text=text, text_stat=text_stat)
 
+    @async_check_connection
+    async def get_text_preview(self, text_no, max_chars=TEXT_PREVIEW_SIZE, subject_only=False) -> KomText:
+        """Get text {text_no}, but only the first {max_chars} bytes of
+        the text. If {subject_only} is true, only the subject line is
+        kept. The truncated attribute of the returned KomText is True
+        if the body is not complete.
+        """
+        return await self._get_text_preview(text_no, max_chars, subject_only)
+
+    async def _get_text_preview(self, text_no, max_chars=TEXT_PREVIEW_SIZE, subject_only=False,
+                                priority=PRIORITY_INTERACTIVE):
+        text_stat = await self._get_text_stat(text_no, priority)
+        end_char = min(max_chars, text_stat.no_of_chars) - 1
+        if end_char < 0:
+            text = b""
+        else:
+            text = await self._client.request(requests.ReqGetText(text_no, 0, end_char),
+                                              priority=priority)
+        truncated = len(text) < text_stat.no_of_chars
+
+        mime_type, encoding = utils.parse_content_type(
+            KomText._get_content_type_from_text_stat(text_stat))
+        if truncated and mime_type[0] == "text" and encoding is not None \
+           and encoding.lower() in ("utf-8", "utf8"):
+            # Don't let a character cut in half make the decoding
+            # fall back to latin-1.
+            text = utils.cut_incomplete_utf8(text)
+        if not (mime_type[0] == "x-kom" and mime_type[1] == "user-area"):
+            lf = text.find(b"\n")
+            if subject_only and lf != -1 and lf + 1 < len(text):
+                text = text[:lf+1]
+                truncated = True
+            elif truncated and lf == -1:
+                # Cut in the subject line. End the line, so that it
+                # is decoded as a subject and not as a body.
+                text += b"\n"
+        stats.set('komsession.texts.previews.last', 1, agg='sum')
+        return await self._get_komtext(text_no=text_no, text=text, text_stat=text_stat, truncated=truncated)
+
+    @async_check_connection
+    async def stream_text(self, text_no, chunk_size=TEXT_CHUNK_SIZE):
+        """Async iterator over the body of text {text_no}, in chunks of
+        at most {chunk_size} bytes.
+
+        The body is fetched with one get-text request per chunk, so
+        only one chunk at a time has to be kept in memory. The chunks
+        are the raw body, after the subject line, and are not decoded.
+        (A text without linefeeds is all body, but that is only known
+        when all of it has been fetched.)
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive")
+        text_stat = await self._get_text_stat(text_no)
+        mime_type, _ = utils.parse_content_type(
+            KomText._get_content_type_from_text_stat(text_stat))
+        # Same rules as in KomText._decode_text: user areas have no
+        # subject, and a text without linefeeds is only a body.
+        in_body = (mime_type[0] == "x-kom" and mime_type[1] == "user-area")
+        head = b""
+        for start in range(0, text_stat.no_of_chars, chunk_size):
+            end_char = min(start + chunk_size, text_stat.no_of_chars) - 1
+            chunk = await self._client.request(
+                requests.ReqGetText(text_no, start, end_char))
+            stats.set('komsession.texts.streamed.chunks.last', 1, agg='sum')
+            if not in_body:
+                head += chunk
+                lf = head.find(b"\n")
+                if lf == -1:
+                    continue
+                in_body = True
+                chunk = head[lf+1:]
+                head = b""
+            if chunk:
+                yield chunk
+        if head:
+            yield head
+
     # TODO: offset/start number, so we can paginate. we probably need
     # to return the local text number for that.
     @async_check_connection
-    async def get_last_texts(self, conf_no, no_of_texts, offset=0, full_text=False):
+    async def get_last_texts(self, conf_no, no_of_texts, offset=0, full_text=False, with_subject=False):
         """Get the {no_of_texts} last texts in conference {conf_no},
-        starting from {offset}.
+        starting from {offset}. If {with_subject} is true, the texts
+        are previews with only the subject line (see
+        get_text_preview()), otherwise they have no text.
+
+        The text stats and previews are fetched as background
+        requests, so that they do not hold up interactive requests.
         """
         #local_no_ceiling = 0 # means the higest numbered texts (i.e. the last)
-        text_mapping = await self._client.request(
-            requests.ReqLocalToGlobalReverse(conf_no, 0, no_of_texts))
-        texts = [ await self._get_komtext(text_no=m[1], text=None, text_stat=await self._client.textstats.get(m[1]))
-                  for m in text_mapping.list if m[1] != 0 ]
+        text_mappings = await self._client.get_last_text_mappings(conf_no, no_of_texts)
+        text_nos = [ m[1] for m in text_mappings if m[1] != 0 ]
+        if with_subject:
+            texts = await self._gather(
+                self._get_text_preview(text_no, subject_only=True, priority=PRIORITY_BACKGROUND)
+                for text_no in text_nos)
+        else:
+            text_stats = await self._gather(
+                self._get_text_stat(text_no, PRIORITY_BACKGROUND) for text_no in text_nos)
+            person_names = await self._get_person_names(
+                pers_no for ts in text_stats for pers_no in self._text_stat_pers_nos(ts))
+            texts = [ await self._get_komtext(text_no=text_no, text=None, text_stat=ts,
+                                              person_names=person_names)
+                      for text_no, ts in zip(text_nos, text_stats) ]
         texts.reverse()
         return texts
 
@@ -1341,8 +2680,8 @@ class AioKomSession(object):
     @async_check_connection
     async def mark_as_read(self, text_no):
         text_stat = await self._get_text_stat(text_no)
-        for mi in text_stat.misc_info.recipient_list:
-            await self._client.mark_as_read_local(mi.recpt, mi.loc_no)
+        await self._gather(self._client.mark_as_read_local(mi.recpt, mi.loc_no)
+                           for mi in text_stat.misc_info.recipient_list)
 
     @async_check_connection
     async def mark_as_unread(self, text_no):
@@ -6,18 +6,26 @@
 
 from __future__ import absolute_import
 from __future__ import print_function
+from collections import OrderedDict
+import copy
 import logging
+import time
 
 from six.moves import range
 
 from . import requests, utils
 from .asyncmsg import AsyncMessages, async_dict
-from .errors import NotMember, NoSuchLocalText, UnimplementedAsync
+from .errors import Error, NotMember, NoSuchLocalText, UnimplementedAsync
 from .stats import stats
 
 
 logger = logging.getLogger("pylyskom.cachedconnection")
 
+# Default number of seconds that CachingPersonClient caches the read
+# ranges of a membership. Texts marked as read by other sessions (or
+# clients) for the same person are not seen before that.
+READ_MEMBERSHIP_TTL = 60
+
 
 class Client(object):
     def __init__(self, conn):
@@ -33,12 +41,69 @@ class Client(object):
         """
         Send an request and return the response.
         """
-        logger.debug("sending request: %s" % (request,))
-        ref_no = self._conn.send_request(request)
-        resp = self._wait_and_dequeue(ref_no)
+        ref_no = self.send(request)
+        resp = self.wait(ref_no)
         logger.debug("returning response for ref_no: %s" % (ref_no, ))
         return resp
 
+    def send(self, request):
+        """Send a request without waiting for the response. Returns the
+        ref-no to give to wait(). Several requests can be sent before
+        waiting for any of them, so that their round trips overlap.
+        """
+        logger.debug("sending request: %s" % (request,))
+        return self._conn.send_request(request)
+
+    def wait(self, ref_no):
+        """Wait for the response to a request sent with send(). Returns
+        the response or raises the error. Must be called once for each
+        sent request.
+        """
+        return self._wait_and_dequeue(ref_no)
+
+    def send_many(self, requests):
+        """Send several requests in one write, without waiting for the
+        responses. Returns a list of ref-nos to give to wait_many() (or
+        wait()).
+        """
+        logger.debug("sending %d requests" % (len(requests),))
+        return self._conn.send_requests(requests)
+
+    def wait_many(self, ref_nos, return_exceptions=False):
+        """Wait for the responses to several requests, in whatever order
+        they arrive. Returns a list of the responses in the order of
+        ref_nos.
+
+        @param return_exceptions: If true, errors are returned in the
+        list instead of raised. Otherwise the first error (in the order
+        of ref_nos) is raised, but only after all responses have been
+        received.
+        """
+        results = []
+        error = None
+        for ref_no in ref_nos:
+            try:
+                results.append(self._wait_and_dequeue(ref_no))
+            except Error as e:
+                if error is None:
+                    error = e
+                results.append(e)
+        if error is not None and not return_exceptions:
+            raise error
+        return results
+
+    def request_many(self, requests, return_exceptions=False):
+        """Send several requests in one write and return their
+        responses. The round trips overlap, instead of waiting for each
+        response before sending the next request. See wait_many() for
+        return_exceptions.
+        """
+        if len(requests) == 0:
+            return []
+        ref_nos = self.send_many(requests)
+        stats.set('clients.requests.pipelined.last', len(ref_nos), agg='sum')
+        return self.wait_many(ref_nos, return_exceptions)
+
     def set_async_handler(self, handler_func):
         """Set the async handler function.
 
@@ -98,7 +163,8 @@ class Client(object):
 #   - Person
 #   - TextStat 
 #   - Subjects
-#   No negative caching. No time-outs.
+#   No negative caching. Optional size limit (least recently used
+#   entries are evicted) and time-outs, per cache (see cache_options).
 #   Some automatic invalidation (if accept-async called appropriately).
 #
 # * Lookup function (conference/person name -> numbers)
@@ -106,8 +172,17 @@ class Client(object):
 #   numbers of all unread text in a conference for a person
 
 class CachingClient(object):
-    def __init__(self, client):
+    def __init__(self, client, cache_options=None):
+        """
+        @param cache_options: Dict from cache name ("UConference",
+        "Conference", "Person", "TextStat", "Membership" or
+        "ReadMembership") to a dict of keyword arguments for that
+        Cache, such as max_size and ttl. "ReadMembership" is the
+        current person's memberships with read ranges (in
+        CachingPersonClient), with ttl READ_MEMBERSHIP_TTL by default.
+        """
         self._client = client
+        self._cache_options = cache_options if cache_options is not None else {}
 
         # Caches
         #
@@ -121,10 +196,10 @@ class CachingClient(object):
         # could be dangerous. Sometime it is okay with cached
         # responses, and sometimes it is not. How can we make it
         # possible to force no cached?
-        self.uconferences = Cache(self._fetch_uconference, "UConference")
-        self.conferences = Cache(self._fetch_conference, "Conference")
-        self.persons = Cache(self._fetch_person, "Person")
-        self.textstats = Cache(self._fetch_textstat, "TextStat")
+        self.uconferences = self._create_cache(self._fetch_uconference, "UConference")
+        self.conferences = self._create_cache(self._fetch_conference, "Conference")
+        self.persons = self._create_cache(self._fetch_person, "Person")
+        self.textstats = self._create_cache(self._fetch_textstat, "TextStat")
 
         self._async_handlers = {}
         self._client.set_async_handler(self._handle_async_message)
@@ -147,6 +222,42 @@ class CachingClient(object):
     def request(self, request):
         return self._client.request(request)
 
+    def get_text_with_text_stat(self, text_no):
+        """Get the text stat (cached) and the contents of a text. If
+        the text stat is not cached, both requests are sent before
+        waiting for any of the responses, to save a round trip.
+
+        @return: A 2-tuple of the text stat and the text.
+        """
+        text_stat = self.textstats.get_cached(text_no)
+        if text_stat is not None:
+            return text_stat, self.request(requests.ReqGetText(text_no))
+
+        text_stat, text = self._client.request_many(
+            [ requests.ReqGetTextStat(text_no), requests.ReqGetText(text_no) ])
+        self.textstats[text_no] = text_stat
+        return text_stat, text
+
+    def get_text_stats(self, text_nos):
+        """Get the text stats for several texts. The ones that are not
+        cached are requested with pipelined requests.
+        """
+        text_stats = dict()
+        uncached = []
+        for text_no in text_nos:
+            text_stat = self.textstats.get_cached(text_no)
+            if text_stat is None:
+                uncached.append(text_no)
+            else:
+                text_stats[text_no] = text_stat
+        uncached = list(OrderedDict.fromkeys(uncached))
+        fetched = self._client.request_many(
+            [ requests.ReqGetTextStat(text_no) for text_no in uncached ])
+        for text_no, text_stat in zip(uncached, fetched):
+            self.textstats[text_no] = text_stat
+            text_stats[text_no] = text_stat
+        return [ text_stats[text_no] for text_no in text_nos ]
+
 
     # Async handling
 
@@ -238,6 +349,11 @@ class CachingClient(object):
 
 
     # Fetching functions (internal use)
+    def _create_cache(self, fetcher, name, **defaults):
+        options = dict(defaults)
+        options.update(self._cache_options.get(name, {}))
+        return Cache(fetcher, name, **options)
+
     def _fetch_uconference(self, no):
         return self.request(requests.ReqGetUconfStat(no))
 
@@ -366,8 +482,8 @@ class CachingClient(object):
 
 
 class CachingPersonClient(CachingClient):
-    def __init__(self, connection):
-        CachingClient.__init__(self, connection)
+    def __init__(self, connection, cache_options=None):
+        CachingClient.__init__(self, connection, cache_options)
 
 #    def connect(self, host, port = 4894, user = "", localbind=None):
 #        CachingClient.connect(self, host, port, user, localbind)
@@ -379,7 +495,14 @@ class CachingPersonClient(CachingClient):
         self._current_conference_no = 0
         
         # Caches
-        self._memberships = Cache(self._fetch_membership, "Membership")
+        self._memberships = self._create_cache(self._fetch_membership, "Membership")
+        # Memberships with read ranges (as utils.ReadRangeSet), which
+        # are updated when texts are marked as read or unread through
+        # this client, and invalidated by other requests that change
+        # read ranges. Texts marked as read by other sessions for the
+        # same person are not seen (no async messages), so they expire.
+        self._read_memberships = self._create_cache(
+            self._fetch_read_membership, "ReadMembership", ttl=READ_MEMBERSHIP_TTL)
         
         # Specific membership cache where the keys are the positions
         # in the membership list for the membership, and the values
@@ -392,8 +515,19 @@ class CachingPersonClient(CachingClient):
         # sending accept-async until the last call.
         self._add_async_handler(AsyncMessages.LEAVE_CONF, self._cpah_leave_conf)
         self._add_async_handler(AsyncMessages.NEW_MEMBERSHIP, self._cpah_new_membership)
+        self._add_async_handler(AsyncMessages.NEW_TEXT, self._cpah_new_text)
         self.request(requests.ReqAcceptAsync(list(self._async_handlers.keys())))
 
+    def request(self, request):
+        result = CachingClient.request(self, request)
+        # Requests that change read ranges, other than the ones sent
+        # by mark_as_read_local() and mark_as_unread_local() (which
+        # update the cached read ranges instead).
+        conf_no = utils.read_ranges_changed_by(request)
+        if conf_no is not None:
+            self._read_memberships.invalidate(conf_no)
+        return result
+
     def login(self, pers_no, password):
         self.request(requests.ReqLogin(pers_no, password, invisible=0))
         # We need to know the current person to be able to have and
@@ -406,6 +540,7 @@ class CachingPersonClient(CachingClient):
         self._pers_no = 0
         self._memberships_by_position = dict()
         self._memberships.invalidate_all()
+        self._read_memberships.invalidate_all()
 
     def get_person_no(self):
         return self._pers_no
@@ -427,15 +562,24 @@ class CachingPersonClient(CachingClient):
 
     def mark_as_read_local(self, conf_no, local_text_no):
         try:
-            self.request(requests.ReqMarkAsRead(conf_no, [local_text_no]))
+            CachingClient.request(self, requests.ReqMarkAsRead(conf_no, [local_text_no]))
         except NotMember:
-            pass
+            return
+        self._update_read_ranges(conf_no, lambda read_ranges: read_ranges.add(local_text_no))
 
     def mark_as_unread_local(self, conf_no, local_text_no):
         try:
-            self.request(requests.ReqMarkAsUnread(conf_no, local_text_no))
+            CachingClient.request(self, requests.ReqMarkAsUnread(conf_no, local_text_no))
         except NotMember:
-            pass
+            return
+        self._update_read_ranges(conf_no, lambda read_ranges: read_ranges.remove(local_text_no))
+
+    def _update_read_ranges(self, conf_no, update):
+        # Update the cached read ranges in place instead of fetching
+        # them again.
+        membership = self._read_memberships.get_cached(conf_no)
+        if membership is not None:
+            update(membership.read_ranges)
 
     def _get_cached_memberships_by_position(self, first, no_of_confs):
         # Return a list of the cached memberships if we have all of
@@ -454,6 +598,7 @@ class CachingPersonClient(CachingClient):
     
     def _invalidate_membership(self, conf_no):
         self._memberships.invalidate(conf_no)
+        self._read_memberships.invalidate(conf_no)
         # Since we only return anything from memberships_by_position
         # if all memberships are found, it means that we can make
         # partial invalidations.
@@ -491,6 +636,12 @@ class CachingPersonClient(CachingClient):
         """Get a membership for a person
         """
         if want_read_ranges:
+            if pers_no == self._pers_no:
+                # The cached membership is updated in place, so return
+                # a copy of it.
+                membership = copy.copy(self._read_memberships[conf_no])
+                membership.read_ranges = membership.read_ranges.copy()
+                return membership
             return self.request(requests.ReqQueryReadTexts(pers_no, conf_no, 1, 0))
         else:
             if pers_no == self._pers_no:
@@ -509,11 +660,20 @@ class CachingPersonClient(CachingClient):
         # for other persons. We also only cache memberships without
         # read ranges, because it is easier to invalidate correctly.
         return self.request(requests.ReqQueryReadTexts11(self._pers_no, conf_no, 0, 0))
+
+    def _fetch_read_membership(self, conf_no):
+        """Fetch the membership, with read ranges, for a conf for the
+        current person.
+        """
+        membership = self.request(requests.ReqQueryReadTexts11(self._pers_no, conf_no, 1, 0))
+        membership.read_ranges = utils.ReadRangeSet(membership.read_ranges)
+        return membership
     
     # Handlers for asynchronous messages (internal use)
     def _cpah_leave_conf(self, msg):
         # Invalidates cached membership
         self._memberships.invalidate(msg.conf_no)
+        self._read_memberships.invalidate(msg.conf_no)
         # We invalidate the entire memberships_by_position because you
         # can change position of memberships.
         self._memberships_by_position = dict()
@@ -525,28 +685,47 @@ class CachingPersonClient(CachingClient):
         # memberships, and because we get this async messages, we know
         # the current person was not a member before.
 
+    def _cpah_new_text(self, msg):
+        # The server marks a new text as read for its author in the
+        # recipients the author is a member of
+        if msg.text_stat.author == self._pers_no:
+            for rcpt in msg.text_stat.misc_info.recipient_list:
+                self._read_memberships.invalidate(rcpt.recpt)
+
     # Report cache usage
     def report_cache_usage(self):
         CachingClient.report_cache_usage(self)
         self._memberships.report()
+        self._read_memberships.report()
 
 
 # Cache class for use internally by CachingClient
 class Cache(object):
-    def __init__(self, fetcher, name = "Unknown"):
-        self.dict = {}
+    def __init__(self, fetcher, name = "Unknown", max_size=None, ttl=None):
+        """
+        @param max_size: Maximum number of cached objects, or None for
+        no limit. When full, the least recently used object is evicted.
+        @param ttl: Number of seconds an object is cached, or None for
+        no time-out.
+        """
+        self.dict = OrderedDict()
         self.fetcher = fetcher
         self.cached = 0
         self.uncached = 0
         self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expires = {} # Key to expiry time (if ttl is set)
+        self._clock = time.monotonic
 
     def __getitem__(self, no):
         #print('%s[%d]' % (self.name, no))
         stats.set('clients.cache.{}.gets.last'.format(self.name), 1, agg='sum')
-        if no in self.dict:
+        if no in self.dict and not self._expire(no):
             #print('%s[%d] - cached' % (self.name, no))
             self.cached = self.cached + 1
             stats.set('clients.cache.{}.gets.hits.last'.format(self.name), 1, agg='sum')
+            self.dict.move_to_end(no)
             return self.dict[no]
         else:
             #print('%s[%d] - not cached' % (self.name, no))
@@ -557,15 +736,41 @@ class Cache(object):
 
     def __setitem__(self, no, val):
         self.dict[no] = val
+        self.dict.move_to_end(no)
+        if self.ttl is not None:
+            self._expires[no] = self._clock() + self.ttl
         stats.set('clients.cache.{}.sets.last'.format(self.name), 1, agg='sum')
+        if self.max_size is not None:
+            while len(self.dict) > self.max_size:
+                evicted, _ = self.dict.popitem(last=False)
+                self._expires.pop(evicted, None)
+                stats.set('clients.cache.{}.evictions.last'.format(self.name), 1, agg='sum')
+
+    def _expire(self, no):
+        # Remove the object if it has timed out. Returns True if it was removed.
+        if self.ttl is None or self._expires[no] > self._clock():
+            return False
+        del self.dict[no]
+        del self._expires[no]
+        stats.set('clients.cache.{}.expirations.last'.format(self.name), 1, agg='sum')
+        return True
+
+    def get_cached(self, no):
+        """Return the cached object for no, or None if it is not
+        cached (without fetching it)."""
+        if no in self.dict and not self._expire(no):
+            return self.dict[no]
+        return None
 
     def invalidate(self, no):
         if no in self.dict:
             del self.dict[no]
+            self._expires.pop(no, None)
             stats.set('clients.cache.{}.invalidations.last'.format(self.name), 1, agg='sum')
 
     def invalidate_all(self):
-        self.dict = dict()
+        self.dict = OrderedDict()
+        self._expires = {}
         stats.set('clients.cache.{}.invalidate-alls.last'.format(self.name), 1, agg='sum')
 
     def report(self):
@@ -18,6 +18,7 @@ from .errors import (
     UnimplementedAsync)
 
 from .protocol import (
+    BaseReceiveBuffer,
     to_hstring,
     read_first_non_ws,
     read_int)
@@ -27,49 +28,71 @@ from .asyncmsg import async_dict
 from .stats import stats
 
 
-class ReceiveBuffer(object):
-    def __init__(self, socket):
+# Initial size of the receive buffer. It grows when a single string
+# that is larger than this is received.
+RECEIVE_BUFFER_SIZE = 64 * 1024
+
+
+class ReceiveBuffer(BaseReceiveBuffer):
+    def __init__(self, socket, size=RECEIVE_BUFFER_SIZE):
         self._socket = socket
 
         # Receive buffer
-        self._rb = b""    # Buffer for data received from connection
-        self._rb_len = 0 # Length of the buffer
+        self._rb_size = size # Preferred size of the buffer
+        self._rb = bytearray(size) # Buffer for data received from connection
+        self._rb_len = 0 # Number of bytes of received data in the buffer
         self._rb_pos = 0 # Position of first unread byte in buffer
 
     def receive_string(self, length):
         """Get a string from the receive buffer (receiving more if
         necessary).
         """
-        self._ensure_receive_buffer_size(length)
-        res = self._rb[self._rb_pos:self._rb_pos+length]
+        if self._rb_len - self._rb_pos < length:
+            self._ensure_receive_buffer_size(length)
+        with memoryview(self._rb) as mv:
+            res = mv[self._rb_pos:self._rb_pos+length].tobytes()
         self._rb_pos = self._rb_pos + length
         return res
 
-    def receive_char(self):
-        """Get a character from the receive buffer (receiving more if
-        necessary).
+    def receive_byte(self):
+        """Get a character as an int from the receive buffer
+        (receiving more if necessary).
         """
-        # FIXME: Optimize for speed
-        self._ensure_receive_buffer_size(1)
-        res = self._rb[self._rb_pos:self._rb_pos+1]
+        if self._rb_pos >= self._rb_len:
+            self._ensure_receive_buffer_size(1)
+        res = self._rb[self._rb_pos]
         self._rb_pos = self._rb_pos + 1
         return res
 
+    def _receive_more(self):
+        self._ensure_receive_buffer_size(self._rb_len - self._rb_pos + 1)
+
     def _ensure_receive_buffer_size(self, size):
         """Ensure that there are at least N bytes in the receive
         buffer."""
-        # FIXME: Rewrite for speed and clarity
         present = self._rb_len - self._rb_pos
-        while present < size:
-            needed = size - present
-            wanted = max(needed, 128) # FIXME: Optimize
-            data = self._socket.recv(wanted)
-            if len(data) == 0:
-                raise ReceiveError()
-            self._rb = self._rb[self._rb_pos:] + data
-            self._rb_pos = 0
-            self._rb_len = len(self._rb)
-            present = self._rb_len
+        if present >= size:
+            return
+
+        capacity = max(size, self._rb_size)
+        if len(self._rb) < size or len(self._rb) > 4 * capacity:
+            # Grow to fit the wanted data, or shrink back after having
+            # received something very large.
+            rb = bytearray(capacity)
+            rb[:present] = self._rb[self._rb_pos:self._rb_len]
+            self._rb = rb
+        elif self._rb_pos > 0:
+            # Compact: move the unread data to the start of the buffer
+            self._rb[:present] = self._rb[self._rb_pos:self._rb_len]
+        self._rb_pos = 0
+        self._rb_len = present
+
+        with memoryview(self._rb) as mv:
+            while self._rb_len < size:
+                received = self._socket.recv_into(mv[self._rb_len:])
+                if received == 0:
+                    raise ReceiveError()
+                self._rb_len += received
 
 
 class Connection(object):
@@ -103,6 +126,24 @@ class Connection(object):
             stats.set('connections.requests.sent.last', 1, agg='sum')
         return ref_no
 
+    def send_requests(self, reqs):
+        """Send several requests with one write. Returns a list of
+        their ref-nos."""
+        with self._lock:
+            ref_nos = []
+            request_strings = []
+            for req in reqs:
+                self._ref_no += 1
+                ref_no = self._ref_no
+                assert ref_no not in self._outstanding_requests
+                request_strings.append(b"%d %s" % (ref_no, req.to_string()))
+                ref_nos.append(ref_no)
+            self._send_string(b"".join(request_strings))
+            for ref_no, req in zip(ref_nos, reqs):
+                self._outstanding_requests[ref_no] = req
+            stats.set('connections.requests.sent.last', len(ref_nos), agg='sum')
+        return ref_nos
+
     def read_response(self):
         with self._lock:
             ref_no, resp, error = self._parse_response()
@@ -9,10 +9,13 @@ import calendar
 from typing import Optional
 
 from .protocol import (
+    ORD_0,
     to_hstring,
     read_first_non_ws,
-    read_int_and_next,
+    read_hollerith_length,
     read_int,
+    read_ints,
+    read_word,
     read_float)
 
 from .errors import (
@@ -73,9 +76,7 @@ class String(bytes):
     @classmethod
     def parse(cls, buf):
         # Parse a string (Hollerith notation)
-        (length, h) = read_int_and_next(buf)
-        if h != b"H":
-            raise ProtocolError()
+        length = read_hollerith_length(buf)
         return cls(buf.receive_string(length))
 
     def to_string(self):
@@ -189,9 +190,13 @@ class Array(list):
             return obj
         elif left != b"{":
             raise ProtocolError()
-        for i in range(0, length):
-            el = cls.ELEMENT_CLASS.parse(buf)
-            obj.append(el)
+        if issubclass(cls.ELEMENT_CLASS, Int):
+            # Read all integers at once
+            list.extend(obj, map(cls.ELEMENT_CLASS, read_ints(buf, length)))
+        else:
+            for i in range(0, length):
+                el = cls.ELEMENT_CLASS.parse(buf)
+                obj.append(el)
         right = read_first_non_ws(buf)
         if right != b"}":
             raise ProtocolError()
@@ -243,18 +248,10 @@ class Bitstring(list):
 
     @classmethod
     def parse(cls, buf):
-        obj = cls()
-        length = cls.LENGTH
-        char = read_first_non_ws(buf)
-        for i in range(0, length):
-            if char == b"0":
-                obj[i] = 0
-            elif char == b"1":
-                obj[i] = 1
-            else:
-                raise ProtocolError()
-            char = buf.receive_char()
-        return obj
+        word = read_word(buf)
+        if len(word) != cls.LENGTH or word.strip(b"01"):
+            raise ProtocolError()
+        return cls([ c - ORD_0 for c in word ])
 
     def to_string(self):
         self._validate_bitstring()
@@ -328,15 +325,8 @@ class Time(object):
     @classmethod
     def parse(cls, buf):
         obj = cls()
-        obj.seconds = Int32.parse(buf)
-        obj.minutes = Int32.parse(buf)
-        obj.hours = Int32.parse(buf)
-        obj.day = Int32.parse(buf)
-        obj.month = Int32.parse(buf)
-        obj.year = Int32.parse(buf)
-        obj.day_of_week = Int32.parse(buf)
-        obj.day_of_year = Int32.parse(buf)
-        obj.is_dst = Bool.parse(buf)
+        (obj.seconds, obj.minutes, obj.hours, obj.day, obj.month, obj.year,
+         obj.day_of_week, obj.day_of_year, obj.is_dst) = read_ints(buf, 9)
         return obj
 
     def __repr__(self):
@@ -628,9 +618,7 @@ class AuxItem(object):
     @classmethod
     def parse(cls, buf):
         obj = cls()
-        obj.aux_no = AuxNo.parse(buf)
-        obj.tag = Int32.parse(buf)
-        obj.creator = PersNo.parse(buf)
+        (obj.aux_no, obj.tag, obj.creator) = read_ints(buf, 3)
         obj.created_at = Time.parse(buf)
         obj.flags = AuxItemFlags.parse(buf)
         obj.inherit_limit = Int32.parse(buf)
@@ -729,10 +717,8 @@ class TextStat(object):
     def parse(cls, buf, old_format=0):
         obj = cls()
         obj.creation_time = Time.parse(buf)
-        obj.author = PersNo.parse(buf)
-        obj.no_of_lines = Int32.parse(buf)
-        obj.no_of_chars = Int32.parse(buf)
-        obj.no_of_marks = Int16.parse(buf)
+        (obj.author, obj.no_of_lines, obj.no_of_chars,
+         obj.no_of_marks) = read_ints(buf, 4)
         obj.misc_info = CookedMiscInfo.parse(buf)
         if old_format:
             obj.aux_items = []
@@ -143,3 +143,4 @@ class ProtocolError(LocalError): pass # E.g. unexpected response
 class UnimplementedAsync(LocalError): pass # Unknown asynchronous message
 class ReceiveError(LocalError): pass # Error reading data from the server
 class NotEnoughDataInBufferError(LocalError): pass # Not enough data in buffer
+class RequestTimeout(LocalError): pass # No reply from the server in time
@@ -190,11 +190,14 @@ class KomMembership:
 
 class KomText:
     def __init__(self, text_no=None, text: str = None, *,
-                 text_stat: TextStat = None, aux_items: List[KomAuxItem] = None, author: KomPersonName = None):
+                 text_stat: TextStat = None, aux_items: List[KomAuxItem] = None, author: KomPersonName = None,
+                 truncated=False):
         self.text_no = text_no
         self.text = text
         self.aux_items = aux_items
         self.author = author
+        # True if text is only the beginning of the text
+        self.truncated = truncated
 
         if text_stat is None:
             self.content_type = None
@@ -347,12 +350,12 @@ class KomServerInfo:
         self.motd_of_lyskom = motd_of_lyskom
 
 
-def create_client(host, port, user):
+def create_client(host, port, user, cache_options=None):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((host, port))
     conn = Connection(s, user)
     client = Client(conn)
-    return CachingPersonClient(client)
+    return CachingPersonClient(client, cache_options)
 
 
 def check_connection(f):
@@ -678,8 +681,7 @@ class KomSession(object):
 
     @check_connection
     def get_text(self, text_no) -> KomText:
-        text_stat = self._get_text_stat(text_no)
-        text = self._client.request(requests.ReqGetText(text_no))
+        text_stat, text = self._client.get_text_with_text_stat(text_no)
         return self._get_komtext(text_no=text_no, text=text, text_stat=text_stat)
 
     # TODO: offset/start number, so we can paginate. we probably need
@@ -692,8 +694,10 @@ class KomSession(object):
         #local_no_ceiling = 0 # means the higest numbered texts (i.e. the last)
         text_mapping = self._client.request(
             requests.ReqLocalToGlobalReverse(conf_no, 0, no_of_texts))
-        texts = [ self._get_komtext(text_no=m[1], text=None, text_stat=self._client.textstats[m[1]])
-                  for m in text_mapping.list if m[1] != 0 ]
+        text_nos = [ m[1] for m in text_mapping.list if m[1] != 0 ]
+        text_stats = self._client.get_text_stats(text_nos)
+        texts = [ self._get_komtext(text_no=text_no, text=None, text_stat=text_stat)
+                  for text_no, text_stat in zip(text_nos, text_stats) ]
         texts.reverse()
         return texts
 
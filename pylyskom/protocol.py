@@ -6,37 +6,139 @@
 
 
 from __future__ import absolute_import
+import re
 import six
 
+from .errors import ProtocolError
+
 WHITESPACE = bytearray(b" \t\r\n")
 DIGITS = bytearray(b"01234567890")
 FLOAT_CHARS = DIGITS + bytearray(b"eE.-+")
 
 ORD_0 = ord("0")
 
+# Single byte strings for all byte values, so that characters read as
+# ints can be returned as bytes without creating new objects.
+BYTES = [ bytes((i,)) for i in range(256) ]
+
 MAX_TEXT_SIZE = int(2**31-1)
 
 
+# Token patterns used by the receive buffers. An integer is (like in
+# the old character based reader) ended by, and consumes, any
+# non-digit character. The lookahead makes sure that all whitespace is
+# skipped, instead of backtracking into it when we have not received
+# the rest of the token yet.
+_NON_WS_RE = re.compile(rb"[ \t\r\n]*([^ \t\r\n])")
+_INT_RE = re.compile(rb"[ \t\r\n]*(?![ \t\r\n])([0-9]*)([^0-9])")
+_WORD_RE = re.compile(rb"[ \t\r\n]*([^ \t\r\n]+)[ \t\r\n]")
+
+# Patterns for reading a number of whitespace separated integers in
+# one match, by the number of integers.
+_INTS_RES = {}
+
+def _ints_re(count):
+    regexp = _INTS_RES.get(count)
+    if regexp is None:
+        regexp = re.compile(rb"(?:[ \t\r\n]*[0-9]+[ \t\r\n]){%d}" % (count,))
+        _INTS_RES[count] = regexp
+    return regexp
+
+
+class BaseReceiveBuffer(object):
+    """Token level reading, shared by the receive buffers.
+
+    Subclasses keep the received data in self._rb, with the unread
+    data between self._rb_pos and self._rb_len. They implement
+    receive_string(), receive_byte() and _receive_more(). The latter
+    should make more data available in the buffer, or raise if that
+    is not possible.
+
+    The tokens are scanned directly in the buffer with precompiled
+    regular expressions, instead of reading them one character at a
+    time.
+    """
+
+    def _match(self, regexp):
+        m = regexp.match(self._rb, self._rb_pos, self._rb_len)
+        while m is None:
+            self._receive_more()
+            m = regexp.match(self._rb, self._rb_pos, self._rb_len)
+        self._rb_pos = m.end()
+        return m
+
+    def receive_char(self):
+        """Get a character from the receive buffer."""
+        return BYTES[self.receive_byte()]
+
+    def read_first_non_ws(self):
+        """Skip whitespace and return first non-ws character"""
+        m = self._match(_NON_WS_RE)
+        return BYTES[self._rb[m.start(1)]]
+
+    def read_int_and_next(self):
+        """Get an integer and next character from the receive buffer."""
+        m = self._match(_INT_RE)
+        return (int(m.group(1) or 0), BYTES[self._rb[m.start(2)]])
+
+    def read_int(self):
+        """Get an integer from the receive buffer (discard next
+        character)"""
+        m = _INT_RE.match(self._rb, self._rb_pos, self._rb_len)
+        if m is None:
+            m = self._match(_INT_RE)
+        else:
+            self._rb_pos = m.end()
+        return int(m.group(1) or 0)
+
+    def read_ints(self, count):
+        """Get a list of count integers from the receive buffer."""
+        m = _ints_re(count).match(self._rb, self._rb_pos, self._rb_len)
+        if m is None:
+            # Not all of them received yet, or not separated by
+            # whitespace. Take them one at a time.
+            read_int = self.read_int
+            return [ read_int() for i in range(count) ]
+        self._rb_pos = m.end()
+        return list(map(int, m.group().split()))
+
+    def read_word(self):
+        """Get the next whitespace delimited word from the receive
+        buffer (discard the whitespace after it)."""
+        return bytes(self._match(_WORD_RE).group(1))
+
+    def read_hollerith_length(self):
+        """Get the length of a Hollerith string, leaving the buffer at
+        the start of the string contents."""
+        (length, h) = self.read_int_and_next()
+        if h != b"H":
+            raise ProtocolError()
+        return length
+
+
 def read_first_non_ws(buf):
     """Skip whitespace and return first non-ws character"""
-    c = buf.receive_char()
-    while c in WHITESPACE:
-        c = buf.receive_char()
-    return c
+    return buf.read_first_non_ws()
 
 def read_int_and_next(buf):
     """Get an integer and next character from the receive buffer."""
-    c = read_first_non_ws(buf)
-    n = 0
-    while c in DIGITS:
-        n = n * 10 + (ord(c) - ORD_0)
-        c = buf.receive_char()
-    return (n, c)
+    return buf.read_int_and_next()
 
 def read_int(buf):
     """Get an integer from the receive buffer (discard next character)"""
-    (c, n) = read_int_and_next(buf)
-    return c
+    return buf.read_int()
+
+def read_ints(buf, count):
+    """Get a list of count integers from the receive buffer."""
+    return buf.read_ints(count)
+
+def read_word(buf):
+    """Get the next whitespace delimited word from the receive buffer."""
+    return buf.read_word()
+
+def read_hollerith_length(buf):
+    """Get the length of a Hollerith string from the receive buffer."""
+    return buf.read_hollerith_length()
 
 def read_float(buf):
     # Get a float from the receive buffer (discard next character)
@@ -48,6 +150,79 @@ def read_float(buf):
     return float(b"".join(digs))
 
 
+# A message from the server ends with a linefeed. Linefeeds can also
+# occur inside Hollerith strings, so the contents of those must be
+# skipped when looking for the end of a message.
+_MESSAGE_END_RE = re.compile(rb"([0-9]+)H|\n")
+
+
+class MessageScanner(object):
+    """Incremental scanner that finds the end of a server message
+    without parsing it.
+
+    The scan state is kept between calls to scan(), so data can be
+    scanned as it arrives and each byte is only looked at once, no
+    matter how many reads a large message needs. Offsets are relative
+    to the start of the message, so the buffer may be compacted
+    between calls as long as the message itself is kept.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._offset = 0 # Next offset to scan, relative to message start
+        self._hollerith_left = 0 # Bytes left of the current Hollerith string
+
+    def at_start(self):
+        """Returns True if nothing of the current message has been scanned."""
+        return self._offset == 0 and self._hollerith_left == 0
+
+    def hollerith_left(self):
+        """Number of bytes that are still needed to complete the
+        Hollerith string currently being scanned."""
+        return self._hollerith_left
+
+    def scan(self, data, start, end):
+        """Scan data[start:end] for the end of the message that starts
+        at start.
+
+        @return: The offset (relative to start) just after the
+        terminating linefeed, or None if the message is not complete
+        yet.
+        """
+        pos = start + self._offset
+        while True:
+            if self._hollerith_left > 0:
+                skip = min(self._hollerith_left, end - pos)
+                pos += skip
+                self._hollerith_left -= skip
+                if self._hollerith_left > 0:
+                    break
+
+            m = _MESSAGE_END_RE.search(data, pos, end)
+            if m is None:
+                # Don't resume in the middle of a number next time,
+                # because it might be the length of a Hollerith string
+                # that continues in data we have not received yet.
+                resume = end
+                while resume > pos and data[resume-1] in DIGITS:
+                    resume -= 1
+                pos = resume
+                break
+
+            if m.group(1) is None:
+                # Linefeed, end of message
+                self.reset()
+                return m.end() - start
+
+            self._hollerith_left = int(m.group(1))
+            pos = m.end()
+
+        self._offset = pos - start
+        return None
+
+
 def to_hstring(s):
     """To hollerith byte string
     """
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import
+from array import array
+from bisect import bisect_left, bisect_right
 import six
 
 from . import mimeparse
+from .datatypes import ReadRange
+from .requests import Requests
 from .errors import Error
 from .protocol import WHITESPACE, DIGITS, ORD_0, to_hstring
 
@@ -24,6 +28,28 @@ def decode_text(text, encoding, backup_encoding='latin1'):
     
     return decoded_text
 
+def cut_incomplete_utf8(data):
+    """Remove an incomplete UTF-8 sequence from the end of data, such
+    as when a text has been cut at an arbitrary byte.
+    """
+    for i in range(1, min(4, len(data)) + 1):
+        c = data[-i]
+        if c & 0xc0 == 0x80:
+            # Continuation byte, keep looking for the start byte
+            continue
+        if c >= 0xf0:
+            length = 4
+        elif c >= 0xe0:
+            length = 3
+        elif c >= 0xc0:
+            length = 2
+        else:
+            length = 1
+        if length > i:
+            return data[:-i]
+        break
+    return data
+
 def parse_content_type(contenttype):
     try:
         mime_type = mimeparse.parse_mime_type(contenttype)
@@ -178,6 +204,8 @@ def read_ranges_to_gaps_and_last(read_ranges):
     each gap in the read ranges, where each tuple is the first
     unread text in the gap and the length of the gap.
     """
+    if isinstance(read_ranges, ReadRangeSet):
+        return read_ranges.gaps_and_last()
     gaps = []
     last = 1
     for read_range in read_ranges:
@@ -187,3 +215,256 @@ def read_ranges_to_gaps_and_last(read_ranges):
         last = read_range.last_read + 1
     return gaps, last
 
+
+def count_unread_texts(read_ranges, highest_local_no):
+    """Count the local text numbers up to highest_local_no that are
+    not in read_ranges. This is the number of unread texts if no texts
+    have been deleted, and an upper bound otherwise.
+    """
+    unread = highest_local_no
+    for read_range in read_ranges:
+        first = max(read_range.first_read, 1)
+        last = min(read_range.last_read, highest_local_no)
+        if last >= first:
+            unread -= last - first + 1
+    return max(unread, 0)
+
+
+class LocalToGlobalIndex(object):
+    """The known part of the local to global text number mapping of a
+    conference.
+
+    The index covers the local numbers from begin up to (but not
+    including) end, with the global numbers in an array (0 for local
+    numbers without a text). If complete is True, there are no texts
+    with local numbers from end and on, as far as we know.
+    """
+
+    def __init__(self):
+        self.begin = 1
+        self.end = 1
+        self.complete = False
+        self._text_nos = array('L')
+
+    def __len__(self):
+        return self.end - self.begin
+
+    def add_mapping(self, begin, end, pairs, later_texts_exists):
+        """Add the local to global mapping of the local numbers from
+        begin up to end, as (local, global) pairs. later_texts_exists
+        tells if there are texts from end and on.
+
+        If the mapping is not adjacent to what we know, the part that
+        goes further towards the end of the conference is kept.
+        """
+        text_nos = array('L', bytes(array('L').itemsize * (end - begin)))
+        for local_no, text_no in pairs:
+            if begin <= local_no < end:
+                text_nos[local_no - begin] = text_no
+        if begin > self.end or end < self.begin or len(self) == 0:
+            if len(self) > 0 and end <= self.end:
+                return
+            self.begin = begin
+            self.end = end
+            self._text_nos = text_nos
+            self.complete = not later_texts_exists
+            return
+        if end >= self.end:
+            self.complete = not later_texts_exists
+        start = max(begin, self.begin)
+        self._text_nos[start - self.begin:min(end, self.end) - self.begin] = \
+            text_nos[start - begin:min(end, self.end) - begin]
+        if end > self.end:
+            self._text_nos.extend(text_nos[self.end - begin:])
+            self.end = end
+        if begin < self.begin:
+            self._text_nos[0:0] = text_nos[:self.begin - begin]
+            self.begin = begin
+
+    def lookup(self, begin, end):
+        """Return the (local, global) pairs for the texts with local
+        numbers from begin up to end, or None if the index does not
+        cover all of them."""
+        if begin < self.begin or (end > self.end and not self.complete):
+            return None
+        text_nos = self._text_nos
+        return [ (local_no, text_nos[local_no - self.begin])
+                 for local_no in range(begin, min(end, self.end))
+                 if text_nos[local_no - self.begin] != 0 ]
+
+    def last_texts(self, no_of_texts):
+        """Return the (local, global) pairs of the last no_of_texts
+        texts, in local number order, or None if the index does not
+        know which they are."""
+        if not self.complete:
+            return None
+        pairs = []
+        text_nos = self._text_nos
+        for i in range(len(text_nos) - 1, -1, -1):
+            if len(pairs) == no_of_texts:
+                break
+            if text_nos[i] != 0:
+                pairs.append((self.begin + i, text_nos[i]))
+        if len(pairs) < no_of_texts and self.begin > 1:
+            return None
+        pairs.reverse()
+        return pairs
+
+    def add_text(self, local_no, text_no):
+        """A new text with local number local_no. It is only added if it
+        is adjacent to what we know."""
+        if local_no < self.begin:
+            return
+        if local_no < self.end:
+            self._text_nos[local_no - self.begin] = text_no
+        elif self.complete:
+            self._text_nos.extend(array('L', bytes(array('L').itemsize * (local_no - self.end))))
+            self._text_nos.append(text_no)
+            self.end = local_no + 1
+
+    def remove_text(self, text_no, local_no=None):
+        """A text is no longer in the conference."""
+        if local_no is None:
+            try:
+                i = self._text_nos.index(text_no)
+            except ValueError:
+                return
+        elif self.begin <= local_no < self.end:
+            i = local_no - self.begin
+        else:
+            return
+        if self._text_nos[i] == text_no:
+            self._text_nos[i] = 0
+
+    def set_incomplete(self):
+        """There might be texts after end that we don't know the local
+        numbers of."""
+        self.complete = False
+
+
+# Requests that change the read ranges of a membership. The conference
+# is the first argument of all of them.
+READ_RANGES_CALL_NOS = frozenset([
+    Requests.MARK_AS_READ,
+    Requests.MARK_AS_UNREAD,
+    Requests.SET_UNREAD,
+    Requests.SET_LAST_READ,
+    Requests.SET_READ_RANGES,
+])
+
+def read_ranges_changed_by(request):
+    """Return the conference whose read ranges request (a Request, or
+    bytes for a raw request) changes, or None if it does not change
+    any read ranges."""
+    if isinstance(request, bytes):
+        args = request.split()
+        if len(args) > 1 and int(args[0]) in READ_RANGES_CALL_NOS:
+            return int(args[1])
+        return None
+    if request.CALL_NO in READ_RANGES_CALL_NOS:
+        return getattr(request, request.ARGS[0].name)
+    return None
+
+
+class ReadRangeSet(object):
+    """Sorted set of read local text numbers.
+
+    The numbers are kept as disjoint, non-adjacent ranges in two
+    parallel arrays with the first and last local number of each
+    range, so lookups and updates are binary searches. Iterating over
+    the set gives ReadRange objects, so it can be used where a list
+    of read ranges is expected.
+    """
+
+    def __init__(self, read_ranges=()):
+        self._firsts = array('L')
+        self._lasts = array('L')
+        for read_range in read_ranges:
+            first = max(read_range.first_read, 1)
+            if read_range.last_read >= first:
+                self.add_range(first, read_range.last_read)
+
+    def __len__(self):
+        """Number of ranges."""
+        return len(self._firsts)
+
+    def __eq__(self, other):
+        if isinstance(other, ReadRangeSet):
+            return self._firsts == other._firsts and self._lasts == other._lasts
+        return NotImplemented
+
+    def __repr__(self):
+        return "ReadRangeSet([{}])".format(", ".join(
+            "ReadRange({}, {})".format(first, last)
+            for first, last in zip(self._firsts, self._lasts)))
+
+    def copy(self):
+        read_ranges = ReadRangeSet()
+        read_ranges._firsts = array('L', self._firsts)
+        read_ranges._lasts = array('L', self._lasts)
+        return read_ranges
+
+    def __iter__(self):
+        for first, last in zip(self._firsts, self._lasts):
+            yield ReadRange(first, last)
+
+    def __contains__(self, local_no):
+        i = bisect_right(self._firsts, local_no) - 1
+        return i >= 0 and self._lasts[i] >= local_no
+
+    def add(self, local_no):
+        self.add_range(local_no, local_no)
+
+    def add_range(self, first, last):
+        """Add the local numbers from first to last (inclusive)."""
+        # Ranges i to j-1 overlap or are adjacent to first-last
+        i = bisect_left(self._lasts, first - 1)
+        j = bisect_right(self._firsts, last + 1)
+        if i < j:
+            first = min(first, self._firsts[i])
+            last = max(last, self._lasts[j - 1])
+        self._firsts[i:j] = array('L', [first])
+        self._lasts[i:j] = array('L', [last])
+
+    def remove(self, local_no):
+        """Remove local_no from the set. Returns False if it was not in
+        the set."""
+        i = bisect_right(self._firsts, local_no) - 1
+        if i < 0 or self._lasts[i] < local_no:
+            return False
+        first, last = self._firsts[i], self._lasts[i]
+        if first == last:
+            del self._firsts[i]
+            del self._lasts[i]
+        elif first == local_no:
+            self._firsts[i] = local_no + 1
+        elif last == local_no:
+            self._lasts[i] = local_no - 1
+        else:
+            self._lasts[i] = local_no - 1
+            self._firsts.insert(i + 1, local_no + 1)
+            self._lasts.insert(i + 1, last)
+        return True
+
+    def gaps(self, first=1, end=None):
+        """Iterate over the gaps between the ranges, from local number
+        first up to (but not including) end, as (first unread, length)
+        tuples like in read_ranges_to_gaps_and_last(). If end is None,
+        the gaps up to the last range are included."""
+        firsts, lasts = self._firsts, self._lasts
+        i = bisect_left(lasts, first)
+        while i < len(firsts):
+            gap_end = firsts[i] if end is None else min(firsts[i], end)
+            if gap_end > first:
+                yield (first, gap_end - first)
+            first = max(first, lasts[i] + 1)
+            if end is not None and first >= end:
+                return
+            i += 1
+        if end is not None and end > first:
+            yield (first, end - first)
+
+    def gaps_and_last(self):
+        """Same as read_ranges_to_gaps_and_last() for the set."""
+        last = self._lasts[-1] + 1 if len(self._lasts) > 0 else 1
+        return list(self.gaps()), last
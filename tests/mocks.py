@@ -1,6 +1,9 @@
+import asyncio
+
 from pylyskom import requests
 from pylyskom.datatypes import CookedMiscInfo
 from pylyskom.cachedconnection import Cache
+from pylyskom.aio import AioCache
 
 
 class MockTextStat(object):
@@ -16,6 +19,13 @@ class MockTextStat(object):
         self.aux_items = []
 
 
+class MockUConference(object):
+    """Mock of UConference datatype
+    """
+    def __init__(self, name=b""):
+        self.name = name
+
+
 class MockPerson(object):
     """Mock of Person data type
     """
@@ -71,6 +81,9 @@ class MockConnection(object):
             # Default is to return None
             return None
 
+    def get_text_with_text_stat(self, text_no):
+        return self.textstats[text_no], self.request(requests.ReqGetText(text_no))
+
     def mock_request(self, request_no, func):
         if func is None:
             raise Exception("Mocked request function is None")
@@ -87,6 +100,94 @@ class MockConnection(object):
         return ""
 
 
+class MockAioClient(object):
+    """Mock of aio.AioCachingPersonClient, with the mocking API of
+    MockConnection. The mocked request functions are not async.
+    """
+    def __init__(self):
+        self.connection = MockConnection()
+        self.textstats = AioCache(self.fetch_textstat, "TextStat")
+        self.uconferences = AioCache(self.fetch_uconference, "UConference")
+
+    async def fetch_textstat(self, no, priority=None):
+        return await self.request(requests.ReqGetTextStat(no))
+
+    async def fetch_uconference(self, no, priority=None):
+        return await self.request(requests.ReqGetUconfStat(no))
+
+    def is_connected(self):
+        return True
+
+    async def close(self):
+        pass
+
+    async def request(self, request, **kwargs):
+        return self.connection.request(request)
+
+    async def get_last_text_mappings(self, conf_no, no_of_texts):
+        mapping = await self.request(requests.ReqLocalToGlobalReverse(conf_no, 0, no_of_texts))
+        return [ e for e in mapping.list if e[1] != 0 ]
+
+    def mock_request(self, request_no, func):
+        self.connection.mock_request(request_no, func)
+
+    def mock_get_request_calls(self, request_no=None):
+        return self.connection.mock_get_request_calls(request_no)
+
+
+class MockAioConnection(object):
+    """Mock of aio.AioConnection. Each request is answered (with the
+    request as ok reply) when it is passed to reply(), in any order.
+    """
+    def __init__(self):
+        self.sent = [] # (ref_no, request)
+        self._ref_no = 0
+        self._responses = asyncio.Queue()
+        self._connected = False
+        # If not None, drain_if_needed() waits for this event, like
+        # when the write buffer is full.
+        self.drained = None
+
+    async def connect(self, host, port, user=None):
+        self._connected = True
+
+    def is_connected(self):
+        return self._connected
+
+    async def close(self):
+        self._connected = False
+
+    async def send_request(self, request):
+        ref_no = self.queue_request(request)
+        await self.drain_if_needed()
+        return ref_no
+
+    def queue_request(self, request):
+        self._ref_no += 1
+        self.sent.append((self._ref_no, request))
+        return self._ref_no
+
+    async def drain_if_needed(self):
+        if self.drained is not None:
+            await self.drained.wait()
+
+    async def read_response(self):
+        response = await self._responses.get()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def reply(self, ref_no, ok_reply=None, error_reply=None):
+        self._responses.put_nowait((ref_no, ok_reply, error_reply, None, None))
+
+    def reply_async_message(self, msg):
+        self._responses.put_nowait((None, None, None, msg, None))
+
+    def fail(self, error):
+        """Make read_response() raise error."""
+        self._responses.put_nowait(error)
+
+
 class MockSocket():
     def __init__(self, recv_data=None):
         self.send_data = b""
@@ -111,5 +212,66 @@ class MockSocket():
         assert isinstance(r, bytes)
         return r
 
+    def recv_into(self, buffer, nbytes=0):
+        if nbytes == 0:
+            nbytes = len(buffer)
+        r = self.recv(nbytes)
+        buffer[:len(r)] = r
+        return len(r)
+
     def close(self):
         pass
+
+
+class MockTransport():
+    """Mock of asyncio.Transport. The written data is collected in
+    data. If there is a protocol, closing the transport tells it that
+    the connection is lost.
+    """
+    def __init__(self, protocol=None):
+        self.write_buffer_size = 0
+        self.data = b""
+        self.writes = 0
+        self.protocol = protocol
+        self.reading = True
+
+    def get_write_buffer_size(self):
+        return self.write_buffer_size
+
+    def write(self, data):
+        assert isinstance(data, bytes)
+        self.data += data
+        self.writes += 1
+
+    def pause_reading(self):
+        assert self.reading
+        self.reading = False
+
+    def resume_reading(self):
+        assert not self.reading
+        self.reading = True
+
+    def close(self):
+        if self.protocol is not None:
+            self.protocol.connection_lost(None)
+            self.protocol = None
+
+
+class MockStreamWriter():
+    """Mock of asyncio.StreamWriter, that writes to a MockTransport.
+    """
+    def __init__(self):
+        self.drains = 0
+        self.transport = MockTransport()
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        self.drains += 1
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
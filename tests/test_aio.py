@@ -0,0 +1,1522 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import errno
+import functools
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from .mocks import (
+    MockAioClient, MockAioConnection, MockStreamWriter, MockTextStat, MockTransport, MockUConference)
+
+from pylyskom import komauxitems, utils
+from pylyskom.aio import (
+    PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, READ_MEMBERSHIP_TTL, READ_SIZE, WRITE_FLUSH_SIZE, WRITE_HIGH_WATER,
+    gather_bounded, _AioReceiveProtocol, AioCache, AioCachingClient, AioCachingPersonClient,
+    AioClient, AioConnection, AioKomSession, AioProtocolConnection, AioReceiveBuffer,
+    RateLimiter, RequestWindow, get_shared_rate_limiter, _shared_rate_limiters)
+from pylyskom.datatypes import AuxItem, ConfType, Mark, Membership, ReadRange
+from pylyskom.asyncmsg import AsyncDeletedText, AsyncNewName, AsyncNewRecipient, AsyncNewText, AsyncSubRecipient
+from pylyskom.errors import (
+    NoSuchLocalText, NoSuchText, ReceiveError, RequestTimeout, UndefinedConference, UndefinedPerson)
+from pylyskom.komsession import KomSessionNotConnected
+from pylyskom.requests import (
+    Requests, ReqChangeConference, ReqCreateConf, ReqGetMarks, ReqGetMembership11, ReqGetText,
+    ReqGetUconfStat, ReqGetUnreadConfs, ReqLocalToGlobal, ReqLocalToGlobalReverse, ReqLogin, ReqLogout,
+    ReqMarkAsRead, ReqMarkAsUnread, ReqQueryReadTexts, ReqSetUnread)
+from pylyskom.stats import stats
+
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture(params=[AioConnection, AioProtocolConnection])
+def connection_class(request):
+    """Run a test with each of the AioConnection implementations."""
+    return request.param
+
+
+def create_aioconnection(recv_data=None, connection_class=AioConnection):
+    """Create a connection of connection_class that is connected to a
+    mock stream or transport, which will return each of recv_data as a
+    separate read. The written data is in conn.mock_transport.
+    """
+    if recv_data is None:
+        recv_data = []
+    conn = connection_class()
+    if connection_class is AioProtocolConnection:
+        protocol = _AioReceiveProtocol(conn._buffer)
+        conn._transport = MockTransport(protocol)
+        conn._protocol = protocol
+        protocol.connection_made(conn._transport)
+        conn.mock_transport = conn._transport
+        conn.mock_feeder = asyncio.ensure_future(feed_protocol(protocol, recv_data))
+    else:
+        conn._tcp_stream_reader = ChunkedStreamReader(recv_data)
+        conn._tcp_stream_writer = MockStreamWriter()
+        conn.mock_transport = conn._tcp_stream_writer.transport
+    return conn
+
+
+async def feed_protocol(protocol, chunks):
+    """Receive each of chunks into one buffer from the protocol, like
+    a transport does, and then the end of the stream."""
+    try:
+        for chunk in chunks:
+            receive_into_protocol(protocol, chunk)
+            await asyncio.sleep(0)
+        protocol.eof_received()
+    except Exception as e:
+        protocol.connection_lost(e)
+
+
+def receive_into_protocol(protocol, chunk):
+    with protocol.get_buffer(-1) as buf:
+        assert len(chunk) <= len(buf)
+        buf[:len(chunk)] = chunk
+    protocol.buffer_updated(len(chunk))
+
+
+def create_aiokomsession(client):
+    ks = AioKomSession(client_factory=lambda: client)
+    ks._client = client
+    return ks
+
+
+def mock_text(client, text, content_type=None):
+    """Mock get-text-stat and (ranged) get-text for a text."""
+    ts = MockTextStat()
+    ts.author = 17
+    ts.no_of_chars = len(text)
+    if content_type is not None:
+        ai = AuxItem()
+        ai.creator = 0
+        ai.tag = komauxitems.AI_CONTENT_TYPE
+        ai.data = content_type
+        ts.aux_items.append(ai)
+    client.mock_request(Requests.GET_TEXT_STAT, lambda request: ts)
+    client.mock_request(Requests.GET_UCONF_STAT, lambda request: MockUConference(b"Person"))
+    client.mock_request(Requests.GET_TEXT, lambda request: text[request.start_char:request.end_char+1])
+    return ts
+
+
+class ChunkedStreamReader():
+    """Stream reader that returns at most one of the chunks per read."""
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    async def read(self, n):
+        if not self.chunks:
+            return b""
+        chunk = self.chunks.pop(0)
+        assert len(chunk) <= n
+        return chunk
+
+
+async def test_aioconnection_send_request_coalesces_writes(connection_class):
+    conn = create_aioconnection(connection_class=connection_class)
+    writer = conn.mock_transport
+    stats.reset()
+    ref_nos = [ await conn.send_request(ReqGetText(n)) for n in range(1, 101) ]
+    assert ref_nos == list(range(1, 101))
+    assert writer.writes == 0
+    await asyncio.sleep(0)
+    assert writer.writes == 1
+    assert writer.data == b"".join(b"%d 25 %d 0 2147483647\n" % (n, n) for n in range(1, 101))
+    assert stats.dump()['pylyskom.connections.writes.last'] == 1
+
+
+async def test_aioconnection_send_request_writes_large_requests_at_once(connection_class):
+    conn = create_aioconnection(connection_class=connection_class)
+    writer = conn.mock_transport
+    request = b"%d %s" % (ReqGetMarks.CALL_NO, b"x" * (WRITE_FLUSH_SIZE // 2))
+    await conn.send_request(request)
+    assert writer.writes == 0
+    await conn.send_request(request)
+    assert writer.writes == 1
+    await conn.send_request(ReqGetText(3))
+    await conn.close()
+    assert writer.writes == 2
+    assert writer.data.endswith(b"3 25 3 0 2147483647\n")
+
+
+async def test_aioconnection_send_request_drains_above_high_water_mark(connection_class):
+    conn = create_aioconnection(connection_class=connection_class)
+    stats.reset()
+    await conn.send_request(ReqGetText(1))
+    assert 'pylyskom.connections.drains.last' not in stats.dump()
+    conn.mock_transport.write_buffer_size = WRITE_HIGH_WATER + 1
+    await conn.send_request(ReqGetText(2))
+    assert stats.dump()['pylyskom.connections.drains.last'] == 1
+
+
+async def test_aioconnection_read_response_handles_ok_reply(connection_class):
+    conn = create_aioconnection([b"=1 25HYawn Nothing is happening\n"], connection_class)
+    ref_no = await conn.send_request(ReqGetText(12345))
+    response = await conn.read_response()
+    assert response == (ref_no, b"Yawn Nothing is happening", None, None, None)
+
+
+async def test_aioconnection_read_response_skips_reply_to_unknown_ref_no(connection_class):
+    conn = create_aioconnection([b"=17 3Hxyz\n%18 10 12345\n=1 3Hone\n"], connection_class)
+    stats.reset()
+    ref_no = await conn.send_request(ReqGetText(12345))
+    # Passed on without a result, for the client to ignore
+    assert await conn.read_response() == (17, None, None, None, None)
+    assert await conn.read_response() == (18, None, None, None, None)
+    assert await conn.read_response() == (ref_no, b"one", None, None, None)
+    assert stats.dump()['pylyskom.connections.responses.received.unknown.last'] == 2
+
+
+async def test_aioconnection_read_response_handles_error_reply(connection_class):
+    conn = create_aioconnection([b"%1 10 12345\n"], connection_class)
+    ref_no = await conn.send_request(ReqGetUnreadConfs(12345))
+    r_ref_no, ok_reply, error_reply, async_msg, reply_bytes = await conn.read_response()
+    assert r_ref_no == ref_no
+    assert ok_reply is None
+    assert isinstance(error_reply, UndefinedPerson)
+    assert error_reply.args == (12345,)
+    assert reply_bytes is None
+
+
+async def test_aioconnection_read_response_handles_array_reply(connection_class):
+    conn = create_aioconnection([b"=1 3 { 13020 100 13043 95 12213 95 }\n"], connection_class)
+    await conn.send_request(ReqGetMarks())
+    _, ok_reply, _, _, reply_bytes = await conn.read_response()
+    assert ok_reply == [ Mark(13020, 100), Mark(13043, 95), Mark(12213, 95) ]
+    assert reply_bytes is None
+
+
+async def test_aioconnection_raw_request_reply_keeps_end_of_array(connection_class):
+    conn = create_aioconnection([b"=1 3 { 13020 100 13043 95 12213 95 }\n"], connection_class)
+    await conn.send_request(b"%d" % (ReqGetMarks.CALL_NO,))
+    _, ok_reply, _, _, reply_bytes = await conn.read_response()
+    assert ok_reply is None
+    assert reply_bytes == b"3 { 13020 100 13043 95 12213 95 }"
+
+
+async def test_aioconnection_read_response_handles_reply_split_over_many_reads(connection_class):
+    text = b"Subject\n" + b"0123456789H\n" * 1000
+    data = b"=1 %dH%s\n=2 4Hnext\n" % (len(text), text)
+    # Split in the middle of the Hollerith length, among other places.
+    chunks = [ data[i:i+7] for i in range(0, len(data), 7) ]
+    conn = create_aioconnection(chunks, connection_class)
+    await conn.send_request(ReqGetText(1))
+    await conn.send_request(ReqGetText(2))
+    resp1 = await conn.read_response()
+    resp2 = await conn.read_response()
+    assert resp1[0] == 1
+    assert resp1[1] == text
+    assert resp2[0] == 2
+    assert resp2[1] == b"next"
+
+
+async def test_aioconnection_read_response_handles_several_replies_in_one_read(connection_class):
+    conn = create_aioconnection([b"=1 6HText 1\n=2 6HText 2\n"], connection_class)
+    stats.reset()
+    await conn.send_request(ReqGetText(1))
+    await conn.send_request(ReqGetText(2))
+    resp1 = await conn.read_response()
+    resp2 = await conn.read_response()
+    assert resp1[:2] == (1, b"Text 1")
+    assert resp2[:2] == (2, b"Text 2")
+    assert stats.dump()['pylyskom.connections.reads.last'] == 1
+
+
+async def test_aioconnection_read_size_grows_for_large_hollerith_string(connection_class):
+    text = b"x" * (3 * READ_SIZE)
+    data = b"=1 %dH%s\n" % (len(text), text)
+    # The second read must fit the whole rest of the string
+    conn = create_aioconnection([data[:100], data[100:-1], data[-1:]], connection_class)
+    stats.reset()
+    await conn.send_request(ReqGetText(1))
+    response = await conn.read_response()
+    assert response[:2] == (1, text)
+    assert stats.dump()['pylyskom.connections.reads.last'] == 3
+
+
+async def test_aioprotocolconnection_pauses_reading_when_replies_are_not_read():
+    conn = AioProtocolConnection()
+    protocol = _AioReceiveProtocol(conn._buffer)
+    transport = conn._transport = MockTransport(protocol)
+    conn._protocol = protocol
+    protocol.connection_made(transport)
+    stats.reset()
+    text = b"x" * (READ_SIZE - 100)
+    for n in range(1, 7):
+        await conn.send_request(ReqGetText(n))
+        receive_into_protocol(protocol, b"=%d %dH%s\n" % (n, len(text), text))
+    # Above READ_HIGH_WATER after the fifth reply
+    assert not transport.reading
+    assert stats.dump()['pylyskom.connections.reads.paused.last'] == 1
+    for n in range(1, 6):
+        assert (await conn.read_response())[:2] == (n, text)
+    # The last reply is below READ_LOW_WATER
+    assert transport.reading
+    assert (await conn.read_response())[:2] == (6, text)
+
+
+async def test_aioprotocolconnection_resumes_reading_for_incomplete_reply():
+    conn = create_aioconnection(connection_class=AioProtocolConnection)
+    protocol = conn._protocol
+    conn.mock_feeder.cancel()
+    text = b"x" * (10 * READ_SIZE)
+    data = b"=1 %dH%s\n" % (len(text), text)
+    await conn.send_request(ReqGetText(1))
+    chunk_size = READ_SIZE - 100
+    for pos in range(0, 5 * chunk_size, chunk_size):
+        receive_into_protocol(protocol, data[pos:pos+chunk_size])
+    assert not conn.mock_transport.reading
+    # The reply is not complete, so reading is resumed
+    read = asyncio.ensure_future(conn.read_response())
+    await run_ready_tasks()
+    assert conn.mock_transport.reading
+    receive_into_protocol(protocol, data[5 * chunk_size:-1])
+    receive_into_protocol(protocol, data[-1:])
+    assert (await read)[:2] == (1, text)
+
+
+async def test_aioconnection_connect_to_server(connection_class):
+    async def handle(reader, writer):
+        assert await reader.readline() == b"A4Huser\n"
+        writer.write(b"LysKOM\n")
+        assert await reader.readline() == b"1 25 12345 0 2147483647\n"
+        writer.write(b"=1 5Hhello\n")
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        conn = connection_class()
+        await conn.connect("127.0.0.1", port, user="user")
+        assert conn.is_connected()
+        ref_no = await conn.send_request(ReqGetText(12345))
+        assert await conn.read_response() == (ref_no, b"hello", None, None, None)
+        with pytest.raises(ReceiveError):
+            await conn.read_response()
+        await conn.close()
+        assert not conn.is_connected()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+async def test_aioconnection_read_response_raises_at_end_of_stream(connection_class):
+    conn = create_aioconnection([b"=1 6HTex"], connection_class)
+    await conn.send_request(ReqGetText(1))
+    with pytest.raises(ReceiveError):
+        await conn.read_response()
+
+
+async def test_aioconnection_raw_request_reply_is_not_parsed(connection_class):
+    # Not a valid reply to get-text, but raw replies are only framed.
+    conn = create_aioconnection([b"=1 3 { 1 2 3 } 5Hab\ncd\n"], connection_class)
+    ref_no = await conn.send_request(b"25 1 0 100")
+    response = await conn.read_response()
+    assert response[:4] == (ref_no, None, None, None)
+    assert isinstance(response[4], memoryview)
+    assert response[4] == b"3 { 1 2 3 } 5Hab\ncd"
+    assert ref_no not in conn._outstanding_requests
+
+
+async def test_aioconnection_raw_request_error_reply_is_not_parsed(connection_class):
+    conn = create_aioconnection([b"%1 10 12345\n"], connection_class)
+    ref_no = await conn.send_request(b"99 12345")
+    response = await conn.read_response()
+    assert response == (ref_no, None, None, None, b"10 12345")
+
+
+async def test_aioconnection_raw_request_empty_reply(connection_class):
+    conn = create_aioconnection([b"=1\n"], connection_class)
+    await conn.send_request(b"86")
+    response = await conn.read_response()
+    assert response[4] == b""
+
+
+async def test_aioconnection_raw_reply_followed_by_other_replies(connection_class):
+    text = b"x" * 1000
+    data = (b"=1 %dH%s\n=2 6HText 2\n:2 13 1 2\n=3 4Hlast\n" %
+            (len(text), text))
+    conn = create_aioconnection([data], connection_class)
+    await conn.send_request(b"25 1 0 1000")
+    await conn.send_request(ReqGetText(2))
+    await conn.send_request(b"25 3 0 1000")
+    resp1 = await conn.read_response()
+    resp2 = await conn.read_response()
+    resp3 = await conn.read_response()
+    resp4 = await conn.read_response()
+    assert resp1[0] == 1
+    assert resp1[4] == b"1000H" + text
+    assert resp2[:2] == (2, b"Text 2")
+    assert resp3[0] is None
+    assert resp3[3].person_no == 1
+    assert resp4[0] == 3
+    assert resp4[4] == b"4Hlast"
+
+
+async def test_aioreceivebuffer_take_hands_over_storage_of_large_data():
+    buf = AioReceiveBuffer()
+    buf.append(b"=1 0123456789\n=2")
+    buf.skip_to(14)
+    storage = buf._rb
+    view = buf.take(3, 13)
+    assert view == b"0123456789"
+    assert view.obj is storage
+    assert view.readonly
+    assert buf._rb is not storage
+    assert buf.receive_string(2) == b"=2"
+
+
+async def test_aioreceivebuffer_receives_into_buffer():
+    buf = AioReceiveBuffer()
+    buf.append(b"=1 0123\n=2")
+    buf.skip_to(8)
+    with buf.get_buffer(10) as view:
+        assert len(view) >= 10
+        view[:4] = b" 5H1"
+    buf.buffer_updated(4)
+    assert buf.receive_string(6) == b"=2 5H1"
+    buf.append(b"2345\n")
+    assert buf.receive_string(5) == b"2345\n"
+    assert buf.find_message_end() is None
+
+
+async def test_aioreceivebuffer_take_copies_small_data():
+    buf = AioReceiveBuffer()
+    buf.append(b"=1 01\n=2 0123456789\n")
+    buf.skip_to(6)
+    storage = buf._rb
+    view = buf.take(3, 5)
+    assert view == b"01"
+    assert view.obj is not storage
+    assert buf._rb is storage
+    assert buf.receive_string(2) == b"=2"
+
+
+async def test_aioreceivebuffer_take_copies_small_data_in_large_storage():
+    buf = AioReceiveBuffer()
+    with buf.get_buffer(READ_SIZE) as view:
+        view[:9] = b"=1 3Hxyz\n"
+    buf.buffer_updated(9)
+    buf.skip_to(9)
+    storage = buf._rb
+    view = buf.take(5, 8)
+    assert view == b"xyz"
+    # Not the whole READ_SIZE storage for three bytes
+    assert view.obj is not storage
+    assert buf._rb is storage
+
+
+async def stream_text(ks, text_no, chunk_size):
+    return [ chunk async for chunk in ks.stream_text(text_no, chunk_size) ]
+
+
+async def test_aiokomsession_stream_text_skips_subject():
+    client = MockAioClient()
+    body = bytes(range(256)) * 10
+    mock_text(client, b"Subject\n" + body, b"image/png")
+    ks = create_aiokomsession(client)
+    chunks = await stream_text(ks, 4711, 1000)
+    assert b"".join(chunks) == body
+    assert all(len(chunk) <= 1000 for chunk in chunks)
+    calls = client.mock_get_request_calls(Requests.GET_TEXT)
+    assert [ (r.start_char, r.end_char) for r in calls ] == [
+        (0, 999), (1000, 1999), (2000, 2567) ]
+
+
+async def test_aiokomsession_stream_text_subject_over_several_chunks():
+    client = MockAioClient()
+    mock_text(client, b"A long subject\nbody")
+    ks = create_aiokomsession(client)
+    assert await stream_text(ks, 4711, 4) == [ b"b", b"ody" ]
+
+
+async def test_aiokomsession_stream_text_without_linefeed_is_all_body():
+    client = MockAioClient()
+    mock_text(client, b"only body")
+    ks = create_aiokomsession(client)
+    assert b"".join(await stream_text(ks, 4711, 4)) == b"only body"
+
+
+async def test_aiokomsession_stream_text_user_area_has_no_subject():
+    client = MockAioClient()
+    mock_text(client, b"8H 5Hjskom\n", b"x-kom/user-area")
+    ks = create_aiokomsession(client)
+    assert b"".join(await stream_text(ks, 4711, 4)) == b"8H 5Hjskom\n"
+
+
+async def test_aiokomsession_stream_text_empty_text():
+    client = MockAioClient()
+    mock_text(client, b"")
+    ks = create_aiokomsession(client)
+    assert await stream_text(ks, 4711, 4) == []
+    assert client.mock_get_request_calls(Requests.GET_TEXT) == []
+
+
+async def test_aiokomsession_stream_text_closes_session_on_connection_error():
+    client = MockAioClient()
+    mock_text(client, b"Subject\nbody")
+    def get_text(request):
+        raise ConnectionResetError(errno.ECONNRESET, "Connection reset by peer")
+    client.mock_request(Requests.GET_TEXT, get_text)
+    ks = create_aiokomsession(client)
+    with pytest.raises(KomSessionNotConnected):
+        await stream_text(ks, 4711, 4)
+    assert not ks.is_connected()
+    with pytest.raises(KomSessionNotConnected):
+        await stream_text(ks, 4711, 4)
+
+
+async def test_aiokomsession_get_text_preview_gets_only_first_chars():
+    client = MockAioClient()
+    mock_text(client, b"Subject\n" + b"x" * 10000, b"image/jpeg")
+    ks = create_aiokomsession(client)
+    text = await ks.get_text_preview(4711, 100)
+    assert text.subject == "Subject"
+    assert text.body == b"x" * 92
+    assert text.truncated
+    calls = client.mock_get_request_calls(Requests.GET_TEXT)
+    assert [ (r.start_char, r.end_char) for r in calls ] == [ (0, 99) ]
+
+
+async def test_aiokomsession_get_text_preview_of_short_text_is_not_truncated():
+    client = MockAioClient()
+    mock_text(client, b"Subject\nBody", b"text/plain; charset=utf-8")
+    ks = create_aiokomsession(client)
+    text = await ks.get_text_preview(4711, 100)
+    assert (text.subject, text.body) == ("Subject", "Body")
+    assert not text.truncated
+
+
+async def test_aiokomsession_get_text_preview_subject_only():
+    client = MockAioClient()
+    mock_text(client, b"Subject\nBody", b"text/plain; charset=utf-8")
+    ks = create_aiokomsession(client)
+    text = await ks.get_text_preview(4711, subject_only=True)
+    assert (text.subject, text.body) == ("Subject", "")
+    assert text.truncated
+
+
+async def test_aiokomsession_get_text_preview_cut_in_subject():
+    client = MockAioClient()
+    mock_text(client, "Räksmörgås\nBody".encode("utf-8"), b"text/plain; charset=utf-8")
+    ks = create_aiokomsession(client)
+    # Cut in the middle of the two bytes of "ö"
+    text = await ks.get_text_preview(4711, 5)
+    assert (text.subject, text.body) == ("Räks", "")
+    assert text.truncated
+
+
+async def test_aiokomsession_get_last_texts_with_subject():
+    client = MockAioClient()
+    mock_text(client, b"Subject\n" + b"x" * 100000, b"image/jpeg")
+    mapping = MagicMock()
+    mapping.list = [ (1, 4711), (2, 0), (3, 4712) ]
+    client.mock_request(Requests.LOCAL_TO_GLOBAL_REVERSE, lambda request: mapping)
+    ks = create_aiokomsession(client)
+    texts = await ks.get_last_texts(1, 3, with_subject=True)
+    assert [ t.text_no for t in texts ] == [ 4712, 4711 ]
+    assert all(t.subject == "Subject" and t.truncated for t in texts)
+    calls = client.mock_get_request_calls(Requests.GET_TEXT)
+    assert all(r.end_char < 10000 for r in calls)
+
+
+async def run_ready_tasks():
+    """Let the tasks that are ready run until they block."""
+    for i in range(5):
+        await asyncio.sleep(0)
+
+
+class ControlledFetcher():
+    """Fetcher for AioCache where the test decides when each fetch is
+    done."""
+    def __init__(self):
+        self.fetches = []
+        self.priorities = []
+
+    async def __call__(self, no, priority=None):
+        fut = asyncio.get_running_loop().create_future()
+        self.fetches.append((no, fut))
+        self.priorities.append(priority)
+        return await fut
+
+
+async def test_aiocache_concurrent_gets_share_one_fetch():
+    fetcher = ControlledFetcher()
+    cache = AioCache(fetcher, "Test")
+    gets = [ asyncio.ensure_future(cache.get(1)) for i in range(5) ]
+    await run_ready_tasks()
+    assert len(fetcher.fetches) == 1
+    fetcher.fetches[0][1].set_result("one")
+    assert await asyncio.gather(*gets) == [ "one" ] * 5
+    assert await cache.get(1) == "one"
+    assert len(fetcher.fetches) == 1
+
+
+async def test_aiocache_interactive_get_does_not_wait_for_background_fetch():
+    fetcher = ControlledFetcher()
+    cache = AioCache(fetcher, "Test")
+    background = [ asyncio.ensure_future(cache.get(1, priority=PRIORITY_BACKGROUND)) for i in range(2) ]
+    await run_ready_tasks()
+    interactive = asyncio.ensure_future(cache.get(1))
+    # Shares the interactive fetch
+    later_background = asyncio.ensure_future(cache.get(1, priority=PRIORITY_BACKGROUND))
+    await run_ready_tasks()
+    assert fetcher.priorities == [ PRIORITY_BACKGROUND, None ]
+    fetcher.fetches[1][1].set_result("interactive")
+    assert await interactive == "interactive"
+    assert await later_background == "interactive"
+    fetcher.fetches[0][1].set_result("background")
+    assert await asyncio.gather(*background) == [ "background" ] * 2
+    assert await cache.get(1) == "interactive"
+    assert len(fetcher.fetches) == 2
+
+
+async def test_aiocache_fetch_error_is_raised_to_all_and_not_cached():
+    fetcher = ControlledFetcher()
+    cache = AioCache(fetcher, "Test")
+    gets = [ asyncio.ensure_future(cache.get(1)) for i in range(2) ]
+    await run_ready_tasks()
+    fetcher.fetches[0][1].set_exception(UndefinedConference(1))
+    results = await asyncio.gather(*gets, return_exceptions=True)
+    assert all(isinstance(r, UndefinedConference) for r in results)
+    get = asyncio.ensure_future(cache.get(1))
+    await run_ready_tasks()
+    assert len(fetcher.fetches) == 2
+    fetcher.fetches[1][1].set_result("one")
+    assert await get == "one"
+
+
+async def test_aiocache_invalidate_during_fetch_does_not_store_stale_result():
+    fetcher = ControlledFetcher()
+    cache = AioCache(fetcher, "Test")
+    get1 = asyncio.ensure_future(cache.get(1))
+    await run_ready_tasks()
+    cache.invalidate(1)
+    # A get after the invalidation must not use the fetch before it
+    get2 = asyncio.ensure_future(cache.get(1))
+    await run_ready_tasks()
+    assert len(fetcher.fetches) == 2
+    fetcher.fetches[1][1].set_result("new")
+    fetcher.fetches[0][1].set_result("old")
+    assert await get1 == "old"
+    assert await get2 == "new"
+    assert await cache.get(1) == "new"
+
+
+async def test_aiocache_cancelled_get_does_not_cancel_fetch_for_others():
+    fetcher = ControlledFetcher()
+    cache = AioCache(fetcher, "Test")
+    get1 = asyncio.ensure_future(cache.get(1))
+    get2 = asyncio.ensure_future(cache.get(1))
+    await run_ready_tasks()
+    get1.cancel()
+    await run_ready_tasks()
+    fetcher.fetches[0][1].set_result("one")
+    assert await get2 == "one"
+    assert get1.cancelled()
+
+
+async def test_aiocache_evicts_least_recently_used():
+    fetched = []
+    async def fetcher(no):
+        fetched.append(no)
+        return no * 10
+    cache = AioCache(fetcher, "TestLRU", max_size=2)
+    stats.reset()
+    assert await cache.get(1) == 10
+    assert await cache.get(2) == 20
+    assert await cache.get(1) == 10 # 2 is now the least recently used
+    assert await cache.get(3) == 30
+    assert list(cache.dict.keys()) == [1, 3]
+    assert await cache.get(2) == 20
+    assert fetched == [1, 2, 3, 2]
+    assert stats.dump()['pylyskom.clients.cache.TestLRU.evictions.last'] == 2
+
+
+async def test_aiocache_ttl():
+    now = [100.0]
+    fetched = []
+    async def fetcher(no):
+        fetched.append(no)
+        return no * 10
+    cache = AioCache(fetcher, "TestTTL", ttl=10)
+    cache._clock = lambda: now[0]
+    stats.reset()
+    assert await cache.get(1) == 10
+    now[0] = 109.0
+    assert await cache.get(1) == 10
+    assert fetched == [1]
+    now[0] = 110.0
+    assert await cache.get(1) == 10
+    assert fetched == [1, 1]
+    assert stats.dump()['pylyskom.clients.cache.TestTTL.expirations.last'] == 1
+
+
+async def test_aiocache_caches_errors_in_error_ttls():
+    now = [100.0]
+    fetched = []
+    async def fetcher(no):
+        fetched.append(no)
+        if no == 1:
+            raise UndefinedConference(no)
+        raise NoSuchText(no)
+    cache = AioCache(fetcher, "TestErrors", ttl=3600, error_ttls={ UndefinedConference: 10 })
+    cache._clock = lambda: now[0]
+    for i in range(2):
+        with pytest.raises(UndefinedConference):
+            await cache.get(1)
+        with pytest.raises(NoSuchText):
+            await cache.get(2)
+    assert fetched == [1, 2, 2]
+    now[0] = 110.0
+    with pytest.raises(UndefinedConference):
+        await cache.get(1)
+    assert fetched == [1, 2, 2, 1]
+
+
+async def test_aiocache_invalidate_error_keeps_objects():
+    async def fetcher(no):
+        if no == 1:
+            raise UndefinedConference(no)
+        return no
+    cache = AioCache(fetcher, "TestErrors", error_ttls={ UndefinedConference: 10 })
+    with pytest.raises(UndefinedConference):
+        await cache.get(1)
+    assert await cache.get(2) == 2
+    cache.invalidate_error(1)
+    cache.invalidate_error(2)
+    assert list(cache.dict.keys()) == [2]
+
+
+def create_aiocachingclient(request):
+    client = MagicMock()
+    client.request = AsyncMock(side_effect=request)
+    error_ttls = dict(error_ttls={ UndefinedConference: 60 })
+    return AioCachingClient(client, cache_options={ "UConference": error_ttls })
+
+
+async def test_aiocachingclient_new_name_clears_undefined_conference():
+    existing = set()
+    async def request(req, **kwargs):
+        if req.conf_no not in existing:
+            raise UndefinedConference(req.conf_no)
+        return MockUConference(b"New")
+    caching_client = create_aiocachingclient(request)
+    with pytest.raises(UndefinedConference):
+        await caching_client.uconferences.get(17)
+    existing.add(17)
+    with pytest.raises(UndefinedConference):
+        await caching_client.uconferences.get(17)
+    msg = AsyncNewName()
+    msg.conf_no = 17
+    await caching_client._handle_async_message(msg)
+    assert (await caching_client.uconferences.get(17)).name == b"New"
+
+
+async def test_aiocachingclient_create_clears_undefined_conference():
+    existing = set()
+    async def request(req, **kwargs):
+        if isinstance(req, ReqCreateConf):
+            existing.add(17)
+            return 17
+        if req.conf_no not in existing:
+            raise UndefinedConference(req.conf_no)
+        return MockUConference(b"New")
+    caching_client = create_aiocachingclient(request)
+    with pytest.raises(UndefinedConference):
+        await caching_client.uconferences.get(17)
+    assert await caching_client.request(ReqCreateConf(b"New", ConfType(), [])) == 17
+    assert (await caching_client.uconferences.get(17)).name == b"New"
+
+
+class ConcurrencyMockAioClient(MockAioClient):
+    """MockAioClient where requests take a while, and that keeps
+    track of how many requests are in flight at most."""
+    def __init__(self):
+        MockAioClient.__init__(self)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def request(self, request, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await run_ready_tasks()
+            return await MockAioClient.request(self, request)
+        finally:
+            self.in_flight -= 1
+
+
+async def test_aiokomsession_get_text_fetches_text_stat_and_text_concurrently():
+    client = ConcurrencyMockAioClient()
+    mock_text(client, b"subject\nbody")
+    ks = create_aiokomsession(client)
+    text = await ks.get_text(4711)
+    assert (text.subject, text.body) == ("subject", "body")
+    assert client.max_in_flight == 2
+
+
+async def test_aiokomsession_get_text_failure_cancels_the_other_request():
+    client = MockAioClient()
+    cancelled = []
+    async def fetch_textstat(no):
+        raise NoSuchText(no)
+    async def request(request):
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.append(request)
+            raise
+    client.textstats.fetcher = fetch_textstat
+    client.request = request
+    ks = create_aiokomsession(client)
+    with pytest.raises(NoSuchText):
+        await ks.get_text(4711)
+    # Not left running (with nobody to retrieve its result)
+    assert [ r.CALL_NO for r in cancelled ] == [ Requests.GET_TEXT ]
+
+
+async def test_aiokomsession_get_last_texts_fetches_concurrently_in_order():
+    client = ConcurrencyMockAioClient()
+    text_stats = {}
+    for text_no in range(1, 31):
+        ts = MockTextStat()
+        ts.author = 100 + text_no % 3
+        text_stats[text_no] = ts
+    mapping = MagicMock()
+    mapping.list = [ (i, i) for i in range(1, 31) ]
+    client.mock_request(Requests.LOCAL_TO_GLOBAL_REVERSE, lambda request: mapping)
+    client.mock_request(Requests.GET_TEXT_STAT, lambda request: text_stats[request.text_no])
+    client.mock_request(Requests.GET_UCONF_STAT,
+                        lambda request: MockUConference(b"Person %d" % (request.conf_no,)))
+    ks = AioKomSession(client_factory=lambda: client, concurrency_limit=4)
+    ks._client = client
+    texts = await ks.get_last_texts(1, 30)
+    assert [ t.text_no for t in texts ] == list(range(30, 0, -1))
+    assert [ t.author.pers_no for t in texts ] == [ 100 + i % 3 for i in range(30, 0, -1) ]
+    assert texts[0].author.username == "Person 100"
+    assert client.max_in_flight == 4
+    assert len(client.mock_get_request_calls(Requests.GET_UCONF_STAT)) == 3
+
+
+async def test_aiokomsession_get_memberships_concurrently_in_order():
+    client = ConcurrencyMockAioClient()
+    memberships = []
+    for conf_no in range(1, 21):
+        m = MagicMock()
+        m.conference = conf_no
+        m.added_by = 0 if conf_no == 1 else 100 + conf_no % 2
+        m.type.passive = (conf_no == 2)
+        memberships.append(m)
+    client.get_memberships = AsyncMock(return_value=memberships)
+    def get_uconf_stat(request):
+        uconf = MagicMock()
+        uconf.name = b"Conf %d" % (request.conf_no,)
+        return uconf
+    client.mock_request(Requests.GET_UCONF_STAT, get_uconf_stat)
+    ks = AioKomSession(client_factory=lambda: client, concurrency_limit=3)
+    ks._client = client
+    result, has_more = await ks.get_memberships(17, 0, 100)
+    assert not has_more
+    assert [ m.conference.conf_no for m in result ] == [ 1 ] + list(range(3, 21))
+    assert result[0].added_by is None
+    assert [ m.added_by.pers_no for m in result[1:] ] == [ 100 + i % 2 for i in range(3, 21) ]
+    assert client.max_in_flight == 3
+    calls = client.mock_get_request_calls(Requests.GET_UCONF_STAT)
+    assert len(calls) == 19 + 2
+
+
+async def test_gather_bounded_cancels_the_rest_when_one_fails():
+    started = []
+    async def work(i):
+        started.append(i)
+        await run_ready_tasks()
+        if i == 1:
+            raise UndefinedConference(i)
+        await asyncio.sleep(10)
+    with pytest.raises(UndefinedConference):
+        await gather_bounded([ work(i) for i in range(10) ], 2)
+    await run_ready_tasks()
+    assert started[:2] == [ 0, 1 ]
+    assert len(started) < 10
+
+
+async def test_aiokomsession_get_membership_unreads_keeps_order():
+    client = ConcurrencyMockAioClient()
+    client.mock_request(Requests.GET_UNREAD_CONFS, lambda request: [ 5, 3, 4, 1, 2 ])
+    async def get_membership(pers_no, conf_no, want_read_ranges):
+        return await client.request(ReqGetText(conf_no))
+    async def get_unread_texts_from_membership(membership):
+        await run_ready_tasks()
+        return list(range(membership))
+    client.mock_request(Requests.GET_TEXT, lambda request: request.text_no)
+    client.get_membership = get_membership
+    client.get_unread_texts_from_membership = get_unread_texts_from_membership
+    ks = AioKomSession(client_factory=lambda: client, concurrency_limit=2)
+    ks._client = client
+    unreads = await ks.get_membership_unreads(17)
+    assert [ (m.conf_no, m.no_of_unread) for m in unreads ] == [
+        (5, 5), (3, 3), (4, 4), (1, 1), (2, 2) ]
+    assert client.max_in_flight == 2
+
+
+def create_local_to_global_conf(highest_local_no, deleted=()):
+    """Returns a request function for a conference where local text
+    number n is global text number 1000 + n, unless n is deleted."""
+    existing = [ n for n in range(1, highest_local_no + 1) if n not in deleted ]
+    def request(req, **kwargs):
+        if isinstance(req, ReqGetUconfStat):
+            uconf = MagicMock()
+            uconf.highest_local_no = highest_local_no
+            return uconf
+        assert isinstance(req, ReqLocalToGlobal)
+        texts = [ n for n in existing if n >= req.first_local_no ][:req.no_of_existing_texts]
+        if not texts:
+            raise NoSuchLocalText(req.first_local_no)
+        mapping = MagicMock()
+        mapping.range_begin = req.first_local_no
+        mapping.range_end = texts[-1] + 1
+        mapping.later_texts_exists = 1 if texts[-1] < existing[-1] else 0
+        mapping.list = [ (n, 1000 + n) for n in texts ]
+        return mapping
+    return request
+
+
+def create_membership(conf_no, read_ranges):
+    membership = MagicMock()
+    membership.conference = conf_no
+    membership.read_ranges = [ ReadRange(first, last) for first, last in read_ranges ]
+    return membership
+
+
+async def check_unread_texts(highest_local_no, read_ranges, deleted=(), cached_highest_local_no=None):
+    request = create_local_to_global_conf(highest_local_no, deleted)
+    in_flight = [0, 0]
+    async def mock_request(req, **kwargs):
+        if cached_highest_local_no is not None and isinstance(req, ReqGetUconfStat):
+            return create_local_to_global_conf(cached_highest_local_no)(req)
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await run_ready_tasks()
+        in_flight[0] -= 1
+        return request(req)
+    client = MagicMock()
+    client.request = AsyncMock(side_effect=mock_request)
+    caching_client = AioCachingClient(client)
+    membership = create_membership(1, read_ranges)
+    unread = await caching_client.get_unread_texts_from_membership(membership, window=4)
+    read = set(n for first, last in read_ranges for n in range(first, last + 1))
+    expected = [ 1000 + n for n in range(1, highest_local_no + 1)
+                 if n not in read and n not in deleted ]
+    assert unread == expected
+    return client, in_flight[1]
+
+
+async def test_aiocachingclient_get_unread_texts_from_membership():
+    await check_unread_texts(10, [])
+    await check_unread_texts(10, [ (1, 10) ])
+    await check_unread_texts(10, [ (1, 3), (5, 7) ])
+    await check_unread_texts(1000, [ (1, 3), (5, 7) ], deleted=range(100, 400))
+    await check_unread_texts(1000, [ (1, 3), (300, 800) ], deleted=range(2, 290))
+    await check_unread_texts(1000, [ (5, 10) ], deleted=range(990, 1001))
+
+
+async def test_aiocachingclient_get_unread_texts_from_membership_is_concurrent():
+    client, max_in_flight = await check_unread_texts(5000, [ (1, 3), (1000, 1010) ])
+    assert max_in_flight == 4
+    # One chunk per 255 local numbers, and nothing after that
+    local_to_global = [ c.args[0] for c in client.request.call_args_list
+                        if isinstance(c.args[0], ReqLocalToGlobal) ]
+    assert len(local_to_global) == 4 + 16
+
+
+async def test_aiocachingclient_get_unread_texts_from_membership_stale_highest_local_no():
+    await check_unread_texts(2000, [ (1, 3) ], cached_highest_local_no=500)
+    await check_unread_texts(2000, [ (1, 3000) ], cached_highest_local_no=1000)
+
+
+def create_text_stat_in_conf(conf_no, local_no):
+    ts = MagicMock()
+    ts.misc_info.recipient_list = [ MagicMock(recpt=conf_no, loc_no=local_no) ]
+    ts.misc_info.comment_to_list = []
+    return ts
+
+
+def create_recipient_msg(msg_class, text_no, conf_no):
+    msg = msg_class()
+    msg.text_no = text_no
+    msg.conf_no = conf_no
+    return msg
+
+
+def count_local_to_global(client):
+    return len([ c for c in client.request.call_args_list
+                 if isinstance(c.args[0], (ReqLocalToGlobal, ReqLocalToGlobalReverse)) ])
+
+
+async def test_aiocachingclient_get_unread_texts_from_membership_uses_index():
+    conf = { "highest_local_no": 600 }
+    async def mock_request(req, **kwargs):
+        return create_local_to_global_conf(conf["highest_local_no"], deleted=(7,))(req)
+    client = MagicMock()
+    client.request = AsyncMock(side_effect=mock_request)
+    caching_client = AioCachingClient(client)
+    membership = create_membership(1, [ (1, 3) ])
+
+    unread = await caching_client.get_unread_texts_from_membership(membership)
+    expected = [ 1000 + n for n in range(4, 601) if n != 7 ]
+    assert unread == expected
+    assert count_local_to_global(client) == 3
+
+    client.request.reset_mock()
+    assert await caching_client.get_unread_texts_from_membership(membership) == expected
+    membership = create_membership(1, [ (1, 300) ])
+    assert await caching_client.get_unread_texts_from_membership(membership) == expected[296:]
+    assert count_local_to_global(client) == 0
+
+    # A new text is added to the index
+    conf["highest_local_no"] = 601
+    await caching_client._cah_new_text(AsyncNewText(1601, create_text_stat_in_conf(1, 601)))
+    unread = await caching_client.get_unread_texts_from_membership(membership)
+    assert unread == expected[296:] + [ 1601 ]
+    assert count_local_to_global(client) == 0
+
+    # A deleted text, and a removed recipient, are removed from it
+    msg = AsyncDeletedText()
+    msg.text_no = 1601
+    msg.text_stat = create_text_stat_in_conf(1, 601)
+    await caching_client._cah_deleted_text(msg)
+    await caching_client._cah_sub_recipient(create_recipient_msg(AsyncSubRecipient, 1400, 1))
+    unread = await caching_client.get_unread_texts_from_membership(membership)
+    assert unread == [ n for n in expected[296:] if n != 1400 ]
+    assert count_local_to_global(client) == 0
+
+
+async def test_aiocachingclient_text_index_new_recipient_is_mapped():
+    conf = { "highest_local_no": 10 }
+    async def mock_request(req, **kwargs):
+        return create_local_to_global_conf(conf["highest_local_no"])(req)
+    client = MagicMock()
+    client.request = AsyncMock(side_effect=mock_request)
+    caching_client = AioCachingClient(client)
+    membership = create_membership(1, [ (1, 5) ])
+    await caching_client.get_unread_texts_from_membership(membership)
+
+    # The local number of the added recipient is not known
+    client.request.reset_mock()
+    conf["highest_local_no"] = 11
+    await caching_client._cah_new_recipient(create_recipient_msg(AsyncNewRecipient, 1011, 1))
+    unread = await caching_client.get_unread_texts_from_membership(membership)
+    assert unread == [ 1006, 1007, 1008, 1009, 1010, 1011 ]
+    assert count_local_to_global(client) == 1
+
+
+async def test_aiocachingclient_text_indexes_evict_least_recently_used():
+    client = MagicMock()
+    client.request = AsyncMock(side_effect=create_local_to_global_conf(10))
+    caching_client = AioCachingClient(client, cache_options={ "TextIndex": { "max_size": 2 } })
+    stats.reset()
+    for conf_no in (1, 2, 1, 3):
+        await caching_client.get_unread_texts_from_membership(create_membership(conf_no, []))
+    assert list(caching_client._text_indexes) == [ 1, 3 ]
+    assert stats.dump()['pylyskom.clients.cache.TextIndex.evictions.last'] == 1
+    client.request.reset_mock()
+    await caching_client.get_unread_texts_from_membership(create_membership(1, []))
+    assert count_local_to_global(client) == 0
+
+
+async def test_aiocachingpersonclient_logout_clears_text_indexes():
+    caching_client, client = await create_read_membership_client()
+    caching_client._get_text_index(1)
+    await caching_client.logout()
+    assert len(caching_client._text_indexes) == 0
+
+
+async def test_aiocachingclient_get_last_text_mappings_uses_index():
+    client = MagicMock()
+    client.request = AsyncMock(side_effect=create_local_to_global_conf(10))
+    caching_client = AioCachingClient(client)
+    await caching_client.get_unread_texts_from_membership(create_membership(1, []))
+    client.request.reset_mock()
+    assert await caching_client.get_last_text_mappings(1, 3) == [ (8, 1008), (9, 1009), (10, 1010) ]
+    assert count_local_to_global(client) == 0
+
+
+async def test_aiokomsession_get_membership_unreads_count_only():
+    client = MockAioClient()
+    client.mock_request(Requests.GET_UNREAD_CONFS, lambda request: [ 1, 2 ])
+    async def get_membership(pers_no, conf_no, want_read_ranges):
+        assert want_read_ranges
+        return create_membership(conf_no, [ (1, 3), (5, 7) ] if conf_no == 1 else [ (1, 50) ])
+    client.get_membership = get_membership
+    client.count_unread_texts_from_membership = functools.partial(
+        AioCachingClient.count_unread_texts_from_membership, client)
+    client.mock_request(Requests.GET_UCONF_STAT, lambda request: MagicMock(highest_local_no=50))
+    ks = create_aiokomsession(client)
+    unreads = await ks.get_membership_unreads(17, count_only=True)
+    assert [ (m.conf_no, m.no_of_unread, m.unread_texts) for m in unreads ] == [ (1, 44, None) ]
+    assert client.mock_get_request_calls(Requests.LOCAL_TO_GLOBAL) == []
+
+
+async def create_read_membership_client(mark_as_read_delay=None, reply=None):
+    async def mock_request(req, **kwargs):
+        if isinstance(req, ReqQueryReadTexts):
+            if reply is not None:
+                await reply.wait()
+            return Membership(conference=req.conference,
+                              read_ranges=[ ReadRange(1, 3), ReadRange(5, 7) ])
+        assert isinstance(req, (ReqChangeConference, ReqLogin, ReqLogout, ReqMarkAsRead, ReqMarkAsUnread,
+                                ReqSetUnread))
+        if isinstance(req, ReqMarkAsRead) and 99 in req.texts:
+            raise NoSuchLocalText(99)
+    client = MagicMock()
+    client.request = AsyncMock(side_effect=mock_request)
+    caching_client = AioCachingPersonClient(client, mark_as_read_delay=mark_as_read_delay)
+    await caching_client.login(17, "secret")
+    return caching_client, client
+
+
+def count_query_read_texts(client):
+    return len([ c for c in client.request.call_args_list
+                 if isinstance(c.args[0], ReqQueryReadTexts) ])
+
+
+async def test_aiocachingpersonclient_updates_cached_read_ranges():
+    caching_client, client = await create_read_membership_client()
+    membership = await caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert utils.read_ranges_to_gaps_and_last(membership.read_ranges) == ([ (4, 1) ], 8)
+
+    await caching_client.mark_as_read_local(1, 4)
+    await caching_client.mark_as_read_local(1, 9)
+    await caching_client.mark_as_unread_local(1, 2)
+    membership = await caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert [ (rr.first_read, rr.last_read) for rr in membership.read_ranges ] == [
+        (1, 1), (3, 7), (9, 9) ]
+    assert count_query_read_texts(client) == 1
+
+    # Other persons' read ranges are not cached
+    await caching_client.get_membership(18, 1, want_read_ranges=True)
+    await caching_client.get_membership(18, 1, want_read_ranges=True)
+    assert count_query_read_texts(client) == 3
+
+    await caching_client.logout()
+    await caching_client.login(17, "secret")
+    await caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert count_query_read_texts(client) == 4
+
+
+async def test_aiocachingpersonclient_returns_copy_of_cached_read_ranges():
+    caching_client, client = await create_read_membership_client()
+    membership1 = await caching_client.get_membership(17, 1, want_read_ranges=True)
+    membership1.read_ranges.add(4)
+    membership2 = await caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert 4 not in membership2.read_ranges
+    assert membership2.read_ranges == utils.ReadRangeSet([ ReadRange(1, 3), ReadRange(5, 7) ])
+    assert repr(membership2.read_ranges) == "ReadRangeSet([ReadRange(1, 3), ReadRange(5, 7)])"
+    assert count_query_read_texts(client) == 1
+
+
+async def test_aiocachingpersonclient_other_read_ranges_changes_invalidate():
+    caching_client, client = await create_read_membership_client()
+    assert caching_client._read_memberships.ttl == READ_MEMBERSHIP_TTL
+    await caching_client.get_membership(17, 1, want_read_ranges=True)
+    await caching_client.request(ReqSetUnread(1, 2))
+    await caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert count_query_read_texts(client) == 2
+    # Raw requests as well
+    client.raw_request = AsyncMock(return_value=memoryview(b""))
+    await caching_client.raw_request(b"%d 1 1 { 4 }" % (ReqMarkAsRead.CALL_NO,))
+    await caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert count_query_read_texts(client) == 3
+    # but not other conferences
+    await caching_client.request(ReqSetUnread(2, 2))
+    await caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert count_query_read_texts(client) == 3
+
+
+async def test_aiocachingpersonclient_mark_as_read_during_read_ranges_fetch():
+    reply = asyncio.Event()
+    caching_client, client = await create_read_membership_client(reply=reply)
+    get = asyncio.ensure_future(caching_client.get_membership(17, 1, want_read_ranges=True))
+    await run_ready_tasks()
+    await caching_client.mark_as_read_local(1, 4)
+    reply.set()
+    await get
+    # The fetch might not include the mark, so it was not cached
+    await caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert count_query_read_texts(client) == 2
+
+
+def get_marks_as_read(client):
+    return [ (c.args[0].conf_no, list(c.args[0].texts)) for c in client.request.call_args_list
+             if isinstance(c.args[0], ReqMarkAsRead) ]
+
+
+async def test_aiocachingpersonclient_batches_marks_as_read():
+    caching_client, client = await create_read_membership_client(mark_as_read_delay=0.01)
+    await caching_client.get_membership(17, 1, want_read_ranges=True)
+    stats.reset()
+    await asyncio.gather(caching_client.mark_as_read_local(1, 4),
+                         caching_client.mark_as_read_local(2, 10),
+                         caching_client.mark_as_read_local(1, 8),
+                         caching_client.mark_as_read_local(2, 11))
+    assert get_marks_as_read(client) == [ (1, [ 4, 8 ]), (2, [ 10, 11 ]) ]
+    assert stats.dump()['pylyskom.clients.markasread.batches.last'] == 2
+    assert stats.dump()['pylyskom.clients.markasread.texts.last'] == 4
+    membership = await caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert utils.read_ranges_to_gaps_and_last(membership.read_ranges) == ([], 9)
+
+
+async def test_aiocachingpersonclient_batches_marks_as_read_up_to_batch_size():
+    caching_client, client = await create_read_membership_client(mark_as_read_delay=0.01)
+    caching_client._mark_as_read_batch_size = 3
+    await asyncio.gather(*[ caching_client.mark_as_read_local(1, n) for n in range(1, 8) ])
+    assert get_marks_as_read(client) == [ (1, [ 1, 2, 3 ]), (1, [ 4, 5, 6 ]), (1, [ 7 ]) ]
+
+
+async def test_aiocachingpersonclient_flushes_marks_as_read():
+    caching_client, client = await create_read_membership_client(mark_as_read_delay=60)
+    marks = asyncio.ensure_future(asyncio.gather(caching_client.mark_as_read_local(1, 4),
+                                                 caching_client.mark_as_read_local(2, 5)))
+    await run_ready_tasks()
+    assert get_marks_as_read(client) == []
+    await caching_client.change_conference(3)
+    assert get_marks_as_read(client) == [ (1, [ 4 ]), (2, [ 5 ]) ]
+    await marks
+
+    marks = asyncio.ensure_future(caching_client.mark_as_read_local(1, 6))
+    await run_ready_tasks()
+    await caching_client.logout()
+    requests_sent = [ c.args[0] for c in client.request.call_args_list ]
+    assert isinstance(requests_sent[-2], ReqMarkAsRead)
+    assert isinstance(requests_sent[-1], ReqLogout)
+    await marks
+
+
+async def test_aiocachingpersonclient_batched_mark_as_read_reports_failed_texts():
+    caching_client, client = await create_read_membership_client(mark_as_read_delay=0.01)
+    results = await asyncio.gather(caching_client.mark_as_read_local(1, 4),
+                                   caching_client.mark_as_read_local(1, 99),
+                                   caching_client.mark_as_read_local(1, 5),
+                                   return_exceptions=True)
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], NoSuchLocalText)
+    assert get_marks_as_read(client) == [ (1, [ 4, 99, 5 ]), (1, [ 4 ]), (1, [ 99 ]), (1, [ 5 ]) ]
+
+
+async def create_aioclient(**kwargs):
+    conn = MockAioConnection()
+    client = AioClient(conn, **kwargs)
+    await client.connect("localhost", 4894)
+    return client, conn
+
+
+async def test_aioclient_routes_replies_in_any_order():
+    client, conn = await create_aioclient()
+    tasks = [ asyncio.ensure_future(client.request(ReqGetText(n))) for n in range(1, 4) ]
+    await run_ready_tasks()
+    assert [ ref_no for ref_no, _ in conn.sent ] == [ 1, 2, 3 ]
+    conn.reply(3, b"three")
+    conn.reply(1, b"one")
+    conn.reply(2, error_reply=NoSuchText(2))
+    assert await tasks[0] == b"one"
+    with pytest.raises(NoSuchText):
+        await tasks[1]
+    assert await tasks[2] == b"three"
+    assert client._reply_futures == {}
+    await client.close()
+
+
+async def test_aioclient_reply_while_draining():
+    client, conn = await create_aioclient()
+    conn.drained = asyncio.Event()
+    task = asyncio.ensure_future(client.request(ReqGetText(1)))
+    await run_ready_tasks()
+    assert len(conn.sent) == 1
+    # The request has been written, and is answered before the drain
+    conn.reply(1, b"one")
+    await run_ready_tasks()
+    conn.drained.set()
+    assert await asyncio.wait_for(task, 1) == b"one"
+    # The response receiver is still running
+    task = asyncio.ensure_future(client.request(ReqGetText(2)))
+    await run_ready_tasks()
+    conn.reply(2, b"two")
+    assert await asyncio.wait_for(task, 1) == b"two"
+    await client.close()
+
+
+async def test_aioclient_reply_to_unknown_ref_no_is_ignored():
+    client, conn = await create_aioclient()
+    stats.reset()
+    task = asyncio.ensure_future(client.request(ReqGetText(1)))
+    await run_ready_tasks()
+    conn.reply(17)
+    conn.reply(1, b"one")
+    assert await asyncio.wait_for(task, 1) == b"one"
+    assert stats.dump()['pylyskom.clients.replies.unknown.last'] == 1
+    await client.close()
+
+
+async def test_aioclient_limits_requests_in_flight():
+    client, conn = await create_aioclient(max_in_flight=2)
+    stats.reset()
+    tasks = [ asyncio.ensure_future(client.request(ReqGetText(n))) for n in range(1, 6) ]
+    await run_ready_tasks()
+    assert len(conn.sent) == 2
+    conn.reply(2, b"two")
+    assert await tasks[1] == b"two"
+    await run_ready_tasks()
+    assert len(conn.sent) == 3
+    for ref_no in range(1, 6):
+        if ref_no != 2:
+            conn.reply(ref_no, b"%d" % ref_no)
+        await run_ready_tasks()
+    assert await asyncio.gather(*tasks) == [ b"1", b"two", b"3", b"4", b"5" ]
+    assert stats.dump()['pylyskom.clients.requests.window.waits.last'] == 3
+    await client.close()
+
+
+async def test_aioclient_without_in_flight_limit():
+    client, conn = await create_aioclient(max_in_flight=None)
+    tasks = [ asyncio.ensure_future(client.request(ReqGetText(n))) for n in range(1, 201) ]
+    await run_ready_tasks()
+    assert len(conn.sent) == 200
+    for ref_no in range(1, 201):
+        conn.reply(ref_no)
+    await asyncio.gather(*tasks)
+    await client.close()
+
+
+def sent_text_nos(conn):
+    return [ request.text_no for ref_no, request in conn.sent ]
+
+
+async def test_aioclient_background_requests_use_bounded_share_of_window():
+    client, conn = await create_aioclient(max_in_flight=4, background_share=0.5)
+    stats.reset()
+    background = [ asyncio.ensure_future(client.request(ReqGetText(n), priority=PRIORITY_BACKGROUND))
+                   for n in range(1, 6) ]
+    await run_ready_tasks()
+    assert sent_text_nos(conn) == [ 1, 2 ]
+    interactive = [ asyncio.ensure_future(client.request(ReqGetText(n)))
+                    for n in range(101, 104) ]
+    await run_ready_tasks()
+    # Sent at once, in the slots background requests may not use
+    assert sent_text_nos(conn) == [ 1, 2, 101, 102 ]
+    # A free slot goes to the waiting interactive request first
+    conn.reply(1, b"1")
+    await run_ready_tasks()
+    assert sent_text_nos(conn) == [ 1, 2, 101, 102, 103 ]
+    conn.reply(3, b"101")
+    await run_ready_tasks()
+    assert sent_text_nos(conn) == [ 1, 2, 101, 102, 103, 3 ]
+    for ref_no in range(2, 9):
+        if ref_no != 3:
+            conn.reply(ref_no, b"%d" % ref_no)
+        await run_ready_tasks()
+    await asyncio.gather(*background, *interactive)
+    dump = stats.dump()
+    assert dump['pylyskom.clients.requests.window.waits.last'] == 1
+    assert dump['pylyskom.clients.requests.window.background.waits.last'] == 3
+    await client.close()
+
+
+async def test_aiokomsession_interactive_request_overtakes_get_last_texts():
+    client, conn = await create_aioclient(max_in_flight=2, background_share=0.5)
+    ks = create_aiokomsession(AioCachingPersonClient(client))
+    last_texts = asyncio.ensure_future(ks.get_last_texts(1, 3))
+    await run_ready_tasks()
+    assert conn.sent[0][1].CALL_NO == Requests.LOCAL_TO_GLOBAL_REVERSE
+    mapping = MagicMock()
+    mapping.range_begin, mapping.range_end = 1, 4
+    mapping.list = [ (1, 1001), (2, 1002), (3, 1003) ]
+    conn.reply(1, mapping)
+    await run_ready_tasks()
+    def sent_after_mapping():
+        return [ (request.CALL_NO, request.text_no) for ref_no, request in conn.sent[1:] ]
+    # Only one of the text stats at a time, as background requests
+    assert sent_after_mapping() == [ (Requests.GET_TEXT_STAT, 1001) ]
+    text = asyncio.ensure_future(ks.get_text(4711))
+    await run_ready_tasks()
+    assert [ text_no for call_no, text_no in sent_after_mapping() ] == [ 1001, 4711 ]
+    conn.reply(2, MockTextStat())
+    await run_ready_tasks()
+    # The free slot goes to the other request of get_text, before
+    # the queued text stats
+    assert sorted(sent_after_mapping()[1:]) == [ (Requests.GET_TEXT, 4711),
+                                                 (Requests.GET_TEXT_STAT, 4711) ]
+    last_texts.cancel()
+    text.cancel()
+    await client.close()
+
+
+async def test_aioclient_background_requests_leave_a_slot_for_interactive():
+    client, conn = await create_aioclient(max_in_flight=2, background_share=1.0)
+    background = [ asyncio.ensure_future(client.request(ReqGetText(n), priority=PRIORITY_BACKGROUND))
+                   for n in range(1, 4) ]
+    await run_ready_tasks()
+    assert sent_text_nos(conn) == [ 1 ]
+    interactive = asyncio.ensure_future(client.request(ReqGetText(101)))
+    await run_ready_tasks()
+    assert sent_text_nos(conn) == [ 1, 101 ]
+    for ref_no in range(1, 5):
+        conn.reply(ref_no, b"%d" % ref_no)
+        await run_ready_tasks()
+    await asyncio.gather(*background, interactive)
+    await client.close()
+
+
+async def test_request_window_cancelled_waiter_does_not_keep_slot():
+    window = RequestWindow(1, 1)
+    await window.acquire(PRIORITY_BACKGROUND)
+    waiter = asyncio.ensure_future(window.acquire(PRIORITY_BACKGROUND))
+    await run_ready_tasks()
+    # Cancelled after it got the slot, but before it could run
+    window.release(PRIORITY_BACKGROUND)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    await asyncio.wait_for(window.acquire(PRIORITY_INTERACTIVE), 1)
+    window.release(PRIORITY_INTERACTIVE)
+    with pytest.raises(ValueError):
+        await window.acquire(17)
+
+
+async def test_rate_limiter_costs_per_request_class():
+    rate_limiter = RateLimiter(10, burst=5, costs={ ReqLocalToGlobal: 3, ReqGetMembership11: 10 })
+    assert rate_limiter.get_cost(ReqGetText(1)) == 1
+    assert rate_limiter.get_cost(ReqLocalToGlobal(1, 1, 255)) == 3
+    assert rate_limiter.get_cost(b"103 1 1 255") == 3
+    # Never more than the bucket holds
+    assert rate_limiter.get_cost(ReqGetMembership11(1, 0, 100, 1, 0)) == 5
+
+
+async def test_aioclient_rate_limit():
+    client, conn = await create_aioclient(rate_limit=dict(rate=100, burst=2))
+    stats.reset()
+    tasks = [ asyncio.ensure_future(client.request(ReqGetText(n))) for n in range(1, 5) ]
+    await run_ready_tasks()
+    assert len(conn.sent) == 2
+    await asyncio.sleep(0.05)
+    assert len(conn.sent) == 4
+    for ref_no in range(1, 5):
+        conn.reply(ref_no)
+    await asyncio.gather(*tasks)
+    dump = stats.dump()
+    assert dump['pylyskom.clients.ratelimit.waits.last'] == 2
+    assert dump['pylyskom.clients.ratelimit.wait_time.last'] > 0
+    await client.close()
+
+
+async def test_rate_limiter_lets_interactive_requests_pass_background():
+    rate_limiter = RateLimiter(100, burst=1)
+    await rate_limiter.acquire(1)
+    background = asyncio.ensure_future(rate_limiter.acquire(1, PRIORITY_BACKGROUND))
+    await run_ready_tasks()
+    interactive = asyncio.ensure_future(rate_limiter.acquire(1, PRIORITY_INTERACTIVE))
+    done, pending = await asyncio.wait([ background, interactive ],
+                                       return_when=asyncio.FIRST_COMPLETED)
+    assert done == { interactive }
+    await asyncio.wait_for(background, 1)
+
+
+async def test_rate_limiter_cancelled_waiter_lets_others_pass():
+    rate_limiter = RateLimiter(10, burst=5, costs={ ReqLocalToGlobal: 5 })
+    await rate_limiter.acquire(5)
+    heavy = asyncio.ensure_future(rate_limiter.acquire(5))
+    await run_ready_tasks()
+    cheap = asyncio.ensure_future(rate_limiter.acquire(1))
+    await run_ready_tasks()
+    heavy.cancel()
+    await asyncio.wait_for(cheap, 0.3)
+
+
+async def test_aioclient_shared_rate_limit():
+    rate_limit = dict(rate=100)
+    client1, _ = await create_aioclient(rate_limit=rate_limit, shared_rate_limit=True)
+    client2, _ = await create_aioclient(rate_limit=rate_limit, shared_rate_limit=True)
+    try:
+        assert client1._rate_limiter is not None
+        assert client1._rate_limiter is client2._rate_limiter
+        assert client1._rate_limiter is get_shared_rate_limiter("localhost", 4894)
+        client3, _ = await create_aioclient(rate_limit=rate_limit)
+        assert client3._rate_limiter is not client1._rate_limiter
+        await client3.close()
+    finally:
+        _shared_rate_limiters.clear()
+        await client1.close()
+        await client2.close()
+
+
+async def test_aioclient_shared_rate_limit_with_other_settings_raises():
+    client1, _ = await create_aioclient(rate_limit=dict(rate=100), shared_rate_limit=True)
+    try:
+        with pytest.raises(ValueError):
+            await create_aioclient(rate_limit=dict(rate=100, burst=10), shared_rate_limit=True)
+        assert get_shared_rate_limiter("localhost", 4894, rate=100) is client1._rate_limiter
+    finally:
+        _shared_rate_limiters.clear()
+        await client1.close()
+
+
+async def test_aioclient_request_timeout():
+    client, conn = await create_aioclient(timeout=0.01)
+    stats.reset()
+    with pytest.raises(RequestTimeout):
+        await client.request(ReqGetText(1))
+    # Per request timeout
+    task = asyncio.ensure_future(client.request(ReqGetText(2), timeout=10))
+    await asyncio.sleep(0.02)
+    assert not task.done()
+    # The late reply to the timed out request is thrown away
+    conn.reply(1, b"late")
+    conn.reply(2, b"two")
+    assert await task == b"two"
+    assert client._reply_futures == {} and client._abandoned_ref_nos == set()
+    assert stats.dump()['pylyskom.clients.requests.timeouts.last'] == 1
+    assert stats.dump()['pylyskom.clients.replies.discarded.last'] == 1
+    await client.close()
+
+
+async def test_aioclient_cancelled_request():
+    client, conn = await create_aioclient(max_in_flight=1)
+    task = asyncio.ensure_future(client.request(ReqGetText(1)))
+    await run_ready_tasks()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert client._reply_futures == {} and client._abandoned_ref_nos == { 1 }
+    # The in-flight window is released
+    task = asyncio.ensure_future(client.request(ReqGetText(2)))
+    await run_ready_tasks()
+    conn.reply(1, b"late")
+    conn.reply(2, b"two")
+    assert await task == b"two"
+    assert client._abandoned_ref_nos == set()
+    await client.close()
+
+
+async def test_aioclient_receiver_failure_fails_all_requests():
+    client, conn = await create_aioclient()
+    tasks = [ asyncio.ensure_future(client.request(ReqGetText(n))) for n in range(1, 4) ]
+    await run_ready_tasks()
+    conn.fail(ReceiveError("End of stream"))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    assert all(isinstance(r, ReceiveError) for r in results)
+    # Later requests fail at once
+    with pytest.raises(ReceiveError):
+        await client.request(ReqGetText(4))
+    assert len(conn.sent) == 3
+    await client.close()
+
+
+async def test_aioclient_close_fails_waiting_requests():
+    client, conn = await create_aioclient()
+    task = asyncio.ensure_future(client.request(ReqGetText(1)))
+    await run_ready_tasks()
+    await client.close()
+    with pytest.raises(ReceiveError):
+        await task
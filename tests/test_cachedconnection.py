@@ -2,10 +2,13 @@ from __future__ import print_function
 
 from unittest.mock import Mock
 
-from pylyskom.errors import NoSuchLocalText
+import pytest
+
+from pylyskom.errors import NoSuchLocalText, NoSuchText
 from pylyskom.datatypes import TextMapping, ReadRange, Membership
-from pylyskom.requests import Requests
-from pylyskom.cachedconnection import Client, CachingClient
+from pylyskom.requests import Requests, ReqGetText, ReqGetTextStat, ReqGetUconfStat, ReqSetUnread
+from pylyskom.cachedconnection import Cache, Client, CachingClient, CachingPersonClient
+from pylyskom.stats import stats
 
 
 def create_local_to_global_handler(highest_local):
@@ -100,3 +103,186 @@ def test_get_unread_texts_from_membership_fetches_the_correct_mappings():
     assert len(unread_texts) == len(set(unread_texts))
     assert len(unread_texts) == last_text - 1
     assert unread_texts == list(range(1, last_text))
+
+
+def test_cache_evicts_least_recently_used():
+    fetched = []
+    def fetcher(no):
+        fetched.append(no)
+        return no * 10
+    cache = Cache(fetcher, "TestLRU", max_size=2)
+    stats.reset()
+    assert cache[1] == 10
+    assert cache[2] == 20
+    assert cache[1] == 10 # 2 is now the least recently used
+    assert cache[3] == 30
+    assert list(cache.dict.keys()) == [1, 3]
+    assert cache[2] == 20
+    assert fetched == [1, 2, 3, 2]
+    assert stats.dump()['pylyskom.clients.cache.TestLRU.evictions.last'] == 2
+
+
+def test_cache_ttl():
+    now = [100.0]
+    fetched = []
+    def fetcher(no):
+        fetched.append(no)
+        return no * 10
+    cache = Cache(fetcher, "TestTTL", ttl=10)
+    cache._clock = lambda: now[0]
+    stats.reset()
+    assert cache[1] == 10
+    now[0] = 109.0
+    assert cache[1] == 10
+    assert fetched == [1]
+    now[0] = 110.0
+    assert cache[1] == 10
+    assert fetched == [1, 1]
+    assert stats.dump()['pylyskom.clients.cache.TestTTL.expirations.last'] == 1
+
+
+def test_caching_client_uses_cache_options():
+    client = Mock()
+    caching_client = CachingClient(client, cache_options={"TextStat": dict(max_size=17, ttl=60)})
+    assert caching_client.textstats.max_size == 17
+    assert caching_client.textstats.ttl == 60
+    assert caching_client.uconferences.max_size is None
+
+
+def test_caching_person_client_updates_cached_read_ranges():
+    requests_sent = []
+    def mock_request(request):
+        requests_sent.append(request.CALL_NO)
+        if request.CALL_NO == Requests.QUERY_READ_TEXTS:
+            return Membership(conference=request.conference,
+                              read_ranges=[ ReadRange(1, 3), ReadRange(5, 7) ])
+    conn = Mock()
+    conn.request = mock_request
+    caching_client = CachingPersonClient(conn)
+    caching_client.request = mock_request
+    caching_client.login(17, "secret")
+    caching_client.get_membership(17, 1, want_read_ranges=True)
+    caching_client.mark_as_read_local(1, 4)
+    caching_client.mark_as_unread_local(1, 6)
+    membership = caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert [ (rr.first_read, rr.last_read) for rr in membership.read_ranges ] == [
+        (1, 5), (7, 7) ]
+    assert requests_sent.count(Requests.QUERY_READ_TEXTS) == 1
+
+
+def test_caching_person_client_other_read_ranges_changes_invalidate():
+    requests_sent = []
+    def mock_request(request):
+        requests_sent.append(request.CALL_NO)
+        if request.CALL_NO == Requests.QUERY_READ_TEXTS:
+            return Membership(conference=request.conference,
+                              read_ranges=[ ReadRange(1, 3), ReadRange(5, 7) ])
+    conn = Mock()
+    conn.request = mock_request
+    caching_client = CachingPersonClient(conn)
+    caching_client.login(17, "secret")
+    membership = caching_client.get_membership(17, 1, want_read_ranges=True)
+    # A copy of the cached membership
+    membership.read_ranges.add(4)
+    membership = caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert 4 not in membership.read_ranges
+    assert requests_sent.count(Requests.QUERY_READ_TEXTS) == 1
+    caching_client.request(ReqSetUnread(1, 2))
+    caching_client.get_membership(17, 1, want_read_ranges=True)
+    assert requests_sent.count(Requests.QUERY_READ_TEXTS) == 2
+
+
+class PipelineMockConnection(object):
+    """Mock of connection.Connection that answers the requests in
+    order, and logs when requests are sent and responses are read."""
+    def __init__(self, responses):
+        self.responses = responses
+        self.log = []
+        self.sent = []
+        self.no_of_read = 0
+
+    def send_request(self, request):
+        self.sent.append(request)
+        self.log.append(("send", request.CALL_NO))
+        return len(self.sent)
+
+    def send_requests(self, requests):
+        self.log.append(("write", len(requests)))
+        return [ self.send_request(request) for request in requests ]
+
+    def read_response(self):
+        self.no_of_read += 1
+        ref_no = self.no_of_read
+        request = self.sent[ref_no - 1]
+        self.log.append(("read", request.CALL_NO))
+        response = self.responses.get(request.CALL_NO)
+        if isinstance(response, Exception):
+            return ref_no, None, response
+        return ref_no, response, None
+
+
+def test_caching_client_get_text_with_text_stat_sends_both_requests_first():
+    text_stat = Mock()
+    conn = PipelineMockConnection({ Requests.GET_TEXT_STAT: text_stat,
+                                    Requests.GET_TEXT: b"subject\nbody" })
+    caching_client = CachingClient(Client(conn))
+    conn.log = []
+    assert caching_client.get_text_with_text_stat(4711) == (text_stat, b"subject\nbody")
+    assert conn.log == [ ("write", 2), ("send", Requests.GET_TEXT_STAT), ("send", Requests.GET_TEXT),
+                         ("read", Requests.GET_TEXT_STAT), ("read", Requests.GET_TEXT) ]
+    # The text stat is cached
+    conn.log = []
+    assert caching_client.get_text_with_text_stat(4711) == (text_stat, b"subject\nbody")
+    assert conn.log == [ ("send", Requests.GET_TEXT), ("read", Requests.GET_TEXT) ]
+
+
+def test_caching_client_get_text_with_text_stat_reads_both_responses_on_error():
+    conn = PipelineMockConnection({ Requests.GET_TEXT_STAT: NoSuchText(4711),
+                                    Requests.GET_TEXT: NoSuchText(4711) })
+    client = Client(conn)
+    caching_client = CachingClient(client)
+    with pytest.raises(NoSuchText):
+        caching_client.get_text_with_text_stat(4711)
+    assert client._ok_queue == {} and client._error_queue == {}
+
+
+def test_client_request_many():
+    conn = PipelineMockConnection({ Requests.GET_TEXT_STAT: NoSuchText(17),
+                                    Requests.GET_TEXT: b"text",
+                                    Requests.GET_UCONF_STAT: "uconf" })
+    client = Client(conn)
+    reqs = [ ReqGetText(1), ReqGetTextStat(17), ReqGetUconfStat(6) ]
+    results = client.request_many(reqs, return_exceptions=True)
+    assert results[0] == b"text" and isinstance(results[1], NoSuchText) and results[2] == "uconf"
+    assert conn.log[0] == ("write", 3)
+    assert [ e[0] for e in conn.log[1:] ] == [ "send" ] * 3 + [ "read" ] * 3
+    with pytest.raises(NoSuchText):
+        client.request_many(reqs)
+    # All responses were read before raising
+    assert client._ok_queue == {} and client._error_queue == {}
+    assert client.request_many([]) == []
+
+
+def test_client_wait_many_handles_responses_in_any_order():
+    conn = PipelineMockConnection({ Requests.GET_TEXT: b"text",
+                                    Requests.GET_UCONF_STAT: "uconf" })
+    client = Client(conn)
+    ref_nos = client.send_many([ ReqGetText(1), ReqGetUconfStat(6) ])
+    assert client.wait_many(list(reversed(ref_nos))) == [ "uconf", b"text" ]
+
+
+def test_caching_client_get_text_stats():
+    text_stats = { 1: Mock(), 2: Mock(), 3: Mock() }
+    conn = PipelineMockConnection({})
+    caching_client = CachingClient(Client(conn))
+    caching_client.textstats[2] = text_stats[2]
+    sent = []
+    def request_many(reqs, return_exceptions=False):
+        sent.append([ req.text_no for req in reqs ])
+        return [ text_stats[req.text_no] for req in reqs ]
+    caching_client._client.request_many = request_many
+    assert caching_client.get_text_stats([ 3, 2, 1, 3 ]) == [
+        text_stats[3], text_stats[2], text_stats[1], text_stats[3] ]
+    assert sent == [ [ 3, 1 ] ]
+    assert caching_client.get_text_stats([ 1, 2 ]) == [ text_stats[1], text_stats[2] ]
+    assert sent == [ [ 3, 1 ], [] ]
@@ -67,6 +67,18 @@ def test_connection_send_request_sends_request_to_socket():
     c.send_request(ReqAcceptAsync([]))
     assert s.send_data == b"A0H\n1 80 0 { }\n"
 
+def test_connection_send_requests_sends_all_requests_in_one_write():
+    s = MockSocket([b"LysKOM\n", b"=2 4Htext\n=1 25HYawn Nothing is happening\n"])
+    c = Connection(s)
+    sends = []
+    send = s.send
+    s.send = lambda data: sends.append(data) or send(data)
+    ref_nos = c.send_requests([ ReqGetText(12345), ReqGetText(4711, 0, 3) ])
+    assert ref_nos == [ 1, 2 ]
+    assert sends == [ b"1 25 12345 0 2147483647\n2 25 4711 0 3\n" ]
+    assert c.read_response() == (2, b"text", None)
+    assert c.read_response()[0] == 1
+
 def test_connection_read_response_raises_bad_request_id_if_there_is_no_outstanding_request():
     s = MockSocket([b"LysKOM\n", b"=1 25HYawn Nothing is happening\n"])
     c = Connection(s)
@@ -4,8 +4,15 @@ import pytest
 from .mocks import MockSocket
 
 from pylyskom.connection import ReceiveBuffer
-from pylyskom.errors import ReceiveError
-from pylyskom.protocol import to_hstring, read_float, read_int
+from pylyskom.errors import ProtocolError, ReceiveError
+from pylyskom.protocol import (
+    MessageScanner,
+    to_hstring,
+    read_first_non_ws,
+    read_float,
+    read_hollerith_length,
+    read_int,
+    read_ints)
 
 def test_to_hstring():
     to_hstring(b'foobar') == b'7Hfoo bar'
@@ -44,3 +51,89 @@ def test_read_int_raises_if_no_noninteger_character_at_end():
     buf = ReceiveBuffer(s)
     with pytest.raises(ReceiveError):
         read_int(buf)
+
+
+def test_message_scanner_finds_end_of_message():
+    scanner = MessageScanner()
+    data = b"=1 17\n=2 4\n"
+    assert scanner.scan(data, 0, len(data)) == 6
+    assert scanner.scan(data, 6, len(data)) == 5
+
+def test_message_scanner_skips_linefeeds_in_hollerith_strings():
+    scanner = MessageScanner()
+    data = b"=1 9Hfoo\nbar\n 3H\n\n\n\n"
+    assert scanner.scan(data, 0, len(data)) == len(data)
+
+def test_message_scanner_returns_none_for_incomplete_message():
+    scanner = MessageScanner()
+    data = b"=1 10Hfoo\n"
+    assert scanner.scan(data, 0, len(data)) is None
+    assert scanner.hollerith_left() == 6
+
+def test_message_scanner_can_resume_in_hollerith_length():
+    scanner = MessageScanner()
+    data = b"=1 1"
+    assert scanner.scan(data, 0, len(data)) is None
+    data += b"2Hhello\nworld!\n"
+    assert scanner.scan(data, 0, len(data)) == len(data)
+
+def test_message_scanner_can_resume_in_hollerith_string():
+    scanner = MessageScanner()
+    data = b"=1 12Hhello\n"
+    assert scanner.scan(data, 0, len(data)) is None
+    data += b"world!\n"
+    assert scanner.scan(data, 0, len(data)) == len(data)
+
+def test_receive_buffer_receive_byte_returns_int():
+    s = MockSocket(b"A")
+    buf = ReceiveBuffer(s)
+    assert buf.receive_byte() == ord("A")
+
+def test_receive_buffer_can_receive_string_larger_than_buffer():
+    data = b"0123456789" * 10
+    s = MockSocket([b"x", data, b"y"])
+    buf = ReceiveBuffer(s, size=16)
+    assert buf.receive_char() == b"x"
+    assert buf.receive_string(len(data)) == data
+    assert buf.receive_char() == b"y"
+
+def test_receive_buffer_compacts_instead_of_growing():
+    s = MockSocket([b"abcdefgh" * 8])
+    buf = ReceiveBuffer(s, size=16)
+    received = b"".join(buf.receive_string(6) for i in range(10))
+    assert received == (b"abcdefgh" * 8)[:60]
+    assert len(buf._rb) == 16
+
+def test_read_int_does_not_stop_in_whitespace_at_end_of_received_data():
+    s = MockSocket([b"  ", b"4711 "])
+    buf = ReceiveBuffer(s, size=2)
+    res = read_int(buf)
+    assert res == 4711
+
+def test_read_int_does_not_stop_in_digits_at_end_of_received_data():
+    s = MockSocket([b"47", b"11 "])
+    buf = ReceiveBuffer(s, size=2)
+    res = read_int(buf)
+    assert res == 4711
+
+def test_read_first_non_ws_does_not_stop_in_whitespace_at_end_of_received_data():
+    s = MockSocket([b"  ", b" x"])
+    buf = ReceiveBuffer(s, size=2)
+    assert read_first_non_ws(buf) == b"x"
+
+def test_read_ints():
+    s = MockSocket(b"1 22 333\n")
+    buf = ReceiveBuffer(s)
+    assert read_ints(buf, 3) == [1, 22, 333]
+
+def test_read_hollerith_length():
+    s = MockSocket(b" 5Hhello")
+    buf = ReceiveBuffer(s)
+    assert read_hollerith_length(buf) == 5
+    assert buf.receive_string(5) == b"hello"
+
+def test_read_hollerith_length_raises_if_not_hollerith_string():
+    s = MockSocket(b" 5 hello")
+    buf = ReceiveBuffer(s)
+    with pytest.raises(ProtocolError):
+        read_hollerith_length(buf)
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import json
+import random
 
 from pylyskom.datatypes import ReadRange
+from pylyskom.requests import ReqGetText, ReqMarkAsUnread, ReqSetUnread
 from pylyskom.utils import (
+    count_unread_texts,
+    cut_incomplete_utf8,
     decode_user_area,
     encode_user_area,
     parse_content_type,
+    LocalToGlobalIndex,
+    ReadRangeSet,
+    read_ranges_changed_by,
     read_ranges_to_gaps_and_last
 )
 
@@ -156,3 +163,150 @@ def test_read_ranges_to_gaps_and_last():
     assert last == 11
     assert len(gaps) == 2
     assert gaps == [(4, 1), (6, 2)]
+
+
+def test_cut_incomplete_utf8():
+    data = "aö€😀".encode("utf-8")
+    assert cut_incomplete_utf8(data) == data
+    assert cut_incomplete_utf8(b"") == b""
+    for cut in range(1, len(data)):
+        cut_data = cut_incomplete_utf8(data[:cut])
+        assert data.startswith(cut_data)
+        assert len(cut_data) > cut - 4
+        cut_data.decode("utf-8")
+
+
+def test_count_unread_texts():
+    assert count_unread_texts([], 0) == 0
+    assert count_unread_texts([], 10) == 10
+    assert count_unread_texts([ ReadRange(1, 10) ], 10) == 0
+    assert count_unread_texts([ ReadRange(1, 3), ReadRange(5, 7) ], 10) == 4
+    # Read ranges past the highest local number (cache not updated yet)
+    assert count_unread_texts([ ReadRange(1, 3), ReadRange(5, 17) ], 10) == 1
+    assert count_unread_texts([ ReadRange(12, 17) ], 10) == 10
+
+
+def test_local_to_global_index_add_mapping_and_lookup():
+    index = LocalToGlobalIndex()
+    assert index.lookup(1, 10) is None
+    index.add_mapping(1, 5, [ (1, 101), (2, 102), (4, 104) ], True)
+    assert index.lookup(1, 5) == [ (1, 101), (2, 102), (4, 104) ]
+    assert index.lookup(2, 4) == [ (2, 102) ]
+    assert index.lookup(3, 7) is None
+    # Adjacent mapping, to the end of the conference
+    index.add_mapping(5, 8, [ (7, 107) ], False)
+    assert (index.begin, index.end, index.complete) == (1, 8, True)
+    assert index.lookup(3, 20) == [ (4, 104), (7, 107) ]
+    # Overlapping mapping at the start
+    index.add_mapping(1, 3, [ (1, 101) ], True)
+    assert index.lookup(1, 8) == [ (1, 101), (4, 104), (7, 107) ]
+    assert index.complete
+
+
+def test_local_to_global_index_disjoint_mapping_keeps_latest():
+    index = LocalToGlobalIndex()
+    index.add_mapping(1, 5, [ (1, 101) ], True)
+    index.add_mapping(10, 12, [ (11, 111) ], False)
+    assert (index.begin, index.end) == (10, 12)
+    assert index.lookup(1, 5) is None
+    assert index.lookup(10, 15) == [ (11, 111) ]
+    index.add_mapping(1, 5, [ (1, 101) ], True)
+    assert (index.begin, index.end) == (10, 12)
+
+
+def test_local_to_global_index_last_texts():
+    index = LocalToGlobalIndex()
+    index.add_mapping(5, 10, [ (5, 105), (7, 107), (9, 109) ], True)
+    assert index.last_texts(2) is None
+    index.add_mapping(10, 10, [], False)
+    assert index.last_texts(2) == [ (7, 107), (9, 109) ]
+    # Earlier texts might exist before local number 5
+    assert index.last_texts(4) is None
+    index.add_mapping(1, 5, [], True)
+    assert index.last_texts(4) == [ (5, 105), (7, 107), (9, 109) ]
+
+
+def test_local_to_global_index_new_and_removed_texts():
+    index = LocalToGlobalIndex()
+    index.add_mapping(1, 3, [ (1, 101), (2, 102) ], True)
+    # Not complete, so we don't know what is between
+    index.add_text(5, 105)
+    assert index.end == 3
+    index.add_mapping(3, 3, [], False)
+    index.add_text(5, 105)
+    assert index.lookup(1, 10) == [ (1, 101), (2, 102), (5, 105) ]
+    index.remove_text(102, 2)
+    index.remove_text(105)
+    index.remove_text(999)
+    assert index.lookup(1, 10) == [ (1, 101) ]
+    index.set_incomplete()
+    assert index.lookup(1, 10) is None
+    assert index.lookup(1, 6) == [ (1, 101) ]
+
+
+def read_range_tuples(read_ranges):
+    return [ (rr.first_read, rr.last_read) for rr in read_ranges ]
+
+
+def test_read_range_set_add_and_remove():
+    rrs = ReadRangeSet([ ReadRange(1, 3), ReadRange(5, 5), ReadRange(), ReadRange(8, 10) ])
+    assert read_range_tuples(rrs) == [ (1, 3), (5, 5), (8, 10) ]
+    assert 3 in rrs and 5 in rrs and 8 in rrs
+    assert 4 not in rrs and 7 not in rrs and 11 not in rrs and 0 not in rrs
+    rrs.add(4)
+    assert read_range_tuples(rrs) == [ (1, 5), (8, 10) ]
+    rrs.add(12)
+    rrs.add_range(6, 9)
+    assert read_range_tuples(rrs) == [ (1, 10), (12, 12) ]
+    assert rrs.remove(4)
+    assert not rrs.remove(4)
+    assert rrs.remove(1)
+    assert rrs.remove(12)
+    assert read_range_tuples(rrs) == [ (2, 3), (5, 10) ]
+    assert len(rrs) == 2
+
+
+def test_read_range_set_gaps():
+    rrs = ReadRangeSet([ ReadRange(1, 1), ReadRange(2, 3), ReadRange(5, 5), ReadRange(8, 10) ])
+    assert rrs.gaps_and_last() == ([ (4, 1), (6, 2) ], 11)
+    assert read_ranges_to_gaps_and_last(rrs) == ([ (4, 1), (6, 2) ], 11)
+    assert ReadRangeSet().gaps_and_last() == ([], 1)
+    assert list(rrs.gaps(5, 20)) == [ (6, 2), (11, 9) ]
+    assert list(rrs.gaps(1, 7)) == [ (4, 1), (6, 1) ]
+
+
+def test_read_range_set_matches_set_of_local_numbers():
+    rnd = random.Random(4711)
+    rrs = ReadRangeSet()
+    read = set()
+    for i in range(2000):
+        local_no = rnd.randint(1, 100)
+        if rnd.random() < 0.6:
+            rrs.add(local_no)
+            read.add(local_no)
+        else:
+            assert rrs.remove(local_no) == (local_no in read)
+            read.discard(local_no)
+    assert [ n for n in range(1, 102) if n in rrs ] == sorted(read)
+    ranges = read_range_tuples(rrs)
+    # Disjoint and not adjacent
+    assert all(ranges[i][1] + 1 < ranges[i + 1][0] for i in range(len(ranges) - 1))
+    assert count_unread_texts(rrs, 100) == 100 - len(read)
+
+
+def test_read_range_set_copy_is_independent():
+    rrs = ReadRangeSet([ ReadRange(1, 3) ])
+    copy = rrs.copy()
+    copy.add(4)
+    assert read_range_tuples(rrs) == [ (1, 3) ]
+    assert copy != rrs
+    rrs.add(4)
+    assert copy == rrs
+
+
+def test_read_ranges_changed_by():
+    assert read_ranges_changed_by(ReqSetUnread(17, 2)) == 17
+    assert read_ranges_changed_by(ReqMarkAsUnread(18, 4)) == 18
+    assert read_ranges_changed_by(b"110 19 0 { }") == 19
+    assert read_ranges_changed_by(ReqGetText(17)) is None
+    assert read_ranges_changed_by(b"25 17 0 100") is None